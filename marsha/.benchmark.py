@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+
+import argparse
+import glob
+import hashlib
+import http.server
+import json
+import math
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Parse the input arguments
+parser = argparse.ArgumentParser(
+    prog='.benchmark.py',
+    description='Benchmark the Marsha pipeline offline, replaying recorded LLM responses from a local OpenAI stub'
+)
+parser.add_argument('specs', nargs='*',
+                    help='The Marsha files to benchmark, defaults to every example, each of which needs a recording')
+parser.add_argument('--runs', type=int, default=5,
+                    help='Number of compiles per Marsha file')
+parser.add_argument('--warmup', type=int, default=1,
+                    help='Number of compiles per Marsha file before measuring, which are not counted')
+parser.add_argument('--recordings', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'recordings'),
+                    help='Directory with the recorded responses, one JSON file per Marsha file')
+parser.add_argument('--record', action='store_true',
+                    help='Forwards the requests to the OpenAI API and records the responses, instead of replaying them')
+parser.add_argument('--output', default='benchmark.json',
+                    help='File to write the results to')
+parser.add_argument('--baseline', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'baseline.json'),
+                    help='Results of a previous benchmark to compare against')
+parser.add_argument('--save-baseline', action='store_true',
+                    help='Writes the results to the baseline file instead of comparing against it')
+parser.add_argument('--tolerance', type=float, default=0.25,
+                    help='How much slower than the baseline a p50 can get, as a fraction, before it is a regression')
+parser.add_argument('--min-delta', type=float, default=0.05,
+                    help='How many seconds slower than the baseline a p50 can get regardless of the tolerance')
+# Everything after `--` is passed on to Marsha
+argv = sys.argv[1:]
+marsha_args = argv[argv.index('--') + 1:] if '--' in argv else []
+args = parser.parse_args(argv[:argv.index('--')] if '--' in argv else argv)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLES = os.path.join(ROOT, 'examples')
+# Trace categories that are not waiting on the LLM
+OVERHEAD_CATEGORIES = ['parse', 'lint', 'venv', 'pip', 'test', 'format', 'io']
+# The temporary directory of each candidate shows up in the prompts, and in the responses that name the files
+TMPDIR_PATTERN = re.compile(r'[^\s\'"`(]*_-_[^/\s\'"`]*/')
+TMPDIR_PLACEHOLDER = '<tmpdir>/'
+# Parts of the prompts that change from run to run without changing the request: test durations and object
+# addresses
+VOLATILE_PATTERNS = [
+    (re.compile(r'(Ran \d+ tests?) in [\d.]+s'), r'\1'),
+    (re.compile(r' at 0x[0-9a-f]+'), ''),
+]
+
+
+def normalize(content: str, cache_dir: str) -> str:
+    content = TMPDIR_PATTERN.sub(
+        TMPDIR_PLACEHOLDER, content.replace(cache_dir, '<cache>'))
+    for (pattern, replacement) in VOLATILE_PATTERNS:
+        content = pattern.sub(replacement, content)
+    return content
+
+
+def find_tmpdir(body: dict) -> str:
+    for message in body['messages']:
+        match = TMPDIR_PATTERN.search(message['content'])
+        if match is not None:
+            return match.group(0)
+    return None
+
+
+def map_contents(response: dict, transform) -> dict:
+    response = json.loads(json.dumps(response))
+    for choice in response['choices']:
+        choice['message']['content'] = transform(choice['message']['content'])
+    return response
+
+
+def request_key(body: dict, cache_dir: str) -> str:
+    messages = [(message['role'], normalize(message['content'], cache_dir))
+                for message in body['messages']]
+    return hashlib.sha256(json.dumps([messages, body.get('model'), body.get('n', 1), body.get('max_tokens')]).encode(
+        'utf-8')).hexdigest()
+
+
+class Recording:
+    """Recorded responses for one Marsha file. The same request can get a different response each time it is
+    made, like a fix that only works on the second try, so every request has a list of them that is replayed in
+    order, repeating the last one"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for entry in json.load(f)['requests']:
+                    self.entries[entry['key']] = entry
+        self.served = {}
+        self.misses = 0
+
+    def reset(self):
+        self.served = {}
+        self.misses = 0
+
+    def replay(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses = self.misses + 1
+            return None
+        index = self.served.get(key, 0)
+        self.served[key] = index + 1
+        return entry['responses'][min(index, len(entry['responses']) - 1)]
+
+    def record(self, key: str, body: dict, response: dict, cache_dir: str):
+        if key not in self.entries:
+            self.entries[key] = {
+                'key': key,
+                'model': body.get('model'),
+                'n': body.get('n', 1),
+                'max_tokens': body.get('max_tokens'),
+                'messages': [{'role': message['role'], 'content': normalize(message['content'], cache_dir)}
+                             for message in body['messages']],
+                'responses': [],
+            }
+        # Only new responses are added, replays of a request made the same number of times stay the same
+        index = self.served.get(key, 0)
+        self.served[key] = index + 1
+        if index >= len(self.entries[key]['responses']):
+            self.entries[key]['responses'].append(response)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump({'requests': list(self.entries.values())},
+                      f, indent=2)
+
+
+def upstream_completion(body: dict) -> dict:
+    import openai
+    openai.api_key = os.getenv('OPENAI_SECRET_KEY')
+    openai.organization = os.getenv('OPENAI_ORG')
+    query = {key: value for (key, value) in body.items() if key != 'stream'}
+    return openai.ChatCompletion.create(**query).to_dict_recursive()
+
+
+class MockOpenAIServer(http.server.ThreadingHTTPServer):
+    """An OpenAI compatible chat completions endpoint that replays, or records, the responses of a `Recording`"""
+
+    def __init__(self, cache_dir: str, record: bool = False):
+        super().__init__(('127.0.0.1', 0), MockOpenAIHandler)
+        self.cache_dir = cache_dir
+        self.record = record
+        self.recording = None
+        self.lock = threading.Lock()
+
+    @property
+    def api_base(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}/v1'
+
+
+class MockOpenAIHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, content: dict):
+        data = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_stream(self, response: dict):
+        # One chunk per choice with all of its content, the stream parser does not care how it is split
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        for choice in response['choices']:
+            for (delta, finish_reason) in [({'role': 'assistant', 'content': choice['message']['content']}, None),
+                                           ({}, choice.get('finish_reason', 'stop'))]:
+                chunk = {'id': response.get('id', 'replay'), 'object': 'chat.completion.chunk',
+                         'model': response['model'], 'choices': [{'index': choice['index'], 'delta': delta,
+                                                                  'finish_reason': finish_reason}]}
+                self.wfile.write(
+                    f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+        self.wfile.write(b'data: [DONE]\n\n')
+        self.close_connection = True
+
+    def do_POST(self):
+        if not self.path.endswith('/chat/completions'):
+            return self.send_json(404, {'error': {'message': f'Unknown path {self.path}', 'type': 'invalid_request_error'}})
+        body = json.loads(self.rfile.read(
+            int(self.headers.get('Content-Length', 0))))
+        key = request_key(body, self.server.cache_dir)
+        if self.server.record:
+            try:
+                response = upstream_completion(body)
+            except Exception as e:
+                return self.send_json(500, {'error': {'message': str(e), 'type': 'server_error'}})
+            with self.server.lock:
+                self.server.recording.record(key, body, map_contents(
+                    response, lambda content: TMPDIR_PATTERN.sub(TMPDIR_PLACEHOLDER, content)), self.server.cache_dir)
+        else:
+            with self.server.lock:
+                response = self.server.recording.replay(key)
+            if response is None:
+                return self.send_json(400, {'error': {'message': 'No recorded response for this request',
+                                                      'type': 'invalid_request_error', 'code': 'not_recorded'}})
+            tmpdir = find_tmpdir(body)
+            if tmpdir is not None:
+                response = map_contents(
+                    response, lambda content: content.replace(TMPDIR_PLACEHOLDER, tmpdir))
+        if body.get('stream'):
+            return self.send_stream(response)
+        self.send_json(200, response)
+
+
+def percentile(values: list[float], p: float) -> float:
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    (lower, upper) = (math.floor(k), math.ceil(k))
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def trace_overhead(trace_file: str) -> dict[str, float]:
+    """Seconds spent in each kind of non-LLM work, summed over the candidates"""
+    totals = {category: 0 for category in OVERHEAD_CATEGORIES}
+    try:
+        with open(trace_file, 'r') as f:
+            events = json.load(f)['traceEvents']
+    except Exception:
+        return totals
+    for event in events:
+        if event['ph'] == 'X' and event.get('cat') in totals:
+            totals[event['cat']] = totals[event['cat']] + event['dur'] / 1e6
+    return totals
+
+
+def run_compile(server: MockOpenAIServer, spec: str, cache_dir: str) -> dict:
+    workdir = tempfile.mkdtemp(prefix='marsha_benchmark_')
+    try:
+        # Type definitions can point at files next to the spec, like a CSV file
+        for path in glob.glob(os.path.join(os.path.dirname(os.path.abspath(spec)), '*')):
+            if os.path.isfile(path):
+                shutil.copy(path, workdir)
+        env = {
+            **os.environ,
+            'PYTHONPATH': ROOT,
+            'OPENAI_API_BASE': server.api_base,
+            'OPENAI_SECRET_KEY': 'replay',
+            'MARSHA_CACHE_DIR': cache_dir,
+        }
+        cmd = [sys.executable, '-m', 'marsha', os.path.basename(spec), '--no-cache', '-s', '--trace',
+               'trace.json'] + marsha_args
+        t1 = time.time()
+        process = subprocess.run(
+            cmd, cwd=workdir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        wall_time = time.time() - t1
+        try:
+            with open(os.path.join(workdir, 'stats.json'), 'r') as f:
+                total_calls = json.load(f)['total_calls']
+        except Exception:
+            total_calls = 0
+        return {
+            'exitcode': process.returncode,
+            'wall_time': wall_time,
+            'llm_calls': total_calls,
+            'overhead': trace_overhead(os.path.join(workdir, 'trace.json')),
+            'output': process.stdout.decode('utf-8', errors='replace'),
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def summarize(runs: list[dict], misses: int) -> dict:
+    def stat(values):
+        return {'p50': percentile(values, 50), 'p95': percentile(values, 95)}
+    return {
+        'runs': len(runs),
+        'success_rate': len([run for run in runs if run['exitcode'] == 0]) / len(runs),
+        'misses': misses,
+        'llm_calls': stat([run['llm_calls'] for run in runs]),
+        'wall_time': stat([run['wall_time'] for run in runs]),
+        'overhead': stat([sum(run['overhead'].values()) for run in runs]),
+        **{category: stat([run['overhead'][category] for run in runs]) for category in OVERHEAD_CATEGORIES},
+    }
+
+
+def find_regressions(results: dict, baseline: dict) -> list[str]:
+    regressions = []
+    for (spec, result) in results.items():
+        if spec not in baseline:
+            continue
+        if result['success_rate'] < baseline[spec]['success_rate']:
+            regressions.append(
+                f'{spec}: success rate {result["success_rate"]} < {baseline[spec]["success_rate"]}')
+        for metric in ['wall_time', 'overhead'] + OVERHEAD_CATEGORIES:
+            (current, previous) = (
+                result[metric]['p50'], baseline[spec][metric]['p50'])
+            if current > previous * (1 + args.tolerance) and current - previous > args.min_delta:
+                regressions.append(
+                    f'{spec}: {metric} p50 {round(current, 3)}s > {round(previous, 3)}s')
+    return regressions
+
+
+def get_recording_path(spec: str) -> str:
+    relative = os.path.relpath(os.path.abspath(spec), EXAMPLES) if os.path.abspath(
+        spec).startswith(EXAMPLES) else os.path.basename(spec)
+    return os.path.join(args.recordings, f'{os.path.splitext(relative)[0]}.json')
+
+
+specs = args.specs if len(args.specs) > 0 else sorted(
+    glob.glob(os.path.join(EXAMPLES, '**', '*.mrsh'), recursive=True))
+# A spec without a recording can't be replayed, and leaving it out would pass the benchmark without running it
+missing = [] if args.record else [
+    spec for spec in specs if not os.path.exists(get_recording_path(spec))]
+if len(missing) > 0:
+    print('No recording for:')
+    print('\n'.join([f'* {spec}' for spec in missing]))
+    print('Run with `--record` and an OpenAI key to make them.')
+    sys.exit(1)
+# Virtual environments are shared by every run, so installing the requirements is only measured once
+cache_dir = tempfile.mkdtemp(prefix='marsha_benchmark_cache_')
+server = MockOpenAIServer(cache_dir, args.record)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+results = {}
+try:
+    for spec in specs:
+        name = os.path.splitext(os.path.relpath(os.path.abspath(spec), EXAMPLES) if os.path.abspath(
+            spec).startswith(EXAMPLES) else os.path.basename(spec))[0]
+        server.recording = Recording(get_recording_path(spec))
+        runs = []
+        misses = 0
+        total_runs = 1 if args.record else args.runs
+        # The first compile creates the virtual environment and fills the caches the later ones read, which would
+        # otherwise be charged to whichever file happens to be benchmarked first
+        for i in range(0 if args.record else args.warmup):
+            print(f'{name}: warm up {i + 1} / {args.warmup}')
+            server.recording.reset()
+            run_compile(server, spec, cache_dir)
+        for i in range(total_runs):
+            print(f'{name}: run {i + 1} / {total_runs}')
+            server.recording.reset()
+            run = run_compile(server, spec, cache_dir)
+            misses = misses + server.recording.misses
+            if run['exitcode'] != 0:
+                print(run['output'])
+            runs.append(run)
+        if args.record:
+            server.recording.save()
+        results[name] = summarize(runs, misses)
+        print(
+            f'{name}: {round(results[name]["success_rate"] * 100)}% passed, wall time p50 {round(results[name]["wall_time"]["p50"], 3)}s, overhead p50 {round(results[name]["overhead"]["p50"], 3)}s')
+finally:
+    server.shutdown()
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+with open(args.output, 'w') as f:
+    json.dump(results, f, indent=2)
+print(f'Results written to {args.output}')
+
+if args.save_baseline:
+    with open(args.baseline, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Baseline written to {args.baseline}')
+elif os.path.exists(args.baseline):
+    with open(args.baseline, 'r') as f:
+        regressions = find_regressions(results, json.load(f))
+    if len(regressions) > 0:
+        print('Regressions against the baseline:')
+        print('\n'.join([f'* {regression}' for regression in regressions]))
+        sys.exit(1)
+    print('No regressions against the baseline.')
@@ -1,14 +1,18 @@
 #!/usr/bin/env python
 
 import argparse
+import asyncio
+import json
 import math
 import os
+import shlex
+import shutil
+import tempfile
 import time
 
+from marsha.stats import percentile
 from marsha.utils import prettify_time_delta
 
-from mistletoe import Document, ast_renderer
-
 
 # Parse the input arguments
 parser = argparse.ArgumentParser(
@@ -16,89 +20,246 @@ parser = argparse.ArgumentParser(
     description='Time the execution of Marsha on the same source multiple times'
 )
 parser.add_argument('source')
-parser.add_argument('attempts', type=int, default=3)
-parser.add_argument('n_parallel_executions', type=int, default=1)
-parser.add_argument('stats', type=bool, default=False)
+parser.add_argument('attempts', nargs='?', type=int, default=3)
+parser.add_argument('n_parallel_executions', nargs='?', type=int, default=1)
+parser.add_argument('stats', nargs='?', type=bool, default=False,
+                    help='Appends the stats of every run to `agg_stats.md`')
+parser.add_argument('--runs', type=int, default=30,
+                    help='Number of runs per configuration')
+parser.add_argument('--concurrency', type=int, default=5,
+                    help='Maximum number of runs at once')
+parser.add_argument('--compare', default=None,
+                    help='Extra Marsha arguments for a second configuration to compare against, like "-n 3"')
+parser.add_argument('--marsha', default='./dist/marsha',
+                    help='The command to run Marsha with')
+parser.add_argument('--keep', action='store_true',
+                    help='Keeps the working directory of every run')
 args = parser.parse_args()
 
-exitcodes = []
-times = []
-calls = []
-cost = []
-total_runs = 30
-for i in range(total_runs):
-    print(f'Run {i + 1} / {total_runs}')
-    t_1 = time.time()
-    print(
-        f'Running ./dist/marsha {args.source} -a {args.attempts} -n {args.n_parallel_executions} {args.stats and "-s"}')
-    exitcode = os.system(
-        f'./dist/marsha {args.source} -a {args.attempts} -n {args.n_parallel_executions} {args.stats and "-s"}')
-    t_2 = time.time()
-    testtime = t_2 - t_1
-    exitcodes.append(exitcode)
-    times.append(testtime)
-    if args.stats:
-        try:
-            run_stats_file = open('stats.md', 'r')
-            run_stats = run_stats_file.read()
-            run_stats_file.close()
-        except Exception:
-            raise Exception('Error reading stats file. Maybe something went run while running Marsha and the stats were not generated?')
+METRICS = ['time', 'calls', 'cost']
+
+
+def resolve_command(command: str) -> list[str]:
+    """Splits the Marsha command, with the executable as an absolute path since the runs start in their own
+    working directory"""
+    parts = shlex.split(command)
+    if os.sep in parts[0] or (os.altsep is not None and os.altsep in parts[0]):
+        executable = os.path.abspath(parts[0])
+    else:
+        executable = shutil.which(parts[0])
+    if executable is None or not os.path.exists(executable):
+        raise SystemExit(f'Marsha command not found: {parts[0]}')
+    return [executable] + parts[1:]
+
+
+MARSHA_COMMAND = resolve_command(args.marsha)
+
+
+def mean(values: list[float]) -> float:
+    return sum(values) / len(values) if len(values) > 0 else 0
+
+
+def stddev(values: list[float]) -> float:
+    # Sample standard deviation, the runs are a sample of what Marsha could do
+    if len(values) < 2:
+        return 0
+    avg = mean(values)
+    return math.sqrt(sum([(v - avg) ** 2 for v in values]) / (len(values) - 1))
+
+
+def beta_continued_fraction(a: float, b: float, x: float, iterations: int = 300, epsilon: float = 1e-12) -> float:
+    # Lentz's method for the continued fraction of the incomplete beta function
+    tiny = 1e-300
+    c = 1
+    d = 1 - (a + b) * x / (a + 1)
+    d = 1 / (d if abs(d) > tiny else tiny)
+    h = d
+    for m in range(1, iterations):
+        for numerator in [m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m)),
+                          -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 2 * m + 1))]:
+            d = 1 + numerator * d
+            d = 1 / (d if abs(d) > tiny else tiny)
+            c = 1 + numerator / c
+            c = c if abs(c) > tiny else tiny
+            h = h * d * c
+        if abs(d * c - 1) < epsilon:
+            break
+    return h
+
+
+def incomplete_beta(a: float, b: float, x: float) -> float:
+    """The regularized incomplete beta function I_x(a, b)"""
+    if x <= 0:
+        return 0
+    if x >= 1:
+        return 1
+    if x > (a + 1) / (a + b + 2):
+        return 1 - incomplete_beta(b, a, 1 - x)
+    front = math.exp(math.lgamma(a + b) - math.lgamma(a) -
+                     math.lgamma(b) + a * math.log(x) + b * math.log(1 - x))
+    return front * beta_continued_fraction(a, b, x) / a
+
+
+def welch_t_test(a: list[float], b: list[float]) -> float:
+    """The two-sided p-value of Welch's t-test, the odds of a difference in means at least this big if both
+    configurations performed the same"""
+    if len(a) < 2 or len(b) < 2:
+        return None
+    (var_a, var_b) = (stddev(a) ** 2 / len(a), stddev(b) ** 2 / len(b))
+    if var_a + var_b == 0:
+        return 1.0 if math.isclose(mean(a), mean(b)) else 0.0
+    t = (mean(a) - mean(b)) / math.sqrt(var_a + var_b)
+    df = (var_a + var_b) ** 2 / (var_a ** 2 /
+                                 (len(a) - 1) + var_b ** 2 / (len(b) - 1))
+    return incomplete_beta(df / 2, 0.5, df / (df + t * t))
+
+
+async def run_marsha(config: str, marsha_args: list[str], i: int, semaphore: asyncio.Semaphore) -> dict:
+    async with semaphore:
+        # Every run gets its own directory, so the generated code, the stats and the build manifest of one run are
+        # never read by another
+        workdir = tempfile.mkdtemp(prefix=f'marsha_time_{config}_{i + 1}_')
+        command = MARSHA_COMMAND + \
+            [os.path.abspath(args.source)] + marsha_args
+        print(
+            f'Run {i + 1} / {args.runs} ({config}): {shlex.join(command)} in {workdir}')
+        t_1 = time.time()
+        with open(os.path.join(workdir, 'marsha.log'), 'w') as log:
+            process = await asyncio.create_subprocess_exec(*command, cwd=workdir, stdout=log, stderr=log)
+            exitcode = await process.wait()
+        t_2 = time.time()
+        run = {'config': config, 'run': i + 1, 'exitcode': exitcode, 'time': t_2 - t_1, 'calls': 0, 'cost': 0,
+               'stats': None}
         try:
-            ast = ast_renderer.get_ast(Document(run_stats))
-            results_child = ast['children'].pop()
-            calls.append(int(results_child[
-                         'children'][2]['content'].split('Total calls: ').pop()))
-            cost.append(float(results_child[
-                'children'][6]['content'].split('Total cost: ').pop()))
+            with open(os.path.join(workdir, 'stats.json'), 'r') as f:
+                run_stats = json.load(f)
+            run['calls'] = run_stats['total_calls']
+            run['cost'] = run_stats['total_cost']
+            with open(os.path.join(workdir, 'stats.md'), 'r') as f:
+                run['stats'] = f.read()
         except Exception as e:
-            print(f'Error: {e}')
-            calls.append(0)
-            cost.append(0)
-        with open('agg_stats.md', 'a') as f:
-            f.write(f'''# Run {i + 1} / {total_runs}
-Exit code: {exitcode}
-Time: {prettify_time_delta(testtime)}
-Stats:
+            print(f'Error reading the stats of run {i + 1} ({config}): {e}')
+        print(
+            f'Run {i + 1} / {args.runs} ({config}) finished in {prettify_time_delta(run["time"])} with exit code {exitcode}')
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+        return run
 
-```md
-{run_stats}
-```
 
-''')
+async def run_all(configs: dict[str, list[str]]) -> list[dict]:
+    semaphore = asyncio.Semaphore(max(args.concurrency, 1))
+    # The configurations take turns, so anything that slows down part of the measurement, like the API, slows down
+    # both of them
+    return await asyncio.gather(*[run_marsha(config, marsha_args, i, semaphore)
+                                  for i in range(args.runs) for (config, marsha_args) in configs.items()])
+
+
+def summarize(runs: list[dict]) -> dict:
+    summary = {
+        'runs': len(runs),
+        'successes': len([run for run in runs if run['exitcode'] == 0]),
+        'success_rate': mean([1 if run['exitcode'] == 0 else 0 for run in runs]),
+    }
+    for metric in METRICS:
+        values = [run[metric] for run in runs]
+        summary[metric] = {
+            'mean': mean(values),
+            'stddev': stddev(values),
+            'p50': percentile(values, 50),
+            'p95': percentile(values, 95),
+            'total': sum(values),
+        }
+    return summary
+
+
+def format_metric(metric: str, value: float) -> str:
+    if metric == 'time':
+        return prettify_time_delta(value)
+    return str(round(value, 2))
+
 
+def format_summary(config: str, marsha_args: list[str], summary: dict) -> str:
+    rows = '\n'.join([f'| {metric} | {format_metric(metric, summary[metric]["mean"])} +/- {format_metric(metric, summary[metric]["stddev"])} | {format_metric(metric, summary[metric]["p50"])} | {format_metric(metric, summary[metric]["p95"])} |'
+                      for metric in METRICS])
+    return f'''## {config}: `{shlex.join(marsha_args)}`
+`{summary['successes']} / {summary['runs']} runs successful`
+**Total cost**: `{round(summary['cost']['total'], 2)}`
 
-successes = [True if code == 0 else False for code in exitcodes]
-# Time calculations
-totaltime = sum(times)
-avgtime = totaltime / total_runs
-square_errors = [(t - avgtime) ** 2 for t in times]
-stddevtime = math.sqrt(sum(square_errors) / total_runs)
-# Call calculations
-totalcalls = sum(calls)
-avgcalls = round(totalcalls / total_runs, 2)
-square_errors = [(c - avgcalls) ** 2 for c in calls]
-stddevcalls = round(math.sqrt(sum(square_errors) / total_runs), 2)
-# Cost calculations
-totalcost = round(sum(cost), 2)
-avgcost = round(totalcost / total_runs, 2)
-square_errors = [(c - avgcost) ** 2 for c in cost]
-stddevcost = round(math.sqrt(sum(square_errors) / total_runs), 2)
-
-results = f'''
-# Test results
-`{sum(successes)} / {total_runs} runs successful`
-**Avg Runtime**: `{prettify_time_delta(avgtime)} +/- {prettify_time_delta(stddevtime)}`
-**Avg GPT calls**: `{avgcalls} +/- {stddevcalls}`
-**Avg cost**: `{avgcost} +/- {stddevcost}`
-**Total cost**: `{totalcost}`
+| Metric | Mean | p50 | p95 |
+| --- | --- | --- | --- |
+{rows}
 '''
+
+
+def run_value(run: dict, metric: str) -> float:
+    if metric == 'success_rate':
+        return 1 if run['exitcode'] == 0 else 0
+    return run[metric]
+
+
+def format_comparison(runs: list[dict]) -> tuple[str, dict]:
+    comparison = {}
+    rows = []
+    for metric in ['success_rate'] + METRICS:
+        (a, b) = ([run_value(run, metric)
+                   for run in runs if run['config'] == config] for config in ['A', 'B'])
+        p_value = welch_t_test(a, b)
+        comparison[metric] = {'A': mean(a), 'B': mean(
+            b), 'difference': mean(b) - mean(a), 'p_value': p_value}
+        rows.append(
+            f'| {metric} | {format_metric(metric, mean(a))} | {format_metric(metric, mean(b))} | {"n/a" if p_value is None else round(p_value, 4)} |')
+    rows = '\n'.join(rows)
+    return (f'''## A vs B
+A p-value below 0.05 means the difference in means is unlikely to be noise (Welch's t-test).
+
+| Metric | A | B | p-value |
+| --- | --- | --- | --- |
+{rows}
+''', comparison)
+
+
+base_args = ['-a', str(args.attempts), '-n',
+             str(args.n_parallel_executions), '-s', '--no-cache']
+configs = {'A': base_args}
+if args.compare is not None:
+    # Later arguments win, so the second configuration can override the attempts or the parallel executions
+    configs['B'] = base_args + shlex.split(args.compare)
+
+t_0 = time.time()
+runs = asyncio.run(run_all(configs))
+print(f'All runs finished in {prettify_time_delta(time.time() - t_0)}')
+
+summaries = {config: summarize(
+    [run for run in runs if run['config'] == config]) for config in configs}
+results = '\n# Test results\n' + '\n'.join([format_summary(config, marsha_args, summaries[config])
+                                            for (config, marsha_args) in configs.items()])
+comparison = None
+if args.compare is not None:
+    (comparison_md, comparison) = format_comparison(runs)
+    results = results + '\n' + comparison_md
 print(results)
-res_file = open('results.md', 'w')
-res_file.write(results)
-res_file.close()
+with open('results.md', 'w') as f:
+    f.write(results)
+with open('results.json', 'w') as f:
+    json.dump({
+        'configs': {config: {'args': marsha_args, **summaries[config]} for (config, marsha_args) in configs.items()},
+        'comparison': comparison,
+        'runs': [{key: value for (key, value) in run.items() if key != 'stats'} for run in runs],
+    }, f, indent=2)
 
 if args.stats:
+    with open('agg_stats.md', 'a') as f:
+        for run in runs:
+            f.write(f'''# Run {run['run']} / {args.runs} ({run['config']})
+Exit code: {run['exitcode']}
+Time: {prettify_time_delta(run['time'])}
+Stats:
+
+```md
+{run['stats']}
+```
+
+''')
     with open('agg_stats.md', 'r') as f:
         stats = f.read()
     print(stats)
@@ -1,6 +1,10 @@
 import asyncio
+import multiprocessing
 
-from marsha.base import main
+# Entry point, guarded so the lint process pool can start its workers, even from the PyInstaller binary
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
 
-# Entry point
-asyncio.run(main())
+    from marsha.base import main
+
+    asyncio.run(main())
@@ -1,16 +1,29 @@
 import argparse
 import asyncio
+import glob
 import os
 import openai
-import tempfile
 import time
 import traceback
 
-from marsha.llm import generate_python_code, review_and_fix
+from marsha.cache import completion_cache
+from marsha.fanout import FanOut, candidate_progress
+from marsha.lint import lint_engine
+from marsha.llm import generate_python_code, gpt_func_to_python, review_and_fix
+from marsha.manifest import BuildManifest, merge_requirements
+from marsha.mappers.chatgpt import ChatGPTMapper
 from marsha.meta import MarshaMeta
 from marsha.parse import write_files_from_markdown
-from marsha.stats import stats
-from marsha.utils import read_file, copy_file, add_helper, copy_tree, prettify_time_delta
+from marsha.patch import patcher
+from marsha.partition import partitioner, DEFAULT_GROUP_TOKENS
+from marsha.shards import test_shards, DEFAULT_TEST_TIMEOUT
+from marsha.ratelimit import rate_limiters, llm_call_limit, subprocess_limit, DEFAULT_REQUESTS_PER_MINUTE, DEFAULT_TOKENS_PER_MINUTE, DEFAULT_MAX_LLM_CALLS, DEFAULT_MAX_SUBPROCESSES
+from marsha.stats import stats, get_stats
+from marsha.trace import tracer
+from marsha.utils import write_file, add_helper, get_filename_from_path, prettify_time_delta
+from marsha.venvs import venv_cache
+from marsha.workers import test_workers, DEFAULT_POOL_SIZE
+from marsha.workspace import Workspace
 
 # Set up OpenAI
 openai.organization = os.getenv('OPENAI_ORG')
@@ -21,137 +34,420 @@ parser = argparse.ArgumentParser(
     prog='marsha',
     description='Marsha AI Compiler',
 )
-parser.add_argument('source')
+parser.add_argument('source', nargs='?', default=None,
+                    help='The Marsha file to compile')
+parser.add_argument('-b', '--build', metavar='DIRECTORY', default=None,
+                    help='Compiles every Marsha file in a directory and its subdirectories instead of a single file, all at once and with no ordering between them, so a file can not use what another file defines')
 parser.add_argument('-d', '--debug', action='store_true',
                     help='Turn on debug logging')
 parser.add_argument('-q', '--quick-and-dirty', action='store_true',
                     help='Code generation with no correction stages run')
 parser.add_argument('-a', '--attempts', type=int, default=1)
 parser.add_argument('-n', '--n-parallel-executions', type=int, default=3)
+parser.add_argument('--adaptive', action='store_true',
+                    help='Picks the number of parallel executions from how often previous candidates for the same functions passed, using `-n` as the maximum, and adds more while they fail')
 parser.add_argument('--exclude-main-helper', action='store_true',
                     help='Skips addition of helper code for running as a script')
 parser.add_argument('--exclude-sanity-check', action='store_true',
                     help='Skips an initial sanity check that function defintions will reliably generate working code')
 parser.add_argument('-s', '--stats', action='store_true',
                     help='Save stats and write them to a file')
+parser.add_argument('--no-cache', action='store_true',
+                    help='Skips the on-disk cache of LLM responses')
+parser.add_argument('--refresh-cache', action='store_true',
+                    help='Ignores cached LLM responses and replaces them with new ones')
+parser.add_argument('--requests-per-minute', type=int, default=DEFAULT_REQUESTS_PER_MINUTE,
+                    help='Maximum number of LLM requests per minute, per model')
+parser.add_argument('--tokens-per-minute', type=int, default=DEFAULT_TOKENS_PER_MINUTE,
+                    help='Maximum number of LLM tokens per minute, per model')
+parser.add_argument('--max-llm-calls', type=int, default=DEFAULT_MAX_LLM_CALLS,
+                    help='Maximum number of LLM calls running at once')
+parser.add_argument('--max-subprocesses', type=int, default=DEFAULT_MAX_SUBPROCESSES,
+                    help='Maximum number of subprocesses (virtual environments, installs, test runs) running at once')
+parser.add_argument('--test-workers', type=int, default=DEFAULT_POOL_SIZE,
+                    help='Number of warm test runner processes per virtual environment, 0 runs every test in a new process')
+parser.add_argument('--test-timeout', type=float, default=DEFAULT_TEST_TIMEOUT,
+                    help='Seconds each generated test can run before it fails as timed out, 0 to only time out the whole test case')
+parser.add_argument('--speculative', action='store_true',
+                    help='Starts generating code at the same time as the sanity check, instead of waiting for it to pass')
+parser.add_argument('--stream', action='store_true',
+                    help='Streams the LLM responses, cancelling the ones that do not match the expected format early')
+parser.add_argument('--patch', action='store_true',
+                    help='Asks for the fixes as search and replace blocks instead of whole files, falling back to whole files when they do not apply')
+parser.add_argument('--trace', nargs='?', const='trace.json', default=None,
+                    help='Writes a Chrome trace of the compile to a file, `trace.json` by default, and prints where the time went')
+parser.add_argument('--split', type=int, nargs='?', const=DEFAULT_GROUP_TOKENS, default=None,
+                    help=f'Generates groups of related functions concurrently instead of the whole file at once, each with up to this many tokens of the spec, {DEFAULT_GROUP_TOKENS} by default')
+parser.add_argument('--rebuild', action='store_true',
+                    help='Regenerates every function instead of reusing the verified ones from the previous compile')
 
 args = parser.parse_args()
+if (args.source is None) == (args.build is None):
+    parser.error(
+        'either a Marsha file or --build DIRECTORY is required, but not both')
 
 
 async def main():
+    completion_cache.enabled = not args.no_cache
+    completion_cache.refresh = args.refresh_cache
+    rate_limiters.configure(args.requests_per_minute, args.tokens_per_minute)
+    llm_call_limit.configure(args.max_llm_calls)
+    subprocess_limit.configure(args.max_subprocesses)
+    test_workers.configure(args.test_workers)
+    test_shards.configure(args.test_timeout)
+    ChatGPTMapper.stream = args.stream
+    patcher.configure(args.patch)
+    partitioner.configure(args.split)
+    if args.trace is not None:
+        tracer.enable()
+    try:
+        if args.build is not None:
+            return await build(args.build)
+        return await compile_single_file(args.source)
+    finally:
+        await test_workers.close()
+        lint_engine.shutdown()
+        venv_cache.cleanup()
+        if args.trace is not None:
+            tracer.to_file(args.trace)
+            print(tracer.summary())
+
+
+async def compile_single_file(input_file: str):
     t1 = time.time()
-    input_file = args.source
+    compile_stats = stats.compile(get_filename_from_path(input_file))
+    try:
+        attempts = await compile_file(input_file)
+    except SystemExit:
+        # The sanity check failed, what it and any speculative generation cost is still worth reporting
+        t2 = time.time()
+        compile_stats.aggregate(t2 - t1, 1)
+        stats.aggregate(t2 - t1, 1)
+        if args.stats:
+            stats.to_file()
+        raise
+    except Exception as e:
+        t2 = time.time()
+        compile_stats.aggregate(t2 - t1, args.attempts)
+        stats.aggregate(t2 - t1, args.attempts)
+        if args.stats:
+            stats.to_file()
+        raise Exception(
+            f'{e}. Total time elapsed: {prettify_time_delta(t2 - t1)}. Total cost: {round(stats.total_cost, 2)}.')
+    t2 = time.time()
+    compile_stats.aggregate(t2 - t1, attempts)
+    stats.aggregate(t2 - t1, attempts)
+    if args.stats:
+        stats.to_file()
+    print(
+        f'{get_filename_from_path(input_file)} done! Total time elapsed: {prettify_time_delta(t2 - t1)}. Total cost: {round(stats.total_cost, 2)}.')
+
+
+async def compile_file(input_file: str, output_dir: str = '.') -> int:
+    """Compiles a single Marsha file, returning the number of attempts it took"""
     # Name without extension
-    meta = await MarshaMeta(input_file).populate()
+    with tracer.span('parse spec', 'parse'):
+        meta = await MarshaMeta(input_file).populate()
+    tracer.tag(file=meta.filename)
     print(f'Compiling functions for {meta.filename}...')
     quick_and_dirty = args.quick_and_dirty
     debug = args.debug
-    should_write_stats = args.stats
     attempts = args.attempts
     n_results = args.n_parallel_executions
     if args.debug:
         print(f'Number of attempts: {attempts}')
         print(f'Number of parallel executions: {n_results}')
+    # Incremental compile: only regenerate the functions that changed since the last verified compile
+    plan = None
+    if not quick_and_dirty and not args.rebuild:
+        manifest = BuildManifest.load(meta.filename, output_dir)
+        plan = manifest.plan(meta) if manifest is not None else None
+    if plan is not None and plan.up_to_date:
+        print(
+            f'No changes found for {meta.filename}, reusing the verified code...')
+        write_output_files(meta, plan.code, plan.test,
+                           plan.requirements, output_dir)
+        return 0
+    gen_meta = meta
+    if plan is not None:
+        print(
+            f'Regenerating {len(plan.dirty_functions)} functions and {len(plan.dirty_types)} types, reusing the rest...')
+        gen_meta = plan.meta
     while attempts:
+        if attempts < args.attempts:
+            # A previous attempt failed, so replaying the same cached responses would fail the same way
+            completion_cache.refresh = True
         attempts = attempts - 1
+        fan_out = FanOut(gen_meta, n_results, args.adaptive)
+        if args.adaptive:
+            print(
+                f'Generating {fan_out.initial} candidates from a {fan_out.passes} passed / {fan_out.failures} failed history...')
         # First stage: generate code for functions and classes
-        try:
-            mds = await generate_python_code(args, meta, n_results, debug)
-        except Exception:
-            continue
+        candidates = generate_python_code(
+            args, gen_meta, fan_out.initial, debug)
         # Early exit if quick and dirty
         if quick_and_dirty:
+            mds = []
+            try:
+                async for md in candidates:
+                    mds.append(md)
+                    if len(mds) == 2:
+                        break
+            except Exception:
+                continue
+            finally:
+                await candidates.aclose()
             print('Writing generated code to files...')
-            for md in mds[:2]:
-                write_files_from_markdown(md)
+            for md in mds:
+                write_files_from_markdown(md, subdir=output_dir)
             attempts = attempts + 1
             break
-        # Writing generated code to temporary files in preparation for next stages
-        file_groups = list()
-        tmp_directories = []
-        for idx, md in enumerate(mds):
-            print('Writing generated code to temporary files...')
-            tmpdir = tempfile.TemporaryDirectory(
-                suffix=f'_-_{meta.filename}_{idx}')
-            tmp_directories.append(tmpdir)
-            file_groups = file_groups + \
-                [write_files_from_markdown(
-                    md, subdir=tmpdir.name)]
-        if args.debug:
-            for filename in [filename for file_group in file_groups for filename in file_group]:
-                print(f'# {filename}\n{read_file(filename)}\n')
-        # Create tasks to run in parallel using asyncio
-        tasks = []
-        for file_group in file_groups:
-            tasks.append(asyncio.create_task(
-                review_and_fix(args, meta, file_group, debug), name=file_group[0]))
+        # Each candidate gets its own workspace and is reviewed as soon as it is generated, without waiting for the
+        # others
+        workspaces = {}
+        t_attempt = time.time()
+
+        def start_candidate(md: str) -> asyncio.Task:
+            idx = len(workspaces)
+            print('Writing generated code to the workspace...')
+            workspace = Workspace(suffix=f'_-_{meta.filename}_{idx}')
+            file_group = write_files_from_markdown(
+                md, subdir=workspace.directory, workspace=workspace)
+            workspaces[file_group[0]] = workspace
+            if plan is not None:
+                splice_verified_code(
+                    meta, plan, workspace, file_group)
+            if args.debug:
+                for filename in file_group:
+                    print(f'# {filename}\n{workspace.read(filename)}\n')
+            return asyncio.create_task(
+                review_candidate(
+                    gen_meta, file_group, workspace, f'{meta.filename}_{idx}', t_attempt, fan_out.track(), debug),
+                name=file_group[0])
+
+        def more_candidates():
+            n_more = fan_out.more_candidates()
+            if n_more == 0:
+                return None
+            print(
+                f'Every candidate is failing, generating {n_more} more...')
+            # A different cache variant each time, so the extra candidates are not the cached ones again
+            return gpt_func_to_python(gen_meta, n_more, debug=debug, cache_variant=len(fan_out.candidates))
+
         try:
-            done_task_name = await run_parallel_tasks(tasks)
+            done_task_name = await run_pipelined_tasks(candidates, start_candidate, more_candidates, fan_out.changed)
             print('Writing generated code to files...')
             filename = done_task_name
-            copy_file(filename, f'{meta.filename}.py')
-            if not args.exclude_main_helper:
-                add_helper(f'{meta.filename}.py')
-            test_filename = filename.replace('.py', '_test.py')
-            copy_file(test_filename, f'{meta.filename}_test.py')
-            directory = os.path.dirname(filename)
+            workspace = workspaces[filename]
+            code = workspace.read(filename)
+            test = workspace.read(filename.replace('.py', '_test.py'))
             requirements_filename = os.path.join(
-                directory, 'requirements.txt')
-            if os.path.exists(requirements_filename):
-                copy_file(requirements_filename, 'requirements.txt')
+                os.path.dirname(filename), 'requirements.txt')
+            requirements = workspace.read(requirements_filename) if workspace.exists(
+                requirements_filename) else ''
+            if plan is not None:
+                # Only the tests for the regenerated functions were run, add back the verified ones
+                test = plan.splice_test(test)
+            write_output_files(meta, code, test, requirements, output_dir)
+            BuildManifest.from_meta(
+                meta, code, test, requirements, output_dir).save()
         except Exception as e:
             print('Failed to generate working code.')
             print(e)
             if args.debug:
                 traceback.print_tb(e.__traceback__)
-                # Copy the temporary directories to a new directory for debugging
-                for tmpdir in tmp_directories:
-                    tmpdir_suffix = tmpdir.name.split('_-_')[-1]
-                    copy_tree(tmpdir.name, f'{tmpdir_suffix}_failed')
+                # Write the workspaces to new directories for debugging
+                for workspace in workspaces.values():
+                    workspace_suffix = workspace.directory.split('_-_')[-1]
+                    workspace.export(f'{workspace_suffix}_failed')
             print('Retrying...')
             continue
         finally:
-            cleanup_tmp_directories(tmp_directories)
+            fan_out.record()
+            cleanup_workspaces(workspaces.values())
         # Done! Add one back to `attempts` to avoid accidentally erroring out on success
         attempts = attempts + 1
         break
     if attempts == 0:
-        t2 = time.time()
-        stats.aggregate(prettify_time_delta(t2 - t1), args.attempts)
-        if should_write_stats:
-            stats.to_file()
         raise Exception(
-            f'Failed to generate working code for {meta.filename}. Total time elapsed: {prettify_time_delta(t2 - t1)}. Total cost: {round(stats.total_cost, 2)}.')
+            f'Failed to generate working code for {meta.filename}')
+    return args.attempts - attempts + 1
+
+
+async def build(directory: str):
+    """Compiles every Marsha file in a directory concurrently"""
+    t1 = time.time()
+    input_files = sorted(glob.glob(os.path.join(
+        directory, '**', '*.mrsh'), recursive=True))
+    if len(input_files) == 0:
+        raise Exception(f'No Marsha files found in {directory}')
+    print(f'Building {len(input_files)} Marsha files from {directory}...')
+    results = {}
+
+    async def build_file(input_file: str):
+        relative_path = os.path.splitext(
+            os.path.relpath(input_file, directory))[0]
+        output_dir = os.path.join('.', relative_path)
+        os.makedirs(output_dir, exist_ok=True)
+        t_file = time.time()
+        # Every file records into its own stats, the build stats add them all up
+        compile_stats = stats.compile(relative_path)
+        try:
+            attempts = await compile_file(input_file, output_dir)
+            results[input_file] = ('done', attempts, time.time() - t_file)
+        # The sanity check exits on failure, which must not take down the rest of the build
+        except (Exception, SystemExit) as e:
+            print(f'Failed to compile {input_file}: {e}')
+            results[input_file] = ('failed', args.attempts,
+                                   time.time() - t_file)
+        compile_stats.aggregate(
+            results[input_file][2], results[input_file][1])
+
+    await asyncio.gather(*[build_file(input_file) for input_file in input_files])
     t2 = time.time()
-    stats.aggregate(prettify_time_delta(t2 - t1), args.attempts - attempts + 1)
-    if should_write_stats:
-        stats.to_file()
+    stats.aggregate(t2 - t1, sum(
+        [attempts for (_, attempts, _) in results.values()]))
+    failed = [f for (f, (status, _, _)) in results.items()
+              if status == 'failed']
+    file_results = '\n'.join([f'| {f} | {status} | {attempts} | {prettify_time_delta(elapsed)} |' for (
+        f, (status, attempts, elapsed)) in sorted(results.items())])
+    write_file('build_stats.md', f'''# Build
+
+| File | Status | Attempts | Time |
+| --- | --- | --- | --- |
+{file_results}
+
+{stats}''')
+    stats.export('build_stats')
     print(
-        f'{meta.filename} done! Total time elapsed: {prettify_time_delta(t2 - t1)}. Total cost: {round(stats.total_cost, 2)}.')
+        f'Built {len(input_files) - len(failed)} / {len(input_files)} files. Total time elapsed: {prettify_time_delta(t2 - t1)}. Total cost: {round(stats.total_cost, 2)}.')
+    if len(failed) > 0:
+        raise Exception(f'Failed to compile {", ".join(failed)}')
+
+
+def splice_verified_code(meta: MarshaMeta, plan, workspace: Workspace, file_group: list[str]):
+    code_filename = f'{workspace.directory}/{meta.filename}.py'
+    if code_filename in file_group:
+        workspace.write(code_filename, plan.splice_code(
+            workspace.read(code_filename)))
+    requirements_filename = f'{workspace.directory}/requirements.txt'
+    generated_requirements = workspace.read(requirements_filename) if workspace.exists(
+        requirements_filename) else ''
+    requirements = merge_requirements(
+        plan.requirements, generated_requirements)
+    if len(requirements) > 0:
+        workspace.write(requirements_filename, requirements)
+        if requirements_filename not in file_group:
+            file_group.append(requirements_filename)
+
+
+def write_output_files(meta: MarshaMeta, code: str, test: str, requirements: str, output_dir: str = '.'):
+    code_filename = os.path.join(output_dir, f'{meta.filename}.py')
+    write_file(code_filename, code)
+    if not args.exclude_main_helper:
+        add_helper(code_filename)
+    write_file(os.path.join(output_dir, f'{meta.filename}_test.py'), test)
+    if len(requirements) > 0:
+        write_file(os.path.join(output_dir, 'requirements.txt'), requirements)
 
 
-async def run_parallel_tasks(tasks: list) -> str:
+async def review_candidate(meta: MarshaMeta, file_group: list[str], workspace: Workspace, name: str, t0: float,
+                           progress=None, debug: bool = False):
+    t1 = time.time()
+    result = 'failed'
+    candidate_stats = get_stats().candidate(name)
+    # The review reports its lint and test failures, so the fan-out knows when to add candidates
+    candidate_progress.set(progress)
+    tracer.tag(candidate=name)
+    try:
+        with tracer.span('candidate', 'candidate'):
+            await review_and_fix(args, meta, file_group, workspace, debug)
+        result = 'passed'
+    except asyncio.CancelledError as e:
+        result = 'cancelled'
+        raise e
+    finally:
+        t2 = time.time()
+        print(
+            f'Candidate {name} {result}, generated at {prettify_time_delta(t1 - t0)} and finished at {prettify_time_delta(t2 - t0)}')
+        candidate_stats.finish(t1 - t0, t2 - t0, result)
+        if progress is not None:
+            progress.update(result=result)
+
+
+async def run_pipelined_tasks(candidates, start_task, more_candidates=None, changed: asyncio.Event = None) -> str:
+    """Starts a task for every candidate as soon as it is generated, returning the name of the first one to succeed.
+
+    Once the candidates run out, `more_candidates` is asked for another generator of them, again every time
+    `changed` is set, until it returns `None` and every task is done"""
     print('Running tasks in parallel...')
-    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
-    done_task = done.pop()
-    if done_task.exception() is None:
-        print('Task completed successfully. Cancelling pending tasks...')
-        for task in pending if pending is not None else []:
-            task.cancel()
-        return done_task.get_name()
-    elif len(pending) > 0:
-        print('Task completed with error. Waiting for pending tasks to finish...')
-        return await run_parallel_tasks(pending)
-    else:
+
+    async def next_candidate():
+        # Errors are returned instead of raised, so a failed sanity check (`SystemExit`) does not escape the task
+        try:
+            return await anext(candidates)
+        except StopAsyncIteration:
+            return None
+        except (Exception, SystemExit) as e:
+            return e
+
+    tasks = set()
+    generation = asyncio.create_task(next_candidate())
+    update = None
+    exception = None
+    try:
+        while True:
+            if generation is None and more_candidates is not None:
+                more = more_candidates()
+                if more is not None:
+                    await candidates.aclose()
+                    candidates = more
+                    generation = asyncio.create_task(next_candidate())
+            if generation is None and len(tasks) == 0:
+                break
+            if generation is None and changed is not None and update is None:
+                changed.clear()
+                update = asyncio.create_task(changed.wait())
+            waiting = tasks | set(
+                [task for task in [generation, update] if task is not None])
+            done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            if update in done:
+                update = None
+            if generation in done:
+                candidate = generation.result()
+                generation = None
+                if isinstance(candidate, str):
+                    tasks.add(start_task(candidate))
+                    generation = asyncio.create_task(next_candidate())
+                elif candidate is not None:
+                    # The candidates already running can still succeed
+                    exception = candidate
+            for task in [task for task in done if task in tasks]:
+                tasks.remove(task)
+                if task.exception() is None:
+                    print('Task completed successfully. Cancelling pending tasks...')
+                    return task.get_name()
+                exception = task.exception()
+                if generation is not None or len(tasks) > 0:
+                    print(
+                        'Task completed with error. Waiting for pending tasks to finish...')
         print('All tasks failed. Raising exception...')
-        if done_task is not None and done_task.exception() is not None:
-            raise done_task.exception()
+        if exception is not None:
+            raise exception
         raise Exception('All tasks failed.')
+    finally:
+        if update is not None:
+            update.cancel()
+        for task in tasks:
+            task.cancel()
+        # Let the cancelled candidates wind down before their workspaces are removed
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if generation is not None:
+            generation.cancel()
+            await asyncio.gather(generation, return_exceptions=True)
+        await candidates.aclose()
 
 
-def cleanup_tmp_directories(tmp_directories: list):
-    for tmp_directory in tmp_directories:
-        try:
-            tmp_directory.cleanup()
-        except Exception:
-            pass
+def cleanup_workspaces(workspaces: list[Workspace]):
+    for workspace in workspaces:
+        workspace.cleanup()
@@ -0,0 +1,125 @@
+import contextvars
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from openai.util import convert_to_openai_object
+
+from marsha.utils import read_file
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'marsha')
+DEFAULT_TTL = 7 * 24 * 60 * 60  # One week, in seconds
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024  # 256MB
+
+
+def get_cache_dir(*subdirs: str) -> str:
+    return os.path.join(os.getenv('MARSHA_CACHE_DIR', DEFAULT_CACHE_DIR), *subdirs)
+
+
+def hash_content(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class CompletionCache:
+    """Content-addressed on-disk cache of chat completions with LRU eviction"""
+
+    def __init__(self, directory: str = None, ttl: float = DEFAULT_TTL, max_size: int = DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        # Disabled skips the cache entirely, refresh skips reads but still stores the new responses. Refresh is
+        # scoped to the current task so one compile retrying does not affect the others running alongside it
+        self.enabled = True
+        self.refresh_var = contextvars.ContextVar(
+            'refresh_cache', default=False)
+
+    @property
+    def refresh(self) -> bool:
+        return self.refresh_var.get()
+
+    @refresh.setter
+    def refresh(self, refresh: bool):
+        self.refresh_var.set(refresh)
+
+    def get_directory(self) -> str:
+        if self.directory is None:
+            self.directory = get_cache_dir('completions')
+        return self.directory
+
+    def key(self, system: str, user_request: str, model: str, n_results: int, max_tokens: int, variant: int = 0) -> str:
+        # Variants are extra responses to the same request, the first one keeps the key it always had
+        if variant > 0:
+            return hash_content(system, user_request, model, n_results, max_tokens, variant)
+        return hash_content(system, user_request, model, n_results, max_tokens)
+
+    def get(self, key: str):
+        if not self.enabled or self.refresh:
+            return None
+        path = os.path.join(self.get_directory(), f'{key}.json')
+        try:
+            entry = json.loads(read_file(path))
+        except Exception:
+            return None
+        if time.time() - entry['created'] > self.ttl:
+            self.invalidate(key)
+            return None
+        # The modification time doubles as the last access time for the LRU eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return convert_to_openai_object(entry['response'])
+
+    def set(self, key: str, response):
+        if not self.enabled:
+            return
+        directory = self.get_directory()
+        try:
+            os.makedirs(directory, exist_ok=True)
+            # Write to a temporary file and rename so concurrent readers never see partial entries
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'created': time.time(), 'response': response}, f)
+            os.replace(tmp_path, os.path.join(directory, f'{key}.json'))
+        except Exception as e:
+            print(f'Failed to write to the completion cache: {e}')
+            return
+        self.evict()
+
+    def invalidate(self, key: str):
+        if key is None:
+            return
+        try:
+            os.remove(os.path.join(self.get_directory(), f'{key}.json'))
+        except OSError:
+            pass
+
+    def evict(self):
+        entries = []
+        total_size = 0
+        with os.scandir(self.get_directory()) as it:
+            for entry in it:
+                if not entry.name.endswith('.json'):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total_size = total_size + st.st_size
+        if total_size <= self.max_size:
+            return
+        # Least recently used entries go first
+        for (_, size, path) in sorted(entries):
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size = total_size - size
+            if total_size <= self.max_size:
+                break
+
+
+completion_cache = CompletionCache()
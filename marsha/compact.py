@@ -0,0 +1,182 @@
+import ast
+import re
+import textwrap
+
+from marsha.tokens import count_tokens
+
+# The third stage prompt, test results included, is kept under this many tokens, leaving room in the `gpt-4`
+# context for the fixed files
+THIRD_STAGE_TOKEN_BUDGET = 5000
+# The test results are truncated to fit the budget, but never below this
+MIN_TEST_RESULTS_TOKENS = 400
+# What the body of a passing test is replaced with, and what the LLM is asked to leave alone
+ELIDED_BODY = '...  # passed'
+
+SEPARATOR = '=' * 70
+DIVIDER = '-' * 70
+FAILURE_HEADER_PATTERN = re.compile(r'^(FAIL|ERROR): (\w+) \(([\w.]+)\)')
+TESTS_RAN_PATTERN = re.compile(r'^Ran (\d+) tests?', re.M)
+
+
+class TestFailure:
+    def __init__(self, header: str, traceback: list[str]):
+        self.header = header
+        self.traceback = traceback
+        match = FAILURE_HEADER_PATTERN.match(header)
+        self.test = None
+        if match is not None:
+            # `test_name (module.Class.test_name)` since Python 3.11, `test_name (module.Class)` before
+            (method, test_id) = (match.group(2), match.group(3).split('.'))
+            self.test = (test_id[-2] if test_id[-1] ==
+                         method and len(test_id) > 1 else test_id[-1], method)
+
+    @property
+    def name(self) -> str:
+        return self.test[1] if self.test is not None else self.header
+
+    @property
+    def signature(self) -> tuple[str, ...]:
+        # Failures are the same when they raise the same exception from the same line of the code under test,
+        # whichever test called it
+        frames = [line.strip()
+                  for line in self.traceback if line.strip().startswith('File ')]
+        error = [line for line in self.traceback if line.strip() != ''][-1:]
+        return tuple([self.header.split(':')[0]] + frames[-1:] + error)
+
+
+def split_test_results(test_results: str) -> tuple[list[TestFailure], str]:
+    """Splits `unittest` output into its failures and the summary at the end, dropping the progress line and
+    anything the tests printed before them"""
+    lines = test_results.split('\n')
+    failures = []
+    summary = []
+    current = None
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if line == SEPARATOR and i + 2 < len(lines) and lines[i + 2] == DIVIDER:
+            current = TestFailure(lines[i + 1], [])
+            failures.append(current)
+            i = i + 3
+            continue
+        if line == DIVIDER and i + 1 < len(lines) and TESTS_RAN_PATTERN.match(lines[i + 1]):
+            summary = lines[i + 1:]
+            break
+        if current is not None:
+            current.traceback.append(line)
+        i = i + 1
+    return (failures, '\n'.join(summary).strip())
+
+
+def compact_test_results(test_results: str) -> str:
+    """Keeps only the output of the failing tests, and only the first of the failures with the same traceback"""
+    (failures, summary) = split_test_results(test_results)
+    if len(failures) == 0:
+        # The test file did not load, or did not use `unittest`, so there is nothing to tell apart
+        return test_results.strip()
+    sections = []
+    first = {}
+    for failure in failures:
+        if failure.signature in first:
+            sections.append(
+                f'{failure.header}\nSame error as `{first[failure.signature].name}`')
+            continue
+        first[failure.signature] = failure
+        traceback = '\n'.join(failure.traceback).strip()
+        sections.append(f'{failure.header}\n{DIVIDER}\n{traceback}')
+    return '\n\n'.join(sections + ([summary] if summary != '' else []))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    # The end of a traceback is the most useful part, so a third of the lines are kept from the start and the
+    # rest from the end
+    if count_tokens(text) <= max_tokens:
+        return text
+    lines = text.split('\n')
+    (head, tail) = ([], [])
+    tokens = 0
+    while len(head) + len(tail) < len(lines):
+        take_head = len(head) * 2 < len(tail)
+        line = lines[len(head)] if take_head else lines[len(
+            lines) - 1 - len(tail)]
+        tokens = tokens + count_tokens(line) + 1
+        if tokens > max_tokens:
+            break
+        if take_head:
+            head.append(line)
+        else:
+            tail.insert(0, line)
+    return '\n'.join(head + [f'... {len(lines) - len(head) - len(tail)} lines truncated ...'] + tail)
+
+
+def get_test_methods(tree: ast.Module):
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef):
+            for item in node.body:
+                if isinstance(item, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                    yield (node.name, item)
+
+
+def elide_tests(test: str, names: set[tuple[str, str]]) -> tuple[str, set[tuple[str, str]]]:
+    """Replaces the body of the given tests with `ELIDED_BODY`, returning the new source and the tests elided"""
+    if len(names) == 0:
+        return (test, set())
+    lines = test.split('\n')
+    elided = set()
+    methods = [(class_name, method) for (class_name, method) in get_test_methods(ast.parse(test))
+               if (class_name, method.name) in names and method.body[0].lineno > method.lineno]
+    for (class_name, method) in sorted(methods, key=lambda m: -m[1].lineno):
+        (start, end) = (method.body[0].lineno, method.body[-1].end_lineno)
+        indent = re.match(r'\s*', lines[start - 1]).group(0)
+        lines[start - 1:end] = [f'{indent}{ELIDED_BODY}']
+        elided.add((class_name, method.name))
+    return ('\n'.join(lines), elided)
+
+
+def is_elided(method: ast.FunctionDef) -> bool:
+    return len(method.body) == 1 and isinstance(method.body[0], ast.Expr) and \
+        isinstance(
+            method.body[0].value, ast.Constant) and method.body[0].value.value is Ellipsis
+
+
+def restore_elided_tests(test: str, original: str, elided: set[tuple[str, str]]) -> str:
+    """Puts the original body back into the elided tests the LLM left alone"""
+    if len(elided) == 0:
+        return test
+    try:
+        tree = ast.parse(test)
+    except SyntaxError:
+        return test
+    original_lines = original.split('\n')
+    bodies = {(class_name, method.name): original_lines[method.body[0].lineno - 1:method.body[-1].end_lineno]
+              for (class_name, method) in get_test_methods(ast.parse(original))}
+    lines = test.split('\n')
+    methods = [(class_name, method) for (class_name, method) in get_test_methods(tree)
+               if (class_name, method.name) in elided and (class_name, method.name) in bodies and is_elided(method)
+               and method.body[0].lineno > method.lineno]
+    for (class_name, method) in sorted(methods, key=lambda m: -m[1].lineno):
+        body = bodies[(class_name, method.name)]
+        line = method.body[0].lineno
+        indent = re.match(r'\s*', lines[line - 1]).group(0)
+        original_indent = re.match(r'\s*', body[0]).group(0)
+        if indent != original_indent:
+            body = textwrap.indent(textwrap.dedent(
+                '\n'.join(body)), indent).split('\n')
+        lines[line - 1:line] = body
+    return '\n'.join(lines)
+
+
+def compact_fix_prompt(prompt_tokens: int, test: str, test_results: str,
+                       passing: set[tuple[str, str]]) -> tuple[str, str, set[tuple[str, str]]]:
+    """Shrinks the tests and test results of a third stage prompt whose other parts take `prompt_tokens`.
+
+    The `passing` tests, as `(class, method)`, are elided, only the first of the identical failures is kept, and the test results are truncated
+    to what is left of `THIRD_STAGE_TOKEN_BUDGET`. Returns the tests, the test results and the elided tests."""
+    try:
+        (test, elided) = elide_tests(test, passing)
+    except SyntaxError:
+        elided = set()
+    test_results = compact_test_results(test_results)
+    budget = max(THIRD_STAGE_TOKEN_BUDGET - prompt_tokens -
+                 count_tokens(test), MIN_TEST_RESULTS_TOKENS)
+    return (test, truncate_to_tokens(test_results, budget), elided)
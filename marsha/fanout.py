@@ -0,0 +1,202 @@
+import asyncio
+import contextvars
+import json
+import os
+import re
+import tempfile
+
+from marsha.cache import get_cache_dir, hash_content
+from marsha.manifest import fingerprint, get_sections
+from marsha.meta import MarshaMeta
+from marsha.utils import read_file
+
+# Beta prior on the pass rate of a candidate, so one lucky or unlucky compile does not decide the fan-out alone
+PRIOR_PASSES = 1
+PRIOR_FAILURES = 1
+# A candidate whose tests stopped at a failure with at most this share of them left unverified is close enough to
+# passing that the third stage will most likely fix it
+CLOSE_FAILURE_RATE = 0.25
+
+TESTS_RAN_PATTERN = re.compile(r'^Ran (\d+) tests?', re.M)
+TESTS_FAILED_PATTERN = re.compile(r'^FAILED \(([^)]*)\)', re.M)
+TEST_METHOD_PATTERN = re.compile(r'^\s*(?:async\s+)?def\s+test', re.M)
+
+candidate_progress = contextvars.ContextVar('candidate_progress', default=None)
+
+
+def spec_keys(meta: MarshaMeta) -> tuple[str, list[str]]:
+    functions, types = get_sections(meta)
+    function_keys = [fingerprint(section)
+                     for (_, section) in sorted(functions.items())]
+    type_keys = [fingerprint(section)
+                 for (_, section) in sorted(types.items())]
+    return (hash_content(function_keys, type_keys), function_keys)
+
+
+def expected_cost(pass_rate: float, n: int) -> float:
+    # Every round generates `n` candidates and takes about as long as any other, and a new round is only needed
+    # when all of them failed. The cost and the latency both grow with the number of rounds, hence the square
+    success_rate = 1 - (1 - pass_rate) ** n
+    if success_rate == 0:
+        return float('inf')
+    return n / success_rate ** 2
+
+
+def choose_fan_out(pass_rate: float, max_candidates: int) -> int:
+    """The number of candidates, up to `max_candidates`, minimizing the expected cost times latency to the first
+    verified one"""
+    if max_candidates < 1:
+        return 0
+    return min(range(1, max_candidates + 1), key=lambda n: expected_cost(pass_rate, n))
+
+
+class FanOutHistory:
+    """Pass rates of the candidates generated for each spec and each function, kept across compiles"""
+
+    def __init__(self, directory: str = None):
+        self.directory = directory
+
+    def get_path(self) -> str:
+        if self.directory is None:
+            self.directory = get_cache_dir('history')
+        return os.path.join(self.directory, 'fan_out.json')
+
+    def load(self) -> dict:
+        try:
+            history = json.loads(read_file(self.get_path()))
+        except Exception:
+            history = {}
+        history.setdefault('specs', {})
+        history.setdefault('functions', {})
+        return history
+
+    def counts(self, spec_key: str, function_keys: list[str]) -> tuple[int, int]:
+        """The passed and failed candidates recorded for a spec"""
+        history = self.load()
+        if spec_key in history['specs']:
+            return tuple(history['specs'][spec_key])
+        # A new combination of functions is as hard as the hardest one of them
+        return min([tuple(history['functions'].get(key, [0, 0])) for key in function_keys],
+                   key=lambda counts: posterior(*counts), default=(0, 0))
+
+    def record(self, spec_key: str, function_keys: list[str], passed: int, failed: int):
+        if passed + failed == 0:
+            return
+        history = self.load()
+        # Without knowing which function broke a candidate, every one of them gets the candidate's result
+        for (records, key) in [(history['specs'], spec_key)] + [(history['functions'], key) for key in function_keys]:
+            [passes, failures] = records.get(key, [0, 0])
+            records[key] = [passes + passed, failures + failed]
+        path = self.get_path()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(history, f)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f'Failed to write the fan-out history: {e}')
+
+
+def posterior(passes: int, failures: int) -> float:
+    return (passes + PRIOR_PASSES) / (passes + failures + PRIOR_PASSES + PRIOR_FAILURES)
+
+
+class CandidateProgress:
+    """How far the review of a candidate got, reported from within its task"""
+
+    def __init__(self, on_update=None):
+        self.on_update = on_update
+        self.lint_errors = 0
+        self.tests = None
+        self.passed = 0
+        self.failures = 0
+        self.result = None
+
+    def update(self, **kwargs):
+        for (key, value) in kwargs.items():
+            setattr(self, key, value)
+        if self.on_update is not None:
+            self.on_update()
+
+    @property
+    def failing(self) -> bool:
+        return self.result == 'failed' or (self.result is None and (self.lint_errors > 0 or self.failures > 0))
+
+    @property
+    def close_to_passing(self) -> bool:
+        if self.result is not None or not self.tests or self.failures == 0:
+            return False
+        return self.passed / self.tests >= 1 - CLOSE_FAILURE_RATE
+
+
+def report_lint(errors: int):
+    progress = candidate_progress.get()
+    if progress is not None:
+        progress.update(lint_errors=errors)
+
+
+def report_tests(test_results: str, test: str):
+    progress = candidate_progress.get()
+    if progress is None:
+        return
+    ran = TESTS_RAN_PATTERN.search(test_results)
+    if ran is None:
+        # The test file did not even load
+        progress.update(tests=None, passed=0,
+                        failures=1 if 'Traceback' in test_results else 0)
+        return
+    failed = TESTS_FAILED_PATTERN.search(test_results)
+    failures = sum([int(count) for count in re.findall(
+        r'(?:failures|errors)=(\d+)', failed.group(1))]) if failed is not None else 0
+    # The tests of a test case that did not finish never ran and count as unverified
+    tests = max(len(TEST_METHOD_PATTERN.findall(test)), int(ran.group(1)))
+    progress.update(tests=tests, passed=int(
+        ran.group(1)) - failures, failures=failures)
+
+
+class FanOut:
+    """Tracks the candidates of one compile attempt, and in adaptive mode picks how many to generate from the
+    pass rate history of the spec, adding more while the running ones fail and none of them is close to passing"""
+
+    def __init__(self, meta: MarshaMeta, max_candidates: int, adaptive: bool = False, history: FanOutHistory = None):
+        self.max_candidates = max_candidates
+        self.adaptive = adaptive
+        self.history = history if history is not None else fan_out_history
+        (self.spec_key, self.function_keys) = spec_keys(meta)
+        (self.passes, self.failures) = self.history.counts(
+            self.spec_key, self.function_keys) if adaptive else (0, 0)
+        self.initial = choose_fan_out(posterior(
+            self.passes, self.failures), max_candidates) if adaptive else max_candidates
+        self.requested = self.initial
+        self.candidates = []
+        self.changed = asyncio.Event()
+
+    def track(self) -> CandidateProgress:
+        progress = CandidateProgress(self.changed.set)
+        self.candidates.append(progress)
+        return progress
+
+    def more_candidates(self) -> int:
+        """The number of candidates to add now, called once the ones requested so far were all generated"""
+        if not self.adaptive:
+            return 0
+        if any([progress.close_to_passing or not progress.failing for progress in self.candidates]):
+            return 0
+        # Every failure so far makes the spec look harder than its history says
+        failed = len(
+            [progress for progress in self.candidates if progress.failing])
+        more = choose_fan_out(posterior(
+            self.passes, self.failures + failed), self.max_candidates - self.requested)
+        self.requested = self.requested + more
+        return more
+
+    def record(self):
+        passed = len(
+            [progress for progress in self.candidates if progress.result == 'passed'])
+        failed = len(
+            [progress for progress in self.candidates if progress.result == 'failed'])
+        self.history.record(self.spec_key, self.function_keys, passed, failed)
+
+
+fan_out_history = FanOutHistory()
@@ -21,91 +21,194 @@ if __name__ == '__main__':
                         help='Saves the result to a file instead of stdout')
     parser.add_argument('-s', '--serve', action='store', required=False, type=int,
                         help='Spins up a simple REST web server on the specified port. When used all other options are ignored')
+    parser.add_argument('-w', '--workers', action='store', required=False, type=int, default=8,
+                        help='Number of requests the server handles at once')
+    parser.add_argument('--queue-size', action='store', required=False, type=int, default=64,
+                        help='Number of connections waiting for a worker before the server answers with a 503')
+    parser.add_argument('--request-timeout', action='store', required=False, type=float, default=30,
+                        help='Seconds a function call can take before the server answers with a 504')
+    parser.add_argument('--keep-alive-timeout', action='store', required=False, type=float, default=5,
+                        help='Seconds an idle connection is kept open, holding on to its worker')
+    parser.add_argument('--max-timed-out-calls', action='store', required=False, type=int, default=16,
+                        help='Number of timed out function calls still running before the server answers with a 503')
     parser.add_argument(
         'params', nargs='*', help='Arguments to be provided to the function being run. Optimistically converted to simple python types by default, and left as strings if not possible')
     args = parser.parse_args()
     func = lookup[args.func]
     if args.serve is not None:
+        import queue
+        import threading
         from http.server import BaseHTTPRequestHandler, HTTPServer
 
+        class CallTimeout(Exception):
+            pass
+
+        class CallsOverloaded(Exception):
+            pass
+
+        class Calls:
+            """Runs every function call in a thread of its own, so one that outlives its timeout does not hold up
+            the calls after it. Python can't stop a running function, so once too many of them are left running new
+            calls are refused right away instead of piling up behind them"""
+
+            def __init__(self, limit):
+                self.limit = limit
+                self.timed_out = 0
+                self.lock = threading.Lock()
+
+            def run(self, func, *params):
+                with self.lock:
+                    if self.timed_out >= self.limit:
+                        raise CallsOverloaded()
+                state = {'done': False, 'timed_out': False}
+
+                def target():
+                    try:
+                        state['out'] = func(*params)
+                    except Exception as e:
+                        state['error'] = e
+                    finally:
+                        with self.lock:
+                            state['done'] = True
+                            if state['timed_out']:
+                                self.timed_out = self.timed_out - 1
+
+                thread = threading.Thread(target=target, daemon=True)
+                thread.start()
+                thread.join(args.request_timeout)
+                with self.lock:
+                    if not state['done']:
+                        state['timed_out'] = True
+                        self.timed_out = self.timed_out + 1
+                        raise CallTimeout()
+                if 'error' in state:
+                    raise state['error']
+                return state['out']
+
+        calls = Calls(args.max_timed_out_calls)
+
         class MarshaServer(BaseHTTPRequestHandler):
+            # Keeps the connection open between requests, every response has a `Content-Length`
+            protocol_version = 'HTTP/1.1'
+            # Idle keep-alive connections are closed after this long, freeing their worker
+            timeout = args.keep_alive_timeout
+
+            def respond(self, status, content_type, body):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                if not self.server.pending.empty():
+                    # Other clients are waiting for a worker, this one reconnects instead of keeping it
+                    self.send_header('Connection', 'close')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def respond_error(self, status, message):
+                self.respond(status, 'application/json', bytes(
+                    json.dumps({'error': message}), 'utf-8'))
+
             def do_GET(self):
                 func_name = self.path.split('/')[1]
                 if func_name not in func_names:
-                    self.send_response(404)
-                    self.send_header('Content-Type', 'application/json')
-                    self.end_headers()
-                    self.wfile.write(
-                        bytes('{"error": "' + self.path + ' does not exist"}', 'utf-8'))
+                    self.respond_error(404, self.path + ' does not exist')
                     return
                 func = lookup[func_name]
                 if func.__code__.co_argcount != 0:
-                    self.send_response(400)
-                    self.send_header('Content-Type', 'application/json')
-                    self.end_headers()
-                    self.wfile.write(
-                        bytes('{"error": "' + self.path + ' is not a GET path"}', 'utf-8'))
+                    self.respond_error(400, self.path + ' is not a GET path')
                     return
-                out = func()
-                self.send_response(200)
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
-                self.wfile.write(bytes(json.dumps(out), 'utf-8'))
+                try:
+                    out = calls.run(func)
+                except CallTimeout:
+                    self.respond_error(504, self.path + ' timed out')
+                    return
+                except CallsOverloaded:
+                    self.respond_error(
+                        503, 'Too many calls timed out and are still running, try again later')
+                    return
+                self.respond(200, 'application/json',
+                             bytes(json.dumps(out), 'utf-8'))
 
             def do_POST(self):
                 func_name = self.path.split('/')[1]
+                content_len = int(self.headers.get('Content-Length', 0))
+                # The body is read even for a request that fails, or the next request on the connection would start
+                # in the middle of it
+                post_body = self.rfile.read(content_len)
                 if func_name not in func_names:
-                    self.send_response(404)
-                    self.send_header('Content-Type', 'application/json')
-                    self.end_headers()
-                    self.wfile.write(
-                        bytes('{"error": "' + self.path + ' does not exist"}', 'utf-8'))
+                    self.respond_error(404, self.path + ' does not exist')
                     return
                 func = lookup[func_name]
-                content_len = int(self.headers.get('Content-Length', 0))
-                post_body = self.rfile.read(content_len)
                 post_payload = None
                 is_json = self.headers.get_content_type() == 'application/json'
                 if is_json:
                     try:
                         post_payload = json.loads(post_body)
                     except Exception:
-                        self.send_response(400)
-                        self.send_header('Content-Type', 'application/json')
-                        self.end_headers()
-                        self.wfile.write(
-                            bytes('{"error": "Invalid JSON provided"}', 'utf-8'))
+                        self.respond_error(400, 'Invalid JSON provided')
                         return
                 else:
                     post_payload = post_body.decode('utf-8')
                 out = None
                 try:
                     if type(post_payload) is list:
-                        out = func(*post_payload)
+                        out = calls.run(func, *post_payload)
                     else:
-                        out = func(post_payload)
-                    self.send_response(200)
+                        out = calls.run(func, post_payload)
+                except CallTimeout:
+                    self.respond_error(504, self.path + ' timed out')
+                    return
+                except CallsOverloaded:
+                    self.respond_error(
+                        503, 'Too many calls timed out and are still running, try again later')
+                    return
                 except Exception as e:
-                    self.send_response(400)
                     if is_json:
-                        self.send_header('Content-Type', 'application/json')
-                        self.end_headers()
-                        self.wfile.write(
-                            bytes('{"error": "' + str(e) + '"}', 'utf-8'))
+                        self.respond_error(400, str(e))
                     else:
-                        self.send_header('Content-Type', 'text/plain')
-                        self.end_headers()
-                        self.wfile.write(bytes(str(e), 'utf-8'))
+                        self.respond(400, 'text/plain', bytes(str(e), 'utf-8'))
                     return
                 if is_json:
-                    self.send_header('Content-Type', 'application/json')
-                    self.end_headers()
-                    self.wfile.write(bytes(json.dumps(out), 'utf-8'))
+                    self.respond(200, 'application/json',
+                                 bytes(json.dumps(out), 'utf-8'))
                 else:
-                    self.send_header('Content-Type', 'text/plain')
-                    self.end_headers()
-                    self.wfile.write(bytes(out, 'utf-8'))
-        server = HTTPServer(('', args.serve), MarshaServer)
+                    self.respond(200, 'text/plain', bytes(out, 'utf-8'))
+
+        class PooledServer(HTTPServer):
+            """Hands each connection to a fixed pool of worker threads through a bounded queue, answering with a 503
+            right away when the queue is full instead of letting clients pile up"""
+            request_queue_size = args.queue_size
+
+            def __init__(self, *server_args):
+                super().__init__(*server_args)
+                self.pending = queue.Queue(maxsize=args.queue_size)
+                for _ in range(args.workers):
+                    threading.Thread(target=self.work, daemon=True).start()
+
+            def process_request(self, request, client_address):
+                try:
+                    self.pending.put_nowait((request, client_address))
+                except queue.Full:
+                    body = bytes(json.dumps(
+                        {'error': 'Server is busy, try again later'}), 'utf-8')
+                    try:
+                        request.sendall(bytes(f'HTTP/1.1 503 Service Unavailable\r\nContent-Type: application/json\r\n'
+                                              f'Content-Length: {len(body)}\r\nRetry-After: 1\r\nConnection: close\r\n\r\n',
+                                              'utf-8') + body)
+                    except OSError:
+                        pass
+                    self.shutdown_request(request)
+
+            def work(self):
+                while True:
+                    (request, client_address) = self.pending.get()
+                    try:
+                        self.finish_request(request, client_address)
+                    except Exception:
+                        self.handle_error(request, client_address)
+                    finally:
+                        self.shutdown_request(request)
+
+        server = PooledServer(('', args.serve), MarshaServer)
         print(f'Listening on port {args.serve}')
         try:
             server.serve_forever()
@@ -0,0 +1,275 @@
+import json
+import os
+import re
+import tempfile
+
+from dataclasses import dataclass, field, asdict
+
+from marsha.cache import get_cache_dir, hash_content
+from marsha.markdown import parse_markdown, to_markdown
+from marsha.utils import read_file
+
+# Bumped whenever the IR changes shape, so older `.mrshc` files are ignored
+IR_VERSION = 1
+
+SECTION_PATTERN = re.compile(r'^\s*#+\s*(func|type)\b')
+FUNC_PATTERN = re.compile(r'\s*func [a-zA-Z_][a-zA-Z0-9_]*\(.*\):')
+VOID_FUNC_PATTERN = re.compile(r'\s*func [a-zA-Z_][a-zA-Z0-9_]*\(.*\)')
+TYPE_PATTERN = re.compile(
+    r'\s*type [a-zA-Z_][a-zA-Z0-9_]*\s*[a-zA-Z0-9_\.\/]*')
+
+
+@dataclass(slots=True)
+class Argument:
+    type: str
+
+
+@dataclass(slots=True)
+class Example:
+    text: str
+
+
+@dataclass(slots=True)
+class Function:
+    name: str
+    args: list[Argument]
+    # `None` for void functions
+    returns: str
+    description: str
+    examples: list[Example]
+    # Whether the examples were a numbered list
+    ordered_examples: bool
+    source: str
+
+    @property
+    def void(self) -> bool:
+        return self.returns is None
+
+    def format_examples(self) -> str:
+        if self.ordered_examples:
+            return '\n'.join([f'{i}. {example.text}' for (i, example) in enumerate(self.examples)])
+        return '\n'.join([f'* {example.text}' for example in self.examples])
+
+
+@dataclass(slots=True)
+class TypeDef:
+    name: str
+    # The file the type is read from, if any
+    filename: str
+    source: str
+
+
+@dataclass(slots=True)
+class Spec:
+    """The functions and types of a Marsha file, parsed once"""
+    functions: list[Function] = field(default_factory=list)
+    types: list[TypeDef] = field(default_factory=list)
+    # `(path, hash)` of every file a type was read from, a `.mrshc` file is stale when one of them changes
+    dependencies: list[list[str]] = field(default_factory=list)
+
+    def function(self, source: str) -> Function:
+        # The functions can be filtered by source after parsing, like the build manifest does, so they are looked
+        # up by it. A section that is not from this spec is parsed on its own
+        for function in self.functions:
+            if function.source == source:
+                return function
+        return parse_function(source, VOID_FUNC_PATTERN.match(source[1:]) is not None and
+                              FUNC_PATTERN.match(source[1:]) is None)
+
+    def type(self, source: str) -> TypeDef:
+        for type_def in self.types:
+            if type_def.source == source:
+                return type_def
+        return parse_type(source)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @staticmethod
+    def from_dict(data: dict):
+        return Spec(
+            functions=[Function(**{
+                **function,
+                'args': [Argument(**arg) for arg in function['args']],
+                'examples': [Example(**example) for example in function['examples']],
+            }) for function in data['functions']],
+            types=[TypeDef(**type_def) for type_def in data['types']],
+            dependencies=data['dependencies'],
+        )
+
+
+def validate_marsha_fn(fn: str, void: bool = False):
+    ast = parse_markdown(fn)
+    fn_heading = ast['children'][0]['children'][0]['content']
+    # Check function signature
+    if not void:
+        return_type = fn_heading.split('):')[1].strip()
+        if not return_type or return_type is None or return_type == '':
+            raise Exception(
+                f'Invalid Marsha function: Missing return type for `{fn_heading}`.')
+    # Check description
+    if ast['children'][1]['type'] != 'Paragraph':
+        raise Exception(
+            f'Invalid Marsha function: Invalid description for `{fn_heading}`.')
+    # Check usage examples if not void first because we need to check the length later
+    if not void:
+        if ast['children'][-1]['type'] != 'List':
+            raise Exception(
+                f'Invalid Marsha function: Invalid usage examples for `{fn_heading}`.')
+        if len(ast['children'][-1]['children']) < 2:  # We need at least a couple of examples
+            raise Exception(
+                f'Invalid Marsha function: Not enough usage examples for `{fn_heading}`.')
+    # Extract content from all children and nested children except header and examples if any
+    fn_desc = ''
+    range_stop = len(ast['children']) - 1 if not void else len(ast['children'])
+    for i in range(1, range_stop):
+        for child in ast['children'][i]['children']:
+            fn_desc += to_markdown(child)
+    if len(fn_desc) <= 80:  # around a couple of sentences at least
+        raise Exception(
+            f'Invalid Marsha function: Description for `{fn_heading}` is too short.')
+
+
+def validate_marsha_type(type: str):
+    ast = parse_markdown(type)
+
+    if len(ast['children']) == 1:
+        type_heading = ast['children'][0]['children'][0]['content']
+        if len(type_heading.split(' ')) != 3:
+            raise Exception(
+                f'Invalid Marsha type: Invalid type definition for `{type_heading}`.')
+    else:
+        type_heading = ast['children'][0]['children'][0]['content']
+        if ast['children'][1]['type'] != 'Paragraph':
+            raise Exception(
+                f'Invalid Marsha type: Invalid type definition for `{type_heading}`.')
+        type_def_samples = filter(lambda x: x['type'] ==
+                                  'RawText', ast['children'][1]['children'])
+        if len(list(type_def_samples)) <= 2:  # We need at least the headers and a couple of examples
+            raise Exception(
+                f'Invalid Marsha type: Not enough examples for `{type_heading}`.')
+
+
+def lex_sections(content: str) -> list[tuple[str, str]]:
+    """Splits a Marsha file into `(kind, text)` sections in a single pass over its lines. Every line starting with
+    `#` begins a new section, `func`, `type` or one that is ignored"""
+    sections = []
+    kind = None
+    text = []
+    lines = content.split('\n')
+    for (i, line) in enumerate(lines):
+        if i < len(lines) - 1:
+            line = line + '\n'
+        if not line.lstrip().startswith('#'):
+            text.append(line)
+            continue
+        if kind is not None:
+            # Same format as the sections were always given to the LLM in
+            sections.append((kind, '# ' + ''.join(text).lstrip()))
+        match = SECTION_PATTERN.match(line)
+        kind = match.group(1) if match is not None else None
+        text = [line.lstrip().lstrip('#')]
+    if kind is not None:
+        sections.append((kind, '# ' + ''.join(text).lstrip()))
+    return sections
+
+
+def parse_function(source: str, void: bool) -> Function:
+    ast = parse_markdown(source)
+    if ast['children'][0]['type'] != 'Heading':
+        raise Exception('Invalid Marsha function')
+    header = ast['children'][0]['children'][0]['content']
+    name = header.split('(')[0].split('func')[1].strip()
+    args = [Argument(arg.strip())
+            for arg in header.split('(')[1].split(')')[0].split(',')]
+    end = header.split('):')
+    returns = end[1].strip() if len(end) > 1 and not void else None
+    description = []
+    examples = []
+    ordered_examples = False
+    for child in ast['children'][1:]:
+        if child['type'] == 'List':
+            examples = [Example(to_markdown(item))
+                        for item in child['children']]
+            ordered_examples = child['start'] is not None
+            continue
+        if len(examples) > 0:
+            raise Exception(
+                'Function description must come *before* usage examples')
+        description.append(to_markdown(child))
+    return Function(name, args, returns, '\n\n'.join(description), examples, ordered_examples, source)
+
+
+def parse_type(source: str) -> TypeDef:
+    ast = parse_markdown(source)
+    if ast['children'][0]['type'] != 'Heading':
+        raise Exception('Invalid Marsha type')
+    header = ast['children'][0]['children'][0]['content']
+    split_header = header.split(' ')
+    filename = split_header[2] if len(
+        ast['children']) == 1 and len(split_header) == 3 else None
+    return TypeDef(split_header[1].strip(), filename, source)
+
+
+def parse_spec(content: str) -> Spec:
+    """Parses and validates a Marsha file"""
+    spec = Spec()
+    for (kind, source) in lex_sections(content):
+        text = source[1:]
+        if kind == 'func' and FUNC_PATTERN.match(text):
+            validate_marsha_fn(source)
+            spec.functions.append(parse_function(source, False))
+        elif kind == 'func' and VOID_FUNC_PATTERN.match(text):
+            validate_marsha_fn(source, True)
+            spec.functions.append(parse_function(source, True))
+        elif kind == 'type' and TYPE_PATTERN.match(text):
+            validate_marsha_type(source)
+            spec.types.append(parse_type(source))
+    if len(spec.functions) == 0 and len(spec.types) == 0:
+        raise Exception('No functions or types found in file')
+    return spec
+
+
+def hash_file(path: str) -> str:
+    try:
+        return hash_content(read_file(path))
+    except Exception:
+        return None
+
+
+class SpecCache:
+    """Parsed Marsha files, serialized to `.mrshc` files keyed on the hash of the source and of the directory it
+    is in, so recompiles skip parsing and validating the spec entirely. The directory is part of the key since the
+    type files are read relative to it, and the same source elsewhere may read different ones"""
+
+    def __init__(self, directory: str = None):
+        self.directory = directory
+
+    def get_path(self, content: str, dirname: str) -> str:
+        if self.directory is None:
+            self.directory = get_cache_dir('specs')
+        return os.path.join(self.directory, f'{hash_content(IR_VERSION, os.path.abspath(dirname), content)}.mrshc')
+
+    def get(self, content: str, dirname: str) -> Spec:
+        try:
+            data = json.loads(read_file(self.get_path(content, dirname)))
+            spec = Spec.from_dict(data)
+        except Exception:
+            return None
+        if any([hash_file(path) != file_hash for (path, file_hash) in spec.dependencies]):
+            return None
+        return spec
+
+    def set(self, content: str, dirname: str, spec: Spec):
+        path = self.get_path(content, dirname)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(spec.to_dict(), f)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f'Failed to write the parsed spec: {e}')
+
+
+spec_cache = SpecCache()
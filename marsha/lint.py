@@ -0,0 +1,227 @@
+import ast
+import asyncio
+import concurrent.futures
+import re
+from collections import OrderedDict
+
+import pycodestyle
+from pyflakes import checker
+
+from marsha.cache import hash_content
+
+# Same output as `pylama`, which the second stage prompt and its cached responses are built around
+LINT_FORMAT = '{filename}:{lnum}:{col} [{etype}] {number} {message} [{source}]'
+# Lines with a `# noqa` comment are skipped, like `pylama` does
+NOQA_PATTERN = re.compile(r'# *noqa\b', re.I)
+# How long a lint request waits for other candidates' files to join its batch, in seconds
+BATCH_WINDOW = 0.01
+MAX_CACHE_ENTRIES = 1024
+
+# We're using the linter as a way to catch coarse errors like missing imports. We don't actually
+# want the LLM to fix the linting issues, we'll just run the output through Python Black at the
+# end, so we have a significant number of warnings and "errors" from the linter we ignore
+IGNORE = {
+    'E111',  # indentation is not multiple of 4
+    'E117',  # over-indented
+    'E126',  # continuation line over-indented for hanging indent
+    'E127',  # continuation line over-indented for visual indent
+    'E128',  # continuation line under-indented for visual indent
+    'E129',  # visually indented line with same indent as next logical line
+    'E131',  # continuation line unaligned for hanging indent
+    'E133',  # closing bracket is missing indentation
+    'E201',  # whitespace after `(`
+    'E202',  # whitespace before `)`
+    'E203',  # whitespace before `,` `;` `:`
+    'E211',  # whitespace before `(`'
+    'E221',  # multiple spaces before operator
+    'E222',  # multiple spaces after operator
+    'E223',  # tab before operator
+    'E224',  # tab after operator
+    'E225',  # missing whitespace around operator
+    'E226',  # missing whitespace around arithmetic operator
+    'E227',  # missing whitespace around bitwise or shift operator
+    'E228',  # missing whitespace around modulo operator
+    'E231',  # missing whitespace after `,` `;` `:`
+    'E241',  # multiple spaces after `,` `;` `:`
+    'E242',  # tab after `,` `;` `:`
+    'E251',  # unexpected spaces around keyword / parameter equals
+    'E252',  # missing whitespace around parameter equals
+    'E261',  # at least two spaces before inline comment
+    'E262',  # inline comment should start with `# `
+    'E265',  # block comment should start with `# `
+    'E266',  # too many `#` for block comment
+    'E271',  # multiple spaces after keyword
+    'E272',  # multiple spaces before keyword
+    'E273',  # tab before keyword
+    'E274',  # tab after keyword
+    'E275',  # space missing after keyword
+    'E301',  # expected 1 blank line, found 0
+    'E302',  # expected 2 blank lines, found 0
+    'E303',  # too many blank lines
+    'E304',  # blank line after function decorator
+    'E305',  # expected 2 blank lines after function or class
+    'E306',  # expected 1 blank line before nested definition
+    'E401',  # multiple imports on one line
+    'E501',  # line too long
+    'E502',  # blackslash redundant between brackets
+    'E701',  # multiple statements on one line (colon)
+    'E702',  # multiple statements on one line (semicolon)
+    'E703',  # statement ends with a semicolon
+    'E722',  # do not use bare except, specify exception instead
+    'E731',  # do not assign a lambda expression, use a def
+    'W191',  # indentation contains tabs
+    'W291',  # trailing whitespace
+    'W292',  # no newline at end of file
+    'W293',  # blank line contains whitespace
+    'W391',  # blank line at end of file
+    # https://github.com/AtomLinter/linter-pylama/blob/master/bin/pylama/lint/pylama_pyflakes.py
+    'W0404',  # module is reimported multiple times
+    'W0410',  # future import(s) after other imports
+    'W0611',  # unused import
+    'W0612',  # unused variable
+}
+
+# pyflakes messages have no codes, these are the ones `pylama` gives them
+m = checker.messages
+PYFLAKES_CODES = {
+    m.UnusedImport.message: 'W0611',
+    m.RedefinedWhileUnused.message: 'W0404',
+    m.ImportShadowedByLoopVar.message: 'W0621',
+    m.ImportStarUsed.message: 'W0401',
+    m.ImportStarUsage.message: 'W0401',
+    m.UndefinedName.message: 'E0602',
+    m.DoctestSyntaxError.message: 'W0511',
+    m.UndefinedExport.message: 'E0603',
+    m.UndefinedLocal.message: 'E0602',
+    m.DuplicateArgument.message: 'E1122',
+    m.LateFutureImport.message: 'W0410',
+    m.UnusedVariable.message: 'W0612',
+    m.ReturnOutsideFunction.message: 'E0104',
+}
+
+style_guide = None
+
+
+class LintReport(pycodestyle.BaseReport):
+    """Collects the pycodestyle errors instead of printing them"""
+
+    def __init__(self, options):
+        super().__init__(options)
+        self.errors = []
+
+    def error(self, line_number, offset, text, check):
+        code = super().error(line_number, offset, text, check)
+        if code is not None:
+            self.errors.append(
+                (line_number, offset + 1, code, text[5:], 'pycodestyle'))
+        return code
+
+
+def get_style_guide() -> pycodestyle.StyleGuide:
+    global style_guide
+    if style_guide is None:
+        # Passing the ignore list replaces pycodestyle's own defaults, same as with `pylama`
+        style_guide = pycodestyle.StyleGuide(
+            config_file=False, ignore=sorted(IGNORE))
+    return style_guide
+
+
+def lint_source(filename: str, source: str) -> list[tuple]:
+    """Lints Python source with `compile()`, pyflakes and pycodestyle, returning `(lnum, col, number, message, source)`
+    tuples"""
+    try:
+        tree = compile(source, filename, 'exec', ast.PyCF_ONLY_AST)
+    except SyntaxError as e:
+        # Nothing else is worth reporting until the code parses
+        return [(e.lineno or 1, e.offset or 1, '', f'SyntaxError: {e.msg}', 'pylama')]
+    except ValueError as e:
+        return [(1, 1, '', str(e), 'pylama')]
+    errors = []
+    for message in checker.Checker(tree, filename).messages:
+        errors.append((message.lineno, message.col + 1, PYFLAKES_CODES.get(message.message, ''),
+                       message.message % message.message_args, 'pyflakes'))
+    options = get_style_guide().options
+    report = LintReport(options)
+    pycodestyle.Checker(filename, lines=source.splitlines(
+        keepends=True), options=options, report=report).check_all()
+    errors.extend(report.errors)
+    lines = source.split('\n')
+    return sorted([e for e in errors if e[2] not in IGNORE and not (
+        e[0] <= len(lines) and NOQA_PATTERN.search(lines[e[0] - 1]))])
+
+
+def lint_sources(sources: list[tuple[str, str]]) -> list[list[tuple]]:
+    return [lint_source(filename, source) for (filename, source) in sources]
+
+
+def format_lint(filename: str, error: tuple) -> str:
+    (lnum, col, number, message, source) = error
+    return LINT_FORMAT.format(filename=filename, lnum=lnum, col=col, etype=number[:1] or 'E', number=number,
+                              message=message.strip().replace('\n', ' '), source=source)
+
+
+class LintEngine:
+    """Lints source strings in a process pool so it never blocks the event loop.
+
+    Requests arriving within `BATCH_WINDOW` of each other are sent to the pool as a single batch, and
+    results are cached by file content, least recently used first out, so unchanged files are never linted twice."""
+
+    def __init__(self, max_workers: int = None):
+        self.max_workers = max_workers
+        self.executor = None
+        self.pending = []
+        self.batch = None
+        self.cache = OrderedDict()
+
+    def get_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        if self.executor is None:
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.max_workers)
+        return self.executor
+
+    async def lint(self, files: dict[str, str]) -> dict[str, list[str]]:
+        """Lints a `{filename: source}` dict, returning the formatted lint messages of each file"""
+        loop = asyncio.get_running_loop()
+        errors = {}
+        waiting = []
+        for (filename, source) in files.items():
+            key = hash_content(source)
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                errors[filename] = self.cache[key]
+                continue
+            future = loop.create_future()
+            self.pending.append((filename, source, future))
+            waiting.append((filename, key, future))
+        if len(waiting) > 0 and self.batch is None:
+            self.batch = asyncio.create_task(self.run_batch())
+        for (filename, key, future) in waiting:
+            errors[filename] = await future
+            self.cache[key] = errors[filename]
+            self.cache.move_to_end(key)
+        while len(self.cache) > MAX_CACHE_ENTRIES:
+            self.cache.popitem(last=False)
+        return {filename: [format_lint(filename, e) for e in errors[filename]] for filename in files}
+
+    async def run_batch(self):
+        await asyncio.sleep(BATCH_WINDOW)
+        (batch, self.pending, self.batch) = (self.pending, [], None)
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                self.get_executor(), lint_sources, [(filename, source) for (filename, source, _) in batch])
+        except Exception as e:
+            for (_, _, future) in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for ((_, _, future), errors) in zip(batch, results):
+            if not future.done():
+                future.set_result(errors)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+lint_engine = LintEngine()
@@ -1,19 +1,28 @@
 import asyncio
-from asyncio.subprocess import Process
-import os
-import platform
+import autopep8
 import time
 import traceback
 import shutil
-import subprocess
 import sys
 
-from pylama.main import parse_options, check_paths, DEFAULT_FORMAT
-
+from marsha.compact import compact_fix_prompt, restore_elided_tests, ELIDED_BODY
+from marsha.fanout import report_lint, report_tests
+from marsha.lint import lint_engine
+from marsha.localize import localize_failures, function_meta, get_type_classes
+from marsha.manifest import merge_requirements
 from marsha.meta import MarshaMeta
-from marsha.parse import validate_first_stage_markdown, validate_second_stage_markdown, write_files_from_markdown, format_marsha_for_llm, extract_func_name
-from marsha.stats import stats
-from marsha.utils import read_file, autoformat_files, prettify_time_delta
+from marsha.partition import partitioner
+from marsha.parse import validate_first_stage_markdown, validate_second_stage_markdown, validate_code_markdown, validate_test_markdown, validate_patch_markdown, write_files_from_markdown, read_markdown_files, format_marsha_for_llm, MarkdownStructure
+from marsha.patch import patcher, PatchError
+from marsha.shards import test_shards, TestResults
+from marsha.splice import extract_definitions, find_collisions, merge_modules
+from marsha.stats import get_stats
+from marsha.tokens import count_tokens
+from marsha.trace import tracer
+from marsha.utils import merge_async_iterators
+from marsha.venvs import venv_cache, get_venv_python
+from marsha.workers import test_workers
+from marsha.workspace import Workspace
 from marsha.mappers.chatgpt import ChatGPTMapper
 
 # PyInstaller creates a temp folder and stores path in _MEIPASS
@@ -62,8 +71,27 @@ async def gpt_improve_func(meta: MarshaMeta):
     print(improvements)
 
 
-async def gpt_func_to_python(meta: MarshaMeta, n_results: int, retries: int = 3, debug: bool = False):
+async def gpt_func_to_python(meta: MarshaMeta, n_results: int, retries: int = 3, debug: bool = False,
+                             stats_stage: str = 'first_stage', cache_variant: int = 0, split: bool = True):
+    if split and partitioner.enabled:
+        groups = partitioner.partition(meta)
+        if len(groups) > 1:
+            async for md in split_func_to_python(meta, groups, n_results, retries, debug, stats_stage, cache_variant):
+                yield md
+            return
     marsha_for_code_llm = format_marsha_for_llm(meta)
+    if meta.existing_code is not None:
+        # Incremental compile: the other functions were already verified and get spliced back in afterwards
+        marsha_for_code_llm = f'''{marsha_for_code_llm}
+
+# Already implemented
+
+The following code is already part of `{meta.filename}.py` and can be used by the functions above.
+Do not include it in your response, it is added to the file automatically.
+
+```py
+{meta.existing_code}
+```'''
     gpt_gen_code = ChatGPTMapper(f'''You are a senior software engineer assigned to write Python 3 functions.
 The assignment is written in markdown format.
 The description of each function should be included as a docstring.
@@ -95,7 +123,8 @@ The desired response must look like the following:
 <dependencies needed>
 ```
 
-''', n_results=n_results, stats_stage='first_stage')
+''', n_results=n_results, stats_stage=stats_stage, cache_variant=cache_variant,
+                                 structure=lambda: MarkdownStructure([f'{meta.filename}.py', 'requirements.txt'], optional=['requirements.txt']))
     marsha_for_test_llm = format_marsha_for_llm(meta)
     gpt_gen_test = ChatGPTMapper(f'''You are a senior software engineer assigned to write a unit test suite for Python 3 functions.
 The assignment is written in markdown format.
@@ -120,63 +149,252 @@ The desired response must look like the following:
 <generated code>
 ```
 
-''', n_results=n_results, stats_stage='first_stage')
+''', n_results=n_results, stats_stage=stats_stage, cache_variant=cache_variant,
+                                 structure=lambda: MarkdownStructure([f'{meta.filename}_test.py']))
     if debug:
         print(f'''marsha_for_llm =
     ---- start ----
 {marsha_for_code_llm}
     ---- end ----''')
 
-    reses = await asyncio.gather(gpt_gen_code.run(marsha_for_code_llm), gpt_gen_test.run(marsha_for_test_llm))
-    # The output should be a valid list of Markdown documents. Parse each one and return the list of parsed doc, on failure
-    # do not add it to the list. If the list to return is empty try again (or fully error out, for now)
-    try:
-        mds = list()
-        for i in range(n_results):
-            # TODO: This unfairly reduces the success probability of the separate GPT calls, requiring both in the same run
-            # to pass. It should instead try to use the same pass if possible, but otherwise use a different pairing so bad
-            # dice rolls don't compound each other.
-            doc = reses[0][i] + '\n\n' + reses[1][i]
-            # Some validation that the generated file matches the expected format of:
-            # # function_name.py
-            # ```py
-            # <insert code here>
-            # ```
-            # # requirements.txt
-            # ```text
-            # <dependency>
-            # ```
-            # # function_name_test.py
-            # ```py
-            # <insert code here>
-            # ```
-            if validate_first_stage_markdown(doc, meta.filename):
-                mds.append(doc)
+    # The code and the tests are validated separately, and only the side without any valid output is requested
+    # again, so one bad generation does not throw away the good ones from the other side. A candidate is yielded
+    # as soon as there is a new valid code and a new valid test to pair, without waiting for the other choices
+    codes = []
+    tests = []
+    pairs = []
+    while True:
+        sides = {}
+        if len(codes) == 0:
+            sides['code'] = valid_choices(gpt_gen_code, marsha_for_code_llm,
+                                          lambda md: validate_code_markdown(md, meta.filename), 'code', debug)
+        if len(tests) == 0:
+            sides['test'] = valid_choices(gpt_gen_test, marsha_for_test_llm,
+                                          lambda md: validate_test_markdown(md, meta.filename), 'test', debug)
+        async for (side, md) in merge_async_iterators(sides):
+            if side == 'code':
+                codes.append(md)
             else:
-                if debug:
-                    print(f'''[First stage] Invalid doc:
-{doc}''')
-        if len(mds) == 0:
-            raise Exception('Invalid output format')
-        return mds
-    except Exception:
+                tests.append(md)
+            # Reusing a code or a test in another pair waits until every output is in
+            used_codes = set([i for (i, _) in pairs])
+            used_tests = set([j for (_, j) in pairs])
+            unused_codes = [i for i in range(
+                len(codes)) if i not in used_codes]
+            unused_tests = [j for j in range(
+                len(tests)) if j not in used_tests]
+            if len(unused_codes) > 0 and len(unused_tests) > 0 and len(pairs) < n_results:
+                pairs.append((unused_codes[0], unused_tests[0]))
+                yield join_candidate(codes[unused_codes[0]], tests[unused_tests[0]])
+        if len(codes) > 0 and len(tests) > 0:
+            break
+        if retries == 0:
+            raise Exception('Failed to generate code', meta.filename)
         if debug:
             print(
                 f'Failed to parse doc. Retries left = {retries}. Retrying...')
-        if retries > 0:
-            return await gpt_func_to_python(meta, n_results, retries - 1, debug)
-        else:
-            raise Exception('Failed to generate code', meta.filename)
+        retries = retries - 1
+    for pair in candidate_pairs(len(codes), len(tests)):
+        if len(pairs) >= n_results:
+            break
+        if pair not in pairs:
+            pairs.append(pair)
+            yield join_candidate(codes[pair[0]], tests[pair[1]])
+
+
+async def split_func_to_python(meta: MarshaMeta, groups: list[MarshaMeta], n_results: int, retries: int,
+                               debug: bool, stats_stage: str, cache_variant: int):
+    """Generates the code and tests of each group of functions concurrently, in completions small enough to not
+    need a bigger model, yielding a candidate for the whole file once every group has one to add to it. The
+    candidates that can't be merged are generated again for the whole file at once"""
+    if debug:
+        print(f'Generating {len(groups)} groups of functions concurrently')
+    generated = [[] for _ in groups]
+    merged = 0
+    yielded = 0
+    async for (i, md) in merge_async_iterators({i: gpt_func_to_python(group, n_results, retries, debug, stats_stage,
+                                                                      cache_variant, split=False)
+                                                for (i, group) in enumerate(groups)}):
+        generated[i].append(md)
+        while merged < n_results and all([len(mds) > merged for mds in generated]):
+            candidate = merge_candidates(
+                meta, [mds[merged] for mds in generated])
+            merged = merged + 1
+            if candidate is not None:
+                yielded = yielded + 1
+                yield candidate
+    if yielded < n_results:
+        if debug:
+            print(
+                f'{n_results - yielded} split candidates define the same names, generating them unsplit')
+        async for md in gpt_func_to_python(meta, n_results - yielded, retries, debug, stats_stage, cache_variant,
+                                           split=False):
+            yield md
+
+
+async def valid_choices(mapper: ChatGPTMapper, user_request: str, validate, label: str, debug: bool = False):
+    valid = 0
+    async for md in mapper.run_choices(user_request):
+        with tracer.span('validate', 'parse', side=label):
+            valid_md = validate(md)
+        if valid_md:
+            valid = valid + 1
+            yield md
+        elif debug:
+            print(f'''[First stage] Invalid {label} doc:
+{md}''')
+    if valid == 0:
+        mapper.invalidate_cache()
+
+
+def candidate_pairs(n_codes: int, n_tests: int) -> list[tuple[int, int]]:
+    # Walk both lists together, so pairs from the same choice come first and every valid code and test gets
+    # used before the remaining combinations
+    pairs = []
+    for k in range(n_codes * n_tests):
+        if (k % n_codes, k % n_tests) not in pairs:
+            pairs.append((k % n_codes, k % n_tests))
+    return pairs + [(i, j) for i in range(n_codes) for j in range(n_tests) if (i, j) not in pairs]
+
+
+def join_candidate(code: str, test: str) -> str:
+    # Candidates are documents of the format:
+    # # function_name.py
+    # ```py
+    # <insert code here>
+    # ```
+    # # requirements.txt
+    # ```text
+    # <dependency>
+    # ```
+    # # function_name_test.py
+    # ```py
+    # <insert code here>
+    # ```
+    return code + '\n\n' + test
+
+
+def merge_candidates(meta: MarshaMeta, mds: list[str]) -> str:
+    # The groups share no definitions, so merging them only hoists and de-duplicates their imports. A helper or a
+    # test class that more than one group defined differently would be dropped instead, which they can't be merged
+    # without, so there is no candidate
+    files = [read_markdown_files(md) for md in mds]
+    for filename in [f'{meta.filename}.py', f'{meta.filename}_test.py']:
+        try:
+            if len(find_collisions([f[filename] for f in files if f.get(filename)])) > 0:
+                return None
+        except SyntaxError:
+            # The linting stage will take care of it
+            pass
 
+    def merge(filename: str) -> str:
+        sources = [f[filename] for f in files if f.get(filename)]
+        merged = sources[0] if len(sources) > 0 else ''
+        for source in sources[1:]:
+            try:
+                merged = merge_modules(merged, source)
+            except SyntaxError:
+                # The linting stage will take care of it
+                merged = f'{merged}\n\n{source}'
+        return merged
 
-async def fix_file(marsha_filename: str, filename: str, lint_text: str, retries: int = 3, debug: bool = False):
-    code = read_file(filename)
-    gpt_fix = ChatGPTMapper(f'''You are a senior software engineer working with Python 3.
+    requirements = merge_requirements(
+        *[f.get('requirements.txt') or '' for f in files])
+    code = f'''# {meta.filename}.py
+
+```py
+{merge(f'{meta.filename}.py')}
+```'''
+    if len(requirements) > 0:
+        code = f'''{code}
+
+# requirements.txt
+
+```txt
+{requirements}
+```'''
+    return join_candidate(code, f'''# {meta.filename}_test.py
+
+```py
+{merge(f'{meta.filename}_test.py')}
+```''')
+
+
+def patch_format(filenames: list[str]) -> str:
+    return f'''Your response must be a markdown file with a section for each file you changed, in the order {', '.join([f'`{filename}`' for filename in filenames])}, and no section for the files you did not change.
+The section header must be the filename.
+The content of the section must be a diff code block with one or more search and replace blocks.
+The search part must be copied exactly from the file, including the indentation, and must be long enough to only match one place in the file.
+The file should end with the code block, nothing else should be added to the file.
+The desired response must look like the following:
+
+# {filenames[0]}
+
+```diff
+<<<<<<< SEARCH
+<lines to replace>
+=======
+<fixed lines>
+>>>>>>> REPLACE
+```
+
+'''
+
+
+async def patch_files(instructions: str, user_request: str, files: dict[str, str], stats_stage: str,
+                      model: str = 'gpt-3.5-turbo', debug: bool = False) -> dict[str, str]:
+    """Asks for the fix as search and replace blocks and applies them to `files`, returning the new content of the
+    patched files, or None when the patch is malformed or doesn't apply and the whole files are needed instead"""
+    filenames = list(files.keys())
+    gpt_patch = ChatGPTMapper(f'''{instructions}
+{patch_format(filenames)}''', model=model, stats_stage=stats_stage,
+                              structure=lambda: MarkdownStructure(filenames, optional=filenames))
+    patch = await gpt_patch.run(user_request)
+    try:
+        if not validate_patch_markdown(patch, filenames):
+            raise PatchError('Invalid output format')
+        patched = patcher.apply(files, read_markdown_files(patch))
+    except PatchError as e:
+        if debug:
+            print(f'''[{stats_stage}] Falling back to whole files, the patch failed: {e}
+{patch}''')
+        gpt_patch.invalidate_cache()
+        get_stats().patch_update(stats_stage, False)
+        return None
+    # Whole files would have repeated every file, changed or not
+    full_tokens = sum([count_tokens(patched.get(filename, content) or '')
+                      for (filename, content) in files.items()])
+    get_stats().patch_update(stats_stage, True, max(
+        0, full_tokens - count_tokens(patch)))
+    return patched
+
+
+async def fix_file(marsha_filename: str, filename: str, lint_text: str, workspace: Workspace, retries: int = 3,
+                   debug: bool = False):
+    code = workspace.read(filename)
+    instructions = '''You are a senior software engineer working with Python 3.
 You are using the `pylama` linting tool to find obvious errors and then fixing them. The linting tool uses `pyflakes` and `pycodestyle` under the hood to provide the recommendations.
 All of the lint errors require fixing.
 You should only fix the lint errors and not change anything else.
 Your response must not comment on what you changed.
-Your response must not add any additional comments, clarifications, notes, information, explanations, details, examples or thoughts.
+Your response must not add any additional comments, clarifications, notes, information, explanations, details, examples or thoughts.'''
+    user_request = f'''# {filename}
+
+```py
+{code}
+```
+
+# pylama results
+
+```
+{lint_text}
+```'''
+    if patcher.enabled:
+        patched = await patch_files(instructions, user_request, {filename: code}, 'second_stage', debug=debug)
+        if patched is not None:
+            workspace.write(filename, patched[filename])
+            return
+    gpt_fix = ChatGPTMapper(f'''{instructions}
 Your response must be a markdown file.
 The first section header must be the filename `{filename}`.
 The content of the first section must be a python code block with the generated code.
@@ -189,18 +407,8 @@ The desired response must look like the following:
 <fixed code>
 ```
 
-''', stats_stage='second_stage')
-    fixed_code = await gpt_fix.run(f'''# {filename}
-
-```py
-{code}
-```
-
-# pylama results
-
-```
-{lint_text}
-```''')
+''', stats_stage='second_stage', structure=lambda: MarkdownStructure([filename]))
+    fixed_code = await gpt_fix.run(user_request)
     # The output should be a valid Markdown document. Parse it and return the parsed doc, on failure
     # try again (or fully error out, for now)
     try:
@@ -208,135 +416,41 @@ The desired response must look like the following:
             if debug:
                 print(f'''[Second stage] Invalid doc:
 {fixed_code}''')
+            gpt_fix.invalidate_cache()
             raise Exception('Invalid output format')
-        write_files_from_markdown(fixed_code)
+        write_files_from_markdown(fixed_code, workspace=workspace)
     except Exception:
         if retries > 0:
-            return await fix_file(marsha_filename, filename, lint_text, retries - 1, debug)
+            return await fix_file(marsha_filename, filename, lint_text, workspace, retries - 1, debug)
         else:
             raise Exception('Failed to generate code', lint_text)
 
 
-async def lint_and_fix_files(marsha_filename: str, files: list[str], max_depth: int = 4, debug: bool = False):
+async def lint_and_fix_files(marsha_filename: str, files: list[str], workspace: Workspace, max_depth: int = 4,
+                             debug: bool = False):
     if max_depth == 0:
         raise Exception('Failed to fix code', files)
-    options = parse_options()
-
-    # Disabling pydocstyle and mccabe as they only do style checks, no compile-like checks
-    options.linters = ['pycodestyle', 'pyflakes']
-    options.paths = [os.path.abspath(f'./{file}') for file in files]
-
-    # options.select = {
-    #     'E112',  # expected an indented block
-    #     'E113',  # unexpected indentation
-    #     'E901',  # SyntaxError or IndentationError
-    #     'E902',  # IOError
-    #     'E0602', # undefined variable
-    #     'E1122',  # unexpected keyword argument in function call
-    #     'W0401', # wildcard import; unable to detect undefined names
-    # }
-
-    # We're using the linter as a way to catch coarse errors like missing imports. We don't actually
-    # want the LLM to fix the linting issues, we'll just run the output through Python Black at the
-    # end, so we have a significant number of warnings and "errors" from the linter we ignore
-    options.ignore = {
-        'E111',  # indentation is not multiple of 4
-        'E117',  # over-indented
-        'E126',  # continuation line over-indented for hanging indent
-        'E127',  # continuation line over-indented for visual indent
-        'E128',  # continuation line under-indented for visual indent
-        'E129',  # visually indented line with same indent as next logical line
-        'E131',  # continuation line unaligned for hanging indent
-        'E133',  # closing bracket is missing indentation
-        'E201',  # whitespace after `(`
-        'E202',  # whitespace before `)`
-        'E203',  # whitespace before `,` `;` `:`
-        'E211',  # whitespace before `(`'
-        'E221',  # multiple spaces before operator
-        'E222',  # multiple spaces after operator
-        'E223',  # tab before operator
-        'E224',  # tab after operator
-        'E225',  # missing whitespace around operator
-        'E226',  # missing whitespace around arithmetic operator
-        'E227',  # missing whitespace around bitwise or shift operator
-        'E228',  # missing whitespace around modulo operator
-        'E231',  # missing whitespace after `,` `;` `:`
-        'E241',  # multiple spaces after `,` `;` `:`
-        'E242',  # tab after `,` `;` `:`
-        'E251',  # unexpected spaces around keyword / parameter equals
-        'E252',  # missing whitespace around parameter equals
-        'E261',  # at least two spaces before inline comment
-        'E262',  # inline comment should start with `# `
-        'E265',  # block comment should start with `# `
-        'E266',  # too many `#` for block comment
-        'E271',  # multiple spaces after keyword
-        'E272',  # multiple spaces before keyword
-        'E273',  # tab before keyword
-        'E274',  # tab after keyword
-        'E275',  # space missing after keyword
-        'E301',  # expected 1 blank line, found 0
-        'E302',  # expected 2 blank lines, found 0
-        'E303',  # too many blank lines
-        'E304',  # blank line after function decorator
-        'E305',  # expected 2 blank lines after function or class
-        'E306',  # expected 1 blank line before nested definition
-        'E401',  # multiple imports on one line
-        'E501',  # line too long
-        'E502',  # blackslash redundant between brackets
-        'E701',  # multiple statements on one line (colon)
-        'E702',  # multiple statements on one line (semicolon)
-        'E703',  # statement ends with a semicolon
-        'E722',  # do not use bare except, specify exception instead
-        'E731',  # do not assign a lambda expression, use a def
-        'W191',  # indentation contains tabs
-        'W291',  # trailing whitespace
-        'W292',  # no newline at end of file
-        'W293',  # blank line contains whitespace
-        'W391',  # blank line at end of file
-        # https://github.com/AtomLinter/linter-pylama/blob/master/bin/pylama/lint/pylama_pyflakes.py
-        'W0404',  # module is reimported multiple times
-        'W0410',  # future import(s) after other imports
-        'W0611',  # unused import
-        'W0612',  # unused variable
-    }
-
-    lints = check_paths(
-        [os.path.abspath(f'./{file}') for file in files], options=options, rootdir='.')
+    # Only Python files are linted, and unchanged ones are served from the lint cache
+    with tracer.span('lint', 'lint', iteration=4 - max_depth):
+        lints = await lint_engine.lint({file: workspace.read(file) for file in files if file.endswith('.py')})
+    report_lint(sum([len(file_lints) for file_lints in lints.values()]))
 
-    if len(lints) == 0:
+    if all([len(file_lints) == 0 for file_lints in lints.values()]):
         return
 
     jobs = []
-    for file in files:
-        file_lints = [e.format(DEFAULT_FORMAT)
-                      for e in lints if e.filename == file]
+    for (file, file_lints) in lints.items():
         if len(file_lints) > 0:
             lint_text = '\n'.join(file_lints)
             jobs.append(fix_file(marsha_filename, file,
-                        lint_text, debug=debug))
+                        lint_text, workspace, debug=debug))
     await asyncio.gather(*jobs)
 
-    await lint_and_fix_files(marsha_filename, files, max_depth - 1, debug)
-
-
-async def run_subprocess(stream: Process, timeout: float = 60.0) -> tuple[str, str]:
-    stdout = ''
-    stderr = ''
-    try:
-        stdout, stderr = await asyncio.wait_for(stream.communicate(), timeout)
-    except asyncio.exceptions.TimeoutError:
-        try:
-            stream.kill()
-        except OSError:
-            # Ignore 'no such process' error
-            pass
-        raise Exception('run_subprocess timeout...')
-    except Exception as e:
-        raise e
-    return (stdout.decode('utf-8'), stderr.decode('utf-8'))
+    await lint_and_fix_files(marsha_filename, files, workspace, max_depth - 1, debug)
 
 
-async def test_and_fix_files(meta: MarshaMeta, files: list[str], retries: int = 4, debug: bool = False):
+async def test_and_fix_files(meta: MarshaMeta, files: list[str], workspace: Workspace, retries: int = 4,
+                             debug: bool = False):
     break_line = '\n'
     if retries == 0:
         raise Exception('Failed to fix code', meta.filename)
@@ -346,72 +460,116 @@ async def test_and_fix_files(meta: MarshaMeta, files: list[str], retries: int =
     code_file = [file for file in files if file.endswith(
         f'{meta.filename}.py')][0]
     req_files = [file for file in files if file.endswith('requirements.txt')]
-    # Define virtual environment path
-    code_file_abspath = os.path.abspath(code_file)
-    code_file_dir = os.path.dirname(code_file_abspath)
-    venv_path = f'{code_file_dir}/venv'
-    # Install requirements if needed
+    # Install requirements if needed, into a virtual environment shared by every candidate with the same ones
     req_file = None
+    python_exe = python
     if len(req_files) > 0:
         req_file = req_files[0]
-        if not os.path.exists(venv_path):
-            print('Creating virtual environment...')
-            try:
-                create_venv_stream = await asyncio.create_subprocess_exec(
-                    python, '-m', 'venv', venv_path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                await run_subprocess(create_venv_stream)
-            except Exception as e:
-                if debug:
-                    print('Failed to create virtual environment', e)
-        print('Installing requirements...')
         try:
-            # define pip executable based on os
-            pip_exe = f'{venv_path}/Scripts/pip.exe' if platform.system(
-            ) == 'Windows' else f'{venv_path}/bin/pip'
-            pip_stream = await asyncio.create_subprocess_exec(
-                pip_exe, 'install', '--disable-pip-version-check', '--no-compile', '-r', req_file, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            await run_subprocess(pip_stream, 120)
+            venv_path = await venv_cache.get(python, workspace.read(req_file), debug)
+            python_exe = get_venv_python(venv_path)
         except Exception as e:
             if debug:
-                print('Failed to install requirements', e)
-
-    # Run the test suite
-    if not os.path.exists(venv_path):
-        python_exe = python
-    else:
-        # define python executable based on os
-        python_exe = f'{venv_path}/Scripts/python.exe' if platform.system(
-        ) == 'Windows' else f'{venv_path}/bin/python'
+                print('Failed to set up virtual environment', e)
+
+    # Run every test case of the suite at once, on warm workers for the interpreter when possible. It is the only
+    # step that needs the files on disk
+    workspace.materialize()
     try:
-        test_stream = await asyncio.create_subprocess_exec(
-            python_exe, test_file, '-f', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = await run_subprocess(test_stream)
-        test_results = f'''{stdout}{stderr}'''
+        with tracer.span('test run', 'test', iteration=4 - retries, warm=test_workers.enabled):
+            results = await test_shards.run(python_exe, workspace.read(req_file) if req_file is not None else '',
+                                            test_file, workspace.read(test_file))
+        test_results = results.format()
+        report_tests(test_results, workspace.read(test_file))
     except Exception as e:
         print('Failed to run test suite...', e)
         test_results = None
 
     # Recursively work on fixing the files while the test suite fails, return when complete
-    if test_results is not None and ("FAILED" in test_results or "Traceback" in test_results):
+    if test_results is not None and results.failed:
         if debug:
             print('Test failed, trying to fix code')
             print(test_results)
-        test = read_file(test_file)
-        code = read_file(code_file)
-        requirements = read_file(req_file) if req_file is not None else None
-        void_function_names = list(
-            map(lambda f: extract_func_name(f), meta.void_funcs))
-        gpt_fix = ChatGPTMapper(f'''You are a senior software engineer helping a junior engineer fix some code that is failing.
+        test = workspace.read(test_file)
+        code = workspace.read(code_file)
+        requirements = workspace.read(
+            req_file) if req_file is not None else None
+        function_names = [meta.spec.function(
+            f).name for f in meta.functions + meta.void_funcs]
+        # With more than one function, each failure is pinned on the function responsible and only that function
+        # is sent to be fixed
+        localized = localize_failures(results, test, code, code_file, function_names) if len(
+            function_names) > 1 else None
+        if localized is not None:
+            files = await fix_functions(meta, localized, code_file, test_file, req_file, workspace, results, debug)
+            return await test_and_fix_files(meta, files, workspace, retries - 1, debug)
+        void_function_names = [meta.spec.function(
+            f).name for f in meta.void_funcs]
+        # The spec, the code and the failing tests are needed in full, but the tests that passed and most of the
+        # test output are not
+        spec = format_marsha_for_llm(meta)
+        (prompt_test, prompt_test_results, elided) = compact_fix_prompt(count_tokens(
+            spec) + count_tokens(code) + count_tokens(requirements or ''), test, test_results, results.passing)
+        get_stats().compact_update('third_stage', count_tokens(test) + count_tokens(test_results) -
+                                   count_tokens(prompt_test) - count_tokens(prompt_test_results))
+        instructions = f'''You are a senior software engineer helping a junior engineer fix some code that is failing.
 You are given the documentation of the functions they were assigned to write, followed by the functions they wrote, the unit tests they wrote, and the unit test results.
 Focus on just fixing the mistakes in the code and unit tests as necessary, trying to do the less number of changes.
 Do not write new unit tests, just fix the existing ones.
+{f"The unit tests with a body of `{ELIDED_BODY}` passed and their body was left out, keep them exactly as they are." if len(elided) > 0 else ""}
 {f"Do not make any reference to the functions {', '.join(void_function_names)} in `{meta.filename}_test.py`." if len(void_function_names) > 0 else ""}
 Make sure to produce working code that passes the unit tests.
 Make sure to follow PEP8 style guidelines.
 Make sure to include all needed standard Python libraries imports.
 Generate `requirements.txt` file with all needed dependencies, do not add fixed version to dependencies.
 Your response must not comment on what you changed.
-Your response must not add any additional comments, clarifications, notes, information, explanations, details, examples or thoughts.
+Your response must not add any additional comments, clarifications, notes, information, explanations, details, examples or thoughts.'''
+        user_request = f'''{spec}
+
+{f"""## Do not test the following functions:
+
+{break_line.join(map(lambda f: f"- {f}", void_function_names))}""" if len(void_function_names) > 0 else ""}
+
+# {code_file}
+
+```py
+{code}
+```
+
+# requirements.txt
+
+```txt
+{requirements if requirements is not None else ''}
+```
+
+# {test_file}
+
+```py
+{prompt_test}
+```
+
+# Test Results
+
+{prompt_test_results}'''
+        subdir = '/'.join(code_file.split('/')[:-1])
+        patched = None
+        if patcher.enabled:
+            patched = await patch_files(instructions, user_request, {
+                f'{meta.filename}.py': code,
+                'requirements.txt': requirements,
+                f'{meta.filename}_test.py': prompt_test,
+            }, 'third_stage', model='gpt-4', debug=debug)
+        if patched is not None:
+            if f'{meta.filename}_test.py' in patched:
+                patched[f'{meta.filename}_test.py'] = restore_elided_tests(
+                    patched[f'{meta.filename}_test.py'], test, elided)
+            for (filename, content) in patched.items():
+                workspace.write(f'{subdir}/{filename}', content)
+            files = [code_file, test_file] + \
+                ([f'{subdir}/requirements.txt'] if (patched.get('requirements.txt')
+                 or requirements or '').strip() != '' else [])
+        else:
+            gpt_fix = ChatGPTMapper(f'''{instructions}
 Your response must be a markdown file.
 The first section header must be the filename `{meta.filename}.py`.
 The content of the first section must be a python code block with the generated code.
@@ -440,17 +598,82 @@ The desired response must look like the following:
 <fixed code>
 ```
 
-''', model='gpt-4', stats_stage='third_stage')
-        fixed_code = await gpt_fix.run(f'''{format_marsha_for_llm(meta)}
-
-{f"""## Do not test the following functions:
+''', model='gpt-4', stats_stage='third_stage',
+                                    structure=lambda: MarkdownStructure([f'{meta.filename}.py', 'requirements.txt', f'{meta.filename}_test.py'],
+                                                                        optional=['requirements.txt']))
+            fixed_code = await gpt_fix.run(user_request)
+            # The output should be a valid Markdown document. Parse it and return the parsed doc, on failure
+            # try again (or fully error out, for now)
+            try:
+                # Some validation that the generated file matches the expected format of:
+                # # function_name.py
+                # ```py
+                # <insert code here>
+                # ```
+                # # requirements.txt
+                # ```txt
+                # <dependency>
+                # ```
+                # # function_name_test.py
+                # ```py
+                # <insert code here>
+                # ```
+                if not validate_first_stage_markdown(fixed_code, meta.filename):
+                    gpt_fix.invalidate_cache()
+                    raise Exception('Invalid output format')
+                files = write_files_from_markdown(
+                    fixed_code, subdir=subdir, workspace=workspace)
+                if len(elided) > 0:
+                    fixed_test_file = [file for file in files if file.endswith(
+                        f'{meta.filename}_test.py')][0]
+                    workspace.write(fixed_test_file, restore_elided_tests(
+                        workspace.read(fixed_test_file), test, elided))
+            except Exception:
+                if retries == 0:
+                    raise Exception('Failed to fix code', meta.filename)
 
-{break_line.join(map(lambda f: f"- {f}", void_function_names))}""" if len(void_function_names) > 0 else ""}
+        # We figure out if this pass has succeeded by re-running the tests recursively, where it
+        # ejects from the iteration if the tests pass
+        return await test_and_fix_files(meta, files, workspace, retries - 1, debug)
+    elif test_results is None:  # If the test suite failed to run, we try again
+        return await test_and_fix_files(meta, files, workspace, retries - 1, debug)
+
+
+async def fix_function(meta: MarshaMeta, function_name: str, test_cases: list[str], code: str, test: str,
+                       requirements: str, results: TestResults, debug: bool = False) -> dict[str, str]:
+    """Fixes one function and its tests, given only its part of the spec, the code and the tests. Returns the
+    fixed files, with just that function and its tests in them, or `None` if the fix failed"""
+    fn_meta = function_meta(meta, function_name)
+    spec = format_marsha_for_llm(fn_meta)
+    fn_code = extract_definitions(code, set(
+        [function_name]) | get_type_classes(fn_meta, code))
+    fn_test = extract_definitions(test, set(test_cases))
+    fn_results = TestResults(
+        [result for result in results.results if result['class'] in test_cases], '', results.elapsed)
+    fn_test_results = fn_results.format()
+    (prompt_test, prompt_test_results, elided) = compact_fix_prompt(count_tokens(
+        spec) + count_tokens(fn_code) + count_tokens(requirements or ''), fn_test, fn_test_results, fn_results.passing)
+    get_stats().compact_update('third_stage', count_tokens(fn_test) + count_tokens(fn_test_results) -
+                               count_tokens(prompt_test) - count_tokens(prompt_test_results))
+    instructions = f'''You are a senior software engineer helping a junior engineer fix some code that is failing.
+You are given the documentation of one of the functions they were assigned to write, followed by the function they wrote, the unit tests they wrote for it, and the unit test results.
+The rest of `{meta.filename}.py` and `{meta.filename}_test.py` is not shown and is not yours to change, only respond with the imports, the function, the classes it uses and its unit tests.
+Focus on just fixing the mistakes in the code and unit tests as necessary, trying to do the less number of changes.
+Do not write new unit tests, just fix the existing ones.
+{f"The unit tests with a body of `{ELIDED_BODY}` passed and their body was left out, keep them exactly as they are." if len(elided) > 0 else ""}
+{f"Do not make any reference to the function {function_name} in `{meta.filename}_test.py`." if len(fn_meta.void_funcs) > 0 else ""}
+Make sure to produce working code that passes the unit tests.
+Make sure to follow PEP8 style guidelines.
+Make sure to include all needed standard Python libraries imports.
+Generate `requirements.txt` file with all needed dependencies, do not add fixed version to dependencies.
+Your response must not comment on what you changed.
+Your response must not add any additional comments, clarifications, notes, information, explanations, details, examples or thoughts.'''
+    user_request = f'''{spec}
 
-# {code_file}
+# {meta.filename}.py
 
 ```py
-{code}
+{fn_code}
 ```
 
 # requirements.txt
@@ -459,56 +682,159 @@ The desired response must look like the following:
 {requirements if requirements is not None else ''}
 ```
 
-# {test_file}
+# {meta.filename}_test.py
 
 ```py
-{test}
+{prompt_test}
 ```
 
 # Test Results
 
-{test_results}''')
-        # The output should be a valid Markdown document. Parse it and return the parsed doc, on failure
-        # try again (or fully error out, for now)
+{prompt_test_results}'''
+    files = {
+        f'{meta.filename}.py': fn_code,
+        'requirements.txt': requirements,
+        f'{meta.filename}_test.py': prompt_test,
+    }
+    fixed = None
+    if patcher.enabled:
+        patched = await patch_files(instructions, user_request, files, 'third_stage', model='gpt-4', debug=debug)
+        fixed = {**files, **patched} if patched is not None else None
+    if fixed is None:
+        gpt_fix = ChatGPTMapper(f'''{instructions}
+Your response must be a markdown file.
+The first section header must be the filename `{meta.filename}.py`.
+The content of the first section must be a python code block with the fixed function.
+The second section header must be the filename `requirements.txt`.
+The content of the second section must be a text code block with the generated code.
+The third section header must be the filename `{meta.filename}_test.py`.
+The content of the third section must be a python code block with the fixed unit tests.
+The file should end with the code block, nothing else should be added to the file.
+The desired response must look like the following:
+
+# {meta.filename}.py
+
+```py
+<fixed code>
+```
+
+# requirements.txt
+
+```txt
+<dependencies needed>
+```
+
+# {meta.filename}_test.py
+
+```py
+<fixed code>
+```
+
+''', model='gpt-4', stats_stage='third_stage',
+                                structure=lambda: MarkdownStructure([f'{meta.filename}.py', 'requirements.txt', f'{meta.filename}_test.py'],
+                                                                    optional=['requirements.txt']))
+        fixed_code = await gpt_fix.run(user_request)
+        if not validate_first_stage_markdown(fixed_code, meta.filename):
+            if debug:
+                print(f'''[Third stage] Invalid fix for {function_name}:
+{fixed_code}''')
+            gpt_fix.invalidate_cache()
+            return None
+        fixed = read_markdown_files(fixed_code)
+    if f'{meta.filename}_test.py' in fixed:
+        fixed[f'{meta.filename}_test.py'] = restore_elided_tests(
+            fixed[f'{meta.filename}_test.py'], fn_test, elided)
+    return fixed
+
+
+async def fix_functions(meta: MarshaMeta, localized: dict[str, list[str]], code_file: str, test_file: str,
+                        req_file: str, workspace: Workspace, results: TestResults, debug: bool = False) -> list[str]:
+    """Fixes every failing function at once and splices the fixed functions and tests back into the files"""
+    code = workspace.read(code_file)
+    test = workspace.read(test_file)
+    requirements = workspace.read(req_file) if req_file is not None else None
+    fixes = await asyncio.gather(*[fix_function(meta, function_name, test_cases, code, test, requirements, results,
+                                                debug) for (function_name, test_cases) in localized.items()])
+    for (function_name, fixed) in zip(localized, fixes):
+        if fixed is None:
+            continue
         try:
-            # Some validation that the generated file matches the expected format of:
-            # # function_name.py
-            # ```py
-            # <insert code here>
-            # ```
-            # # requirements.txt
-            # ```txt
-            # <dependency>
-            # ```
-            # # function_name_test.py
-            # ```py
-            # <insert code here>
-            # ```
-            if not validate_first_stage_markdown(fixed_code, meta.filename):
-                raise Exception('Invalid output format')
-            subdir = '/'.join(code_file.split('/')[:-1])
-            files = write_files_from_markdown(fixed_code, subdir=subdir)
-        except Exception:
-            if retries == 0:
-                raise Exception('Failed to fix code', meta.filename)
+            code = merge_modules(code, fixed.get(f'{meta.filename}.py') or '')
+            test = merge_modules(
+                test, fixed.get(f'{meta.filename}_test.py') or '')
+        except SyntaxError:
+            # The tests will fail again and the next pass gets another try at it
+            if debug:
+                print(
+                    f'[Third stage] The fix for {function_name} is not valid Python')
+            continue
+        requirements = merge_requirements(
+            requirements or '', fixed.get('requirements.txt') or '')
+    subdir = '/'.join(code_file.split('/')[:-1])
+    workspace.write(code_file, code)
+    workspace.write(test_file, test)
+    if (requirements or '').strip() != '':
+        workspace.write(f'{subdir}/requirements.txt', requirements)
+        return [code_file, test_file, f'{subdir}/requirements.txt']
+    return [code_file, test_file]
+
+
+async def speculative_func_to_python(meta: MarshaMeta, n_results: int, debug: bool = False):
+    # Generate the code alongside the sanity check instead of after it, the check almost always passes. The
+    # generation is tracked as its own stats stage until then, so a failed check shows what it wasted. The
+    # candidates that arrive before the check passes are held back until it does
+    queue = asyncio.Queue()
+    finished = object()
+
+    async def generate():
+        try:
+            async for md in gpt_func_to_python(meta, n_results, debug=debug, stats_stage='speculative'):
+                queue.put_nowait(md)
+        finally:
+            queue.put_nowait(finished)
 
-        # We figure out if this pass has succeeded by re-running the tests recursively, where it
-        # ejects from the iteration if the tests pass
-        return await test_and_fix_files(meta, files, retries - 1, debug)
-    elif test_results is None:  # If the test suite failed to run, we try again
-        return await test_and_fix_files(meta, files, retries - 1, debug)
+    generation = asyncio.create_task(generate())
+    checked = False
+    try:
+        can_func = await gpt_can_func_python(meta, n_results)
+        if not can_func:
+            generation.cancel()
+            await asyncio.gather(generation, return_exceptions=True)
+            await gpt_improve_func(meta)
+            sys.exit(1)
+        checked = True
+        while True:
+            md = await queue.get()
+            if md is finished:
+                break
+            yield md
+        generation.result()
+    finally:
+        if not generation.done():
+            generation.cancel()
+            await asyncio.gather(generation, return_exceptions=True)
+        # Only once the check passed was the generation needed, otherwise its cost stays in the speculative stage
+        if checked:
+            get_stats().merge_stage('speculative', 'first_stage')
 
 
-async def generate_python_code(args, meta: MarshaMeta, n_results: int, debug: bool) -> list[str]:
+async def generate_python_code(args, meta: MarshaMeta, n_results: int, debug: bool):
+    """Yields the first stage candidates as they become available"""
     t1 = time.time()
     print('Generating Python code...')
-    mds = None
+    candidates = None
     try:
-        if not args.exclude_sanity_check:
+        if args.exclude_sanity_check:
+            candidates = gpt_func_to_python(meta, n_results, debug=debug)
+        elif args.speculative:
+            candidates = speculative_func_to_python(meta, n_results, debug)
+        else:
             if not await gpt_can_func_python(meta, n_results):
                 await gpt_improve_func(meta)
                 sys.exit(1)
-        mds = await gpt_func_to_python(meta, n_results, debug=debug)
+            candidates = gpt_func_to_python(meta, n_results, debug=debug)
+        async for md in candidates:
+            yield md
     except Exception as e:
         print('First stage failure')
         print(e)
@@ -517,45 +843,47 @@ async def generate_python_code(args, meta: MarshaMeta, n_results: int, debug: bo
         print('Retrying...')
         raise e
     finally:
+        if candidates is not None:
+            await candidates.aclose()
         t2 = time.time()
-        stats.first_stage.total_time = prettify_time_delta(
-            t2 - t1)
-    return mds
+        get_stats().time_update('first_stage', t2 - t1)
 
 
-async def review_and_fix(args, meta: MarshaMeta, files: list[str], debug: bool = False):
+async def review_and_fix(args, meta: MarshaMeta, files: list[str], workspace: Workspace, debug: bool = False):
     t_ssi = time.time()
     print('Parsing generated code...')
     try:
-        await lint_and_fix_files(meta.filename, files, debug=debug)
+        with tracer.span('second stage', 'stage'):
+            await lint_and_fix_files(meta.filename, files, workspace, debug=debug)
     except Exception as e:
         print('Second stage failure')
         print(e)
         raise e
     finally:
         t_ssii = time.time()
-        stats.second_stage.total_time = prettify_time_delta(
-            t_ssii - t_ssi)
+        get_stats().time_update('second_stage', t_ssii - t_ssi)
     if args.debug:
         for file in files:
-            print(f'# {file}\n{read_file(file)}\n')
+            print(f'# {file}\n{workspace.read(file)}\n')
     t_tsi = time.time()
     print('Verifying and correcting generated code...')
     try:
-        await test_and_fix_files(meta, files, debug=debug)
+        with tracer.span('third stage', 'stage'):
+            await test_and_fix_files(meta, files, workspace, debug=debug)
     except Exception as e:
         print('Third stage failure')
         print(e)
         raise e
     finally:
         t_tsii = time.time()
-        stats.third_stage.total_time = prettify_time_delta(
-            t_tsii - t_tsi)
+        get_stats().time_update('third_stage', t_tsii - t_tsi)
     if args.debug:
         for file in files:
-            print(f'# {file}\n{read_file(file)}\n')
+            print(f'# {file}\n{workspace.read(file)}\n')
     print('Formatting code...')
-    autoformat_files(files)
+    with tracer.span('autoformat', 'format'):
+        for file in files:
+            workspace.write(file, autopep8.fix_code(workspace.read(file)))
     if args.debug:
         for file in files:
-            print(f'# {file}\n{read_file(file)}\n')
+            print(f'# {file}\n{workspace.read(file)}\n')
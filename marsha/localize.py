@@ -0,0 +1,62 @@
+import copy
+import os
+import re
+
+from marsha.manifest import references
+from marsha.meta import MarshaMeta
+from marsha.shards import TestResults
+from marsha.splice import find_class_for_type, map_test_cases, split_module
+
+FRAME_PATTERN = re.compile(r'^\s*File "([^"]+)", line \d+, in (\w+)', re.M)
+
+
+def find_responsible_function(traceback: str, code_file: str, function_names: list[str]) -> str:
+    # The innermost frame in the generated code that is one of the spec functions, a failing test of one function
+    # can be caused by another one it calls
+    frames = [name for (path, name) in FRAME_PATTERN.findall(traceback)
+              if os.path.basename(path) == os.path.basename(code_file) and name in function_names]
+    return frames[-1] if len(frames) > 0 else None
+
+
+def localize_failures(results: TestResults, test: str, code: str, code_file: str,
+                      function_names: list[str]) -> dict[str, list[str]]:
+    """Maps every function with a failing test to the test cases to fix it with, its own and the failing ones that
+    lead to it. `None` when a failure can't be pinned on a single function, like when the test file didn't load"""
+    try:
+        test_cases = map_test_cases(test, function_names)
+        definitions = set([name for (kind, name, _) in split_module(
+            code) if kind == 'definition'])
+    except SyntaxError:
+        return None
+    localized = {}
+    for result in results.results:
+        if result['status'] in ['pass', 'skip']:
+            continue
+        if result['class'] is None:
+            return None
+        function_name = find_responsible_function(
+            result['traceback'], code_file, function_names) or test_cases.get(result['class'])
+        if function_name is None or function_name not in definitions:
+            return None
+        localized.setdefault(function_name, set()).add(result['class'])
+    return {function_name: sorted(classes | set([test_case for (test_case, tested) in test_cases.items()
+                                                 if tested == function_name]))
+            for (function_name, classes) in localized.items()}
+
+
+def function_meta(meta: MarshaMeta, function_name: str) -> MarshaMeta:
+    """The part of the spec for one function, with the types it references"""
+    function_meta = copy.copy(meta)
+    function_meta.functions = [
+        func for func in meta.functions if meta.spec.function(func).name == function_name]
+    function_meta.void_funcs = [
+        func for func in meta.void_funcs if meta.spec.function(func).name == function_name]
+    source = (function_meta.functions + function_meta.void_funcs)[0]
+    types = [t for t in meta.types or [] if references(
+        source, meta.spec.type(t).name)]
+    function_meta.types = types if len(types) > 0 else None
+    return function_meta
+
+
+def get_type_classes(meta: MarshaMeta, code: str) -> set[str]:
+    return set([find_class_for_type(code, meta.spec.type(t).name) for t in meta.types or []]) - set([None])
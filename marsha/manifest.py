@@ -0,0 +1,155 @@
+import copy
+import json
+import os
+import re
+
+from marsha.cache import hash_content
+from marsha.meta import MarshaMeta
+from marsha.splice import remove_definitions, find_class_for_type, map_test_cases, merge_modules, split_module
+from marsha.utils import read_file, write_file
+
+MANIFEST_VERSION = 1
+
+
+def fingerprint(section: str) -> str:
+    # Whitespace-only edits should not trigger a rebuild
+    return hash_content(' '.join(section.split()))
+
+
+def references(section: str, name: str) -> bool:
+    return re.search(rf'\b{re.escape(name)}\b', section) is not None
+
+
+def get_sections(meta: MarshaMeta) -> tuple[dict[str, str], dict[str, str]]:
+    functions = {meta.spec.function(
+        func).name: func for func in meta.functions + meta.void_funcs}
+    types = {meta.spec.type(
+        t).name: t for t in meta.types} if meta.types is not None else {}
+    return (functions, types)
+
+
+def merge_requirements(*requirements: str) -> str:
+    lines = []
+    for reqs in requirements:
+        for line in reqs.split('\n'):
+            line = line.strip()
+            if len(line) > 0 and line not in lines:
+                lines.append(line)
+    return '\n'.join(lines)
+
+
+def splice_code(generated: str, verified: str) -> str:
+    try:
+        # Verified definitions go first, since new ones may depend on them at import time, and win over any
+        # regenerated copy of them
+        verified_names = {name for (kind, name, _) in split_module(
+            verified) if kind == 'definition'}
+        return merge_modules(verified, remove_definitions(generated, verified_names))
+    except SyntaxError:
+        # The linting stage will take care of the generated code, later definitions win in the meantime
+        return f'{generated}\n\n{verified}'
+
+
+class BuildManifest:
+    """Fingerprints of each function and type of a Marsha file alongside the code verified for them"""
+
+    def __init__(self, filename: str, functions: dict[str, str], types: dict[str, str], code: str, test: str, requirements: str, directory: str = '.'):
+        self.filename = filename
+        self.directory = directory
+        self.functions = functions
+        self.types = types
+        self.code = code
+        self.test = test
+        self.requirements = requirements
+
+    @staticmethod
+    def get_path(filename: str, directory: str = '.') -> str:
+        return os.path.join(directory, f'{filename}.manifest.json')
+
+    @classmethod
+    def load(cls, filename: str, directory: str = '.'):
+        path = BuildManifest.get_path(filename, directory)
+        if not os.path.exists(path):
+            return None
+        try:
+            data = json.loads(read_file(path))
+        except Exception:
+            print(f'Ignoring invalid build manifest {path}')
+            return None
+        if data.get('version') != MANIFEST_VERSION:
+            return None
+        return cls(filename, data['functions'], data['types'], data['code'], data['test'], data['requirements'], directory)
+
+    @classmethod
+    def from_meta(cls, meta: MarshaMeta, code: str, test: str, requirements: str, directory: str = '.'):
+        functions, types = get_sections(meta)
+        return cls(meta.filename, {name: fingerprint(func) for (name, func) in functions.items()},
+                   {name: fingerprint(t) for (name, t) in types.items()}, code, test, requirements, directory)
+
+    def save(self):
+        write_file(BuildManifest.get_path(self.filename, self.directory), json.dumps({
+            'version': MANIFEST_VERSION,
+            'functions': self.functions,
+            'types': self.types,
+            'code': self.code,
+            'test': self.test,
+            'requirements': self.requirements,
+        }, indent=2))
+
+    def plan(self, meta: MarshaMeta):
+        """Figures out which functions and types need to be regenerated, or `None` if nothing can be reused"""
+        functions, types = get_sections(meta)
+        dirty_types = {name for (name, t) in types.items()
+                       if self.types.get(name) != fingerprint(t)}
+        dirty_functions = {name for (name, func) in functions.items()
+                           if self.functions.get(name) != fingerprint(func)}
+        removed_types = set(self.types) - set(types)
+        removed_functions = set(self.functions) - set(functions)
+        # Functions referencing anything that changed have to be regenerated and re-tested, too
+        changed = dirty_types | removed_types | dirty_functions | removed_functions
+        while True:
+            new_dirty = {name for (name, func) in functions.items() if name not in dirty_functions and any(
+                [references(func, other) for other in changed if other != name])}
+            if len(new_dirty) == 0:
+                break
+            dirty_functions = dirty_functions | new_dirty
+            changed = changed | new_dirty
+        if len(dirty_functions) == len(functions) and len(dirty_types) == len(types):
+            return None
+        return IncrementalPlan(self, meta, dirty_functions, dirty_types, removed_functions, removed_types)
+
+
+class IncrementalPlan:
+    def __init__(self, manifest: BuildManifest, meta: MarshaMeta, dirty_functions: set[str], dirty_types: set[str], removed_functions: set[str], removed_types: set[str]):
+        self.manifest = manifest
+        self.dirty_functions = dirty_functions
+        self.dirty_types = dirty_types
+        stale_functions = dirty_functions | removed_functions
+        stale_classes = {find_class_for_type(manifest.code, name)
+                         for name in dirty_types | removed_types} - {None}
+        stale_tests = {test_case for (test_case, func) in map_test_cases(
+            manifest.test, list(manifest.functions)).items() if func in stale_functions}
+        self.code = remove_definitions(
+            manifest.code, stale_functions | stale_classes)
+        self.test = remove_definitions(manifest.test, stale_tests)
+        self.requirements = manifest.requirements
+        # Only the dirty functions are sent to the LLM, with the verified code as context
+        self.meta = copy.copy(meta)
+        self.meta.functions = [func for func in meta.functions if meta.spec.function(
+            func).name in dirty_functions]
+        self.meta.void_funcs = [func for func in meta.void_funcs if meta.spec.function(
+            func).name in dirty_functions]
+        dirty_type_defs = [t for t in meta.types or []
+                           if meta.spec.type(t).name in dirty_types]
+        self.meta.types = dirty_type_defs if len(dirty_type_defs) > 0 else None
+        self.meta.existing_code = self.code
+
+    @property
+    def up_to_date(self) -> bool:
+        return len(self.dirty_functions) == 0 and len(self.dirty_types) == 0
+
+    def splice_code(self, generated: str) -> str:
+        return splice_code(generated, self.code)
+
+    def splice_test(self, generated: str) -> str:
+        return splice_code(generated, self.test)
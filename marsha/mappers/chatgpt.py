@@ -1,46 +1,131 @@
+import asyncio
 import openai
 import time
 
+from openai.util import convert_to_openai_object
+
+from marsha.cache import completion_cache
 from marsha.mappers.base import BaseMapper
-from marsha.stats import stats
+from marsha.ratelimit import rate_limiters, llm_call_limit, estimate_query_tokens, backoff_delay, get_retry_after, DEFAULT_COMPLETION_TOKENS
+from marsha.stats import get_stats
+from marsha.tokens import estimate_tokens, estimate_messages_tokens
+from marsha.trace import tracer
 from marsha.utils import prettify_time_delta
 
 # Get time at startup to make human legible "start times" in the logs
 t0 = time.time()
 
 
-async def retry_chat_completion(query, model='gpt-3.5-turbo', max_tries=3, n_results=1):
+async def stream_chat_completion(query, structure, on_choice=None):
+    """Streams the completion, checking every choice with its own `structure()` as the tokens arrive.
+
+    The request is cancelled once every unfinished choice is provably malformed, and those choices get an
+    `aborted` finish reason. Every other choice is passed to `on_choice` as soon as it is complete. Streamed
+    responses have no usage, so it is estimated."""
+    n_results = query.get('n', 1)
+    contents = [''] * n_results
+    finish_reasons = [None] * n_results
+    checks = [structure() for _ in range(n_results)]
+    model = query['model']
+    response = await openai.ChatCompletion.acreate(stream=True, **query)
+    try:
+        async for chunk in response:
+            model = chunk.get('model', model)
+            for choice in chunk.choices:
+                content = choice.delta.get('content')
+                if content is not None:
+                    contents[choice.index] = contents[choice.index] + content
+                    checks[choice.index].feed(content)
+                if choice.finish_reason is not None:
+                    finish_reasons[choice.index] = choice.finish_reason
+                    # Check the last line, too
+                    checks[choice.index].feed('\n')
+                    if on_choice is not None:
+                        on_choice(choice.index, contents[choice.index])
+            unfinished = [i for i in range(n_results)
+                          if finish_reasons[i] is None]
+            if len(unfinished) > 0 and all([not checks[i].valid for i in unfinished]):
+                for i in unfinished:
+                    finish_reasons[i] = 'aborted'
+                break
+    finally:
+        if hasattr(response, 'aclose'):
+            await response.aclose()
+    prompt_tokens = estimate_messages_tokens(query['messages'])
+    completion_tokens = sum([estimate_tokens(content)
+                            for content in contents])
+    return convert_to_openai_object({
+        'object': 'chat.completion',
+        'model': model,
+        'choices': [{
+            'index': i,
+            'message': {'role': 'assistant', 'content': contents[i]},
+            'finish_reason': finish_reasons[i],
+        } for i in range(n_results)],
+        'usage': {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+        },
+    })
+
+
+async def retry_chat_completion(query, model='gpt-3.5-turbo', max_tries=3, n_results=1, structure=None, on_choice=None):
     t1 = time.time()
     query['model'] = model
     query['n'] = n_results
+    attempt = 0
     while True:
+        limiter = rate_limiters.get(query['model'])
+        estimated_tokens = estimate_query_tokens(query)
+        await limiter.acquire(estimated_tokens)
         try:
-            out = await openai.ChatCompletion.acreate(**query)
+            async with llm_call_limit:
+                if structure is not None:
+                    out = await stream_chat_completion(query, structure, on_choice)
+                else:
+                    out = await openai.ChatCompletion.acreate(**query)
             t2 = time.time()
+            limiter.reconcile(estimated_tokens, out.get(
+                'usage', {}).get('total_tokens', estimated_tokens))
             print(
                 f'''Chat query took {prettify_time_delta(t2 - t1)}, started at {prettify_time_delta(t1 - t0)}, ms/chars = {(t2 - t1) * 1000 / out.get('usage', {}).get('total_tokens', 9001)}''')
             return out
         except openai.error.InvalidRequestError as e:
+            limiter.reconcile(estimated_tokens, 0)
+            max_tries = max_tries - 1
+            if max_tries == 0:
+                raise e
             if e.code == 'context_length_exceeded':
-                # Try to cover up this error by choosing the bigger, more expensive model
+                # Try to cover up this error by choosing the bigger, more expensive model, no need to wait for that
                 query['model'] = 'gpt-4'
+                continue
+            await asyncio.sleep(backoff_delay(attempt))
+        except openai.error.RateLimitError as e:
+            limiter.reconcile(estimated_tokens, 0)
             max_tries = max_tries - 1
             if max_tries == 0:
                 raise e
-            time.sleep(3 / max_tries)
+            delay = backoff_delay(attempt, get_retry_after(e))
+            limiter.pause(delay)
+            await asyncio.sleep(delay)
         except Exception as e:
+            limiter.reconcile(estimated_tokens, 0)
             max_tries = max_tries - 1
             if max_tries == 0:
                 raise e
-            time.sleep(3 / max_tries)
-        if max_tries == 0:
-            raise Exception('Could not execute chat completion')
+            await asyncio.sleep(backoff_delay(attempt, get_retry_after(e)))
+        attempt = attempt + 1
 
 
 class ChatGPTMapper(BaseMapper):
     """ChatGPT-based mapper class"""
 
-    def __init__(self, system, model='gpt-3.5-turbo', max_tokens=None, max_retries=3, n_results=1, stats_stage=None):
+    # Stream the responses that have an expected `structure`, aborting malformed ones early
+    stream = False
+
+    def __init__(self, system, model='gpt-3.5-turbo', max_tokens=None, max_retries=3, n_results=1, stats_stage=None,
+                 structure=None, cache_variant=0):
         BaseMapper.__init__(self)
         self.system = system
         self.model = model
@@ -48,8 +133,15 @@ class ChatGPTMapper(BaseMapper):
         self.max_retries = max_retries
         self.n_results = n_results
         self.stats_stage = stats_stage
+        self.structure = structure
+        self.cache_variant = cache_variant
+        self.cache_key = None
+
+    async def transform(self, user_request, on_choice=None):
+        with tracer.span('chat completion', 'llm', stage=self.stats_stage, model=self.model, n=self.n_results) as span:
+            return await self.complete(user_request, on_choice, span)
 
-    async def transform(self, user_request):
+    async def complete(self, user_request, on_choice, span):
         query_obj = {
             'messages': [{
                 'role': 'system',
@@ -61,9 +153,76 @@ class ChatGPTMapper(BaseMapper):
         }
         if self.max_tokens is not None:
             query_obj['max_tokens'] = self.max_tokens
-        res = await retry_chat_completion(query_obj, self.model, self.max_retries, self.n_results)
+        self.cache_key = completion_cache.key(
+            self.system, user_request, self.model, self.n_results, self.max_tokens, self.cache_variant)
+        # Every usable choice goes to `on_choice` once, streamed ones as soon as they finish
+        emitted = set()
 
-        if self.stats_stage is not None:
-            stats.stage_update(self.stats_stage, [res])
+        def emit(index, content):
+            if on_choice is not None and index not in emitted:
+                emitted.add(index)
+                on_choice(content)
+
+        res = completion_cache.get(self.cache_key)
+        if res is not None:
+            span.tag(cached=True)
+            if self.stats_stage is not None:
+                get_stats().stage_update(self.stats_stage, [res], cached=True)
+        else:
+            structure = self.structure if ChatGPTMapper.stream else None
+            try:
+                res = await retry_chat_completion(query_obj, self.model, self.max_retries, self.n_results, structure,
+                                                  emit)
+            except asyncio.CancelledError as e:
+                if self.stats_stage is not None:
+                    get_stats().cancel_update(self.stats_stage, self.model, estimate_messages_tokens(
+                        query_obj['messages']))
+                raise e
+            aborted = [
+                choice for choice in res.choices if choice.finish_reason == 'aborted']
+            # Aborted responses are incomplete, so they are never cached
+            if len(aborted) == 0:
+                completion_cache.set(self.cache_key, res)
+
+            if self.stats_stage is not None:
+                get_stats().stage_update(self.stats_stage, [res])
+                if len(aborted) > 0:
+                    get_stats().abort_update(self.stats_stage, [estimate_tokens(
+                        choice.message.content) for choice in aborted], self.expected_tokens(res))
+
+        for choice in res.choices:
+            if choice.finish_reason != 'aborted':
+                emit(choice.index, choice.message.content)
 
         return [choice.message.content for choice in res.choices] if self.n_results > 1 else res.choices[0].message.content
+
+    async def run_choices(self, user_request):
+        """Yields each choice of the response as soon as it is complete, so with streaming the first ones to finish
+        don't wait for the rest"""
+        queue = asyncio.Queue()
+        finished = object()
+        task = asyncio.create_task(self.transform(
+            user_request, on_choice=queue.put_nowait))
+        task.add_done_callback(lambda _: queue.put_nowait(finished))
+        try:
+            while True:
+                content = await queue.get()
+                if content is finished:
+                    break
+                yield content
+            self.output = task.result()
+        finally:
+            if not task.done():
+                task.cancel()
+
+    def expected_tokens(self, res) -> int:
+        # How long an aborted choice would have been, judging by the ones that finished
+        finished = [estimate_tokens(choice.message.content)
+                    for choice in res.choices if choice.finish_reason != 'aborted']
+        if len(finished) > 0:
+            return max(finished)
+        return self.max_tokens if self.max_tokens is not None else DEFAULT_COMPLETION_TOKENS
+
+    def invalidate_cache(self):
+        # Drop the last response from the cache when it turned out to be unusable, so a retry asks the LLM again
+        completion_cache.invalidate(self.cache_key)
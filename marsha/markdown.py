@@ -0,0 +1,109 @@
+import hashlib
+
+from collections import OrderedDict
+from mistletoe import Document, ast_renderer
+
+# Enough for the functions and types of a large spec and the responses of every candidate in flight
+DEFAULT_MAX_SIZE = 512
+
+
+class MarkdownCache:
+    """Parsed markdown documents keyed by the hash of their source, so the spec sections and the LLM responses
+    that go through several validation and extraction helpers are only parsed once. The least recently used
+    documents are dropped past `max_size`.
+
+    The parsed documents are shared, so they must not be modified."""
+
+    def __init__(self, max_size: int = DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.documents = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, md: str) -> dict:
+        key = hashlib.sha256(md.encode('utf-8')).digest()
+        document = self.documents.get(key)
+        if document is not None:
+            self.hits = self.hits + 1
+            self.documents.move_to_end(key)
+            return document
+        self.misses = self.misses + 1
+        document = ast_renderer.get_ast(Document(md))
+        self.documents[key] = document
+        if len(self.documents) > self.max_size:
+            self.documents.popitem(last=False)
+        return document
+
+    def clear(self):
+        self.documents.clear()
+
+
+markdown_cache = MarkdownCache()
+
+
+def parse_markdown(md: str) -> dict:
+    return markdown_cache.get(md)
+
+
+def to_markdown(node):
+    # Technically I should iterate on the `children` lists every time because they could have more
+    # than one, but since this is hardwired for each node type, I'm just going to use the actual
+    # implementations to skip that when possible to reduce recursion depth and simplify the code
+    if node['type'] == 'AutoLink':
+        return f'''[{node['children'][0]['content']}]'''
+    if node['type'] == 'BlockCode':
+        return '\n'.join([f'''    {line}''' for line in node['children'][0].split('\n')])
+    if node['type'] == 'CodeFence':
+        return f'''```{node['language']}
+{node['children'][0]['content']}
+```'''
+    if node['type'] == 'Document':
+        return ''.join([to_markdown(child) for child in node['children']])
+    if node['type'] == 'Emphasis':
+        return f'''*{node['children'][0]['content']}*'''
+    if node['type'] == 'EscapeSequence':
+        return f'''\\{node['children'][0]['content']}'''
+    if node['type'] == 'Heading':
+        return ('#' * node['level']) + ' ' + ''.join([to_markdown(child) for child in node['children']])
+    if node['type'] == 'Image':
+        if len(node['title']['children'][0]['content']) > 0:
+            return f'''![{''.join([to_markdown(child) for child in node['children']])}]({node['src']['children'][0]['content']} "{node['title']['children'][0]['content']}")'''
+        else:
+            return f'''![{''.join([to_markdown(child) for child in node['children']])}]({node['src']['children'][0]['content']})'''
+    if node['type'] == 'InlineCode':
+        return f'''`{node['children'][0]['content']}`'''
+    if node['type'] == 'LineBreak':
+        return '\n'
+    if node['type'] == 'Link':
+        if len(node['title']['children'][0]['content']) > 0:
+            return f'''[{''.join([to_markdown(child) for child in node['children']])}]({node['src']['children'][0]['content']} "{node['title']['children'][0]['content']}")'''
+        else:
+            return f'''[{''.join([to_markdown(child) for child in node['children']])}]({node['src']['children'][0]['content']})'''
+    if node['type'] == 'List':
+        if node['start'] is not None:
+            return '\n'.join([f'''{i}. {text}''' for (i, text) in enumerate([to_markdown(child) for child in node['children']])])
+        else:
+            return '\n'.join([f'''* {to_markdown(child)}''' for child in node['children']])
+    if node['type'] == 'ListItem':
+        return ''.join([to_markdown(child) for child in node['children']])
+    if node['type'] == 'Paragraph':
+        return ''.join([to_markdown(child) for child in node['children']])
+    if node['type'] == 'Quote':
+        return '\n'.join([f'''> {to_markdown(child)}''' for child in node['children']])
+    if node['type'] == 'RawText':
+        return node['content']
+    if node['type'] == 'SetextHeading':
+        raise NotImplementedError()
+    if node['type'] == 'Strikethrough':
+        return f'''~~{node['children'][0]['content']}~~'''
+    if node['type'] == 'Strong':
+        return f'''**{node['children'][0]['content']}**'''
+    if node['type'] == 'Table':
+        raise NotImplementedError()
+    if node['type'] == 'TableCell':
+        raise NotImplementedError()
+    if node['type'] == 'TableRow':
+        raise NotImplementedError()
+    if node['type'] == 'ThematicBreak':
+        return '\n---\n'
+    raise Exception(f'''Unknown AST node {node['type']} encountered!''')
@@ -1,7 +1,7 @@
 # -*- mode: python ; coding: utf-8 -*-
 from PyInstaller.utils.hooks import collect_all
 
-datas = [('../examples', './examples'), ('./helper.py', './marsha')]
+datas = [('../examples', './examples'), ('./helper.py', './marsha'), ('./test_worker.py', './marsha'), ('./test_runner.py', './marsha')]
 binaries = []
 hiddenimports = []
 tmp_ret = collect_all('pyflakes')
@@ -12,8 +12,6 @@ tmp_ret = collect_all('pycodestyle')
 datas += tmp_ret[0]; binaries += tmp_ret[1]; hiddenimports += tmp_ret[2]
 tmp_ret = collect_all('pydocstyle')
 datas += tmp_ret[0]; binaries += tmp_ret[1]; hiddenimports += tmp_ret[2]
-tmp_ret = collect_all('pylama')
-datas += tmp_ret[0]; binaries += tmp_ret[1]; hiddenimports += tmp_ret[2]
 
 
 block_cipher = None
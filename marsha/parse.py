@@ -1,53 +1,22 @@
 import os
+import re
 
-from mistletoe import Document, ast_renderer
-
-from marsha.meta import MarshaMeta, to_markdown
+from marsha.markdown import parse_markdown
+from marsha.meta import MarshaMeta
+from marsha.trace import tracer
 from marsha.utils import write_file
 
 
 def format_marsha_for_llm(meta: MarshaMeta):
     break_line = '\n'
     res = [f'# Requirements for file `{meta.filename}`']
-    for func in meta.functions + meta.void_funcs:
-        ast = ast_renderer.get_ast(Document(func))
-        if ast['children'][0]['type'] != 'Heading':
-            raise Exception('Invalid Marsha function')
-        name = ''
-        args = []
-        ret = ''
-        desc_parts = []
-        reqs = ''
-        list_started = False
-        for (i, child) in enumerate(ast['children']):
-            if i == 0:
-                # Special handling for the initial header (for now)
-                if child['type'] != 'Heading':
-                    raise Exception('Invalid Marsha function')
-                header = child['children'][0]['content']
-                name = header.split('(')[0].split('func')[1].strip()
-                args = [arg.strip()
-                        for arg in header.split('(')[1].split(')')[0].split(',')]
-                end = header.split('):')
-                if len(end) == 1:
-                    ret = 'None'
-                else:
-                    ret = header.split('):')[1].strip()
-                continue
-            if child['type'] == 'List':
-                list_started = True
-                reqs = to_markdown(child)
-                continue
-            if list_started:
-                raise Exception(
-                    'Function description must come *before* usage examples')
-            desc_parts.append(to_markdown(child))
-        desc = '\n\n'.join(desc_parts)
-
+    for source in meta.functions + meta.void_funcs:
+        func = meta.spec.function(source)
+        reqs = func.format_examples()
         arg_fmt = '\n'.join(
-            [f'{i + 1}. {arg}' for (i, arg) in enumerate(args)])
+            [f'{i + 1}. {arg.type}' for (i, arg) in enumerate(func.args)])
 
-        fn_def = f'''## Requirements for function `{name}`
+        fn_def = f'''## Requirements for function `{func.name}`
 
 ### Inputs
 
@@ -55,11 +24,11 @@ def format_marsha_for_llm(meta: MarshaMeta):
 
 ### Output
 
-{ret}
+{func.returns if func.returns is not None else 'None'}
 
 ### Description
 
-{desc}
+{func.description}
 
 {f"""### Examples of expected behavior
 
@@ -78,7 +47,7 @@ def format_marsha_for_llm(meta: MarshaMeta):
 
 # TODO: Potentially re-org this so the stages are together?
 def validate_first_stage_markdown(md, marsha_filename):
-    ast = ast_renderer.get_ast(Document(md))
+    ast = parse_markdown(md)
     if len(ast['children']) != 4 and len(ast['children']) != 6:
         return False
     if len(ast['children']) == 4:
@@ -116,8 +85,34 @@ def validate_first_stage_markdown(md, marsha_filename):
     return True
 
 
+def validate_code_markdown(md, marsha_filename):
+    # The code half of the first stage, with an optional requirements section
+    ast = parse_markdown(md)
+    if len(ast['children']) != 2 and len(ast['children']) != 4:
+        return False
+    if ast['children'][0]['type'] != 'Heading':
+        return False
+    if ast['children'][1]['type'] != 'CodeFence':
+        return False
+    if ast['children'][0]['children'][0]['content'].strip() != f'{marsha_filename}.py':
+        return False
+    if len(ast['children']) == 4:
+        if ast['children'][2]['type'] != 'Heading':
+            return False
+        if ast['children'][3]['type'] != 'CodeFence':
+            return False
+        if ast['children'][2]['children'][0]['content'].strip() != 'requirements.txt':
+            return False
+    return True
+
+
+def validate_test_markdown(md, marsha_filename):
+    # The test half of the first stage
+    return validate_second_stage_markdown(md, f'{marsha_filename}_test.py')
+
+
 def validate_second_stage_markdown(md, filename):
-    ast = ast_renderer.get_ast(Document(md))
+    ast = parse_markdown(md)
     if len(ast['children']) != 2:
         return False
     if ast['children'][0]['type'] != 'Heading':
@@ -129,8 +124,109 @@ def validate_second_stage_markdown(md, filename):
     return True
 
 
-def write_files_from_markdown(md: str, subdir=None) -> list[str]:
-    ast = ast_renderer.get_ast(Document(md))
+def validate_patch_markdown(md, filenames):
+    # Only the files that changed, in the same order as `filenames`
+    ast = parse_markdown(md)
+    if len(ast['children']) == 0 or len(ast['children']) % 2 != 0:
+        return False
+    last = -1
+    for i in range(0, len(ast['children']), 2):
+        if ast['children'][i]['type'] != 'Heading':
+            return False
+        if ast['children'][i + 1]['type'] != 'CodeFence':
+            return False
+        filename = ast['children'][i]['children'][0]['content'].strip()
+        if filename not in filenames or filenames.index(filename) <= last:
+            return False
+        last = filenames.index(filename)
+    return True
+
+
+def read_markdown_files(md: str) -> dict[str, str]:
+    ast = parse_markdown(md)
+    files = {}
+    filename = ''
+    for section in ast['children']:
+        if section['type'] == 'Heading':
+            filename = section['children'][0]['content'].strip()
+        elif section['type'] == 'CodeFence':
+            files[filename] = section['children'][0]['content']
+    return files
+
+
+HEADING_PATTERN = re.compile(r'^ {0,3}#{1,6}[ \t]+(.*?)(?:[ \t]+#+)?[ \t]*$')
+FENCE_PATTERN = re.compile(r'^ {0,3}(`{3,}|~{3,})')
+
+
+class MarkdownStructure:
+    """Incrementally checks a streamed response against the `# filename` headings, each followed by a code
+    block, that the stage validation expects.
+
+    It only rejects a response once no continuation could pass the validation, and accepting it here does
+    not replace running the validation on the full response."""
+
+    def __init__(self, filenames: list[str], optional: list[str] = None):
+        self.filenames = filenames
+        self.optional = optional if optional is not None else []
+        self.section = 0
+        self.state = 'heading'
+        self.fence = None
+        self.buffer = ''
+        self.valid = True
+
+    def feed(self, text: str) -> bool:
+        if not self.valid:
+            return False
+        # Only complete lines can be checked, the rest waits for the next chunk
+        lines = (self.buffer + text).split('\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            if not self.check_line(line):
+                self.valid = False
+                break
+        return self.valid
+
+    def check_line(self, line: str) -> bool:
+        if self.state == 'code':
+            fence = FENCE_PATTERN.match(line)
+            if fence is not None and fence.group(1)[0] == self.fence[0] and len(fence.group(1)) >= len(self.fence) and \
+                    len(line.strip().strip(self.fence[0])) == 0:
+                self.state = 'heading'
+            return True
+        if len(line.strip()) == 0:
+            return True
+        if self.state == 'fence':
+            # Anything between the heading and the code block, like prose, is an extra section
+            fence = FENCE_PATTERN.match(line)
+            if fence is None:
+                return False
+            self.fence = fence.group(1)
+            self.state = 'code'
+            return True
+        heading = HEADING_PATTERN.match(line)
+        if heading is None:
+            return False
+        name = heading.group(1).strip()
+        while self.section < len(self.filenames) and self.filenames[self.section] != name and \
+                self.filenames[self.section] in self.optional:
+            self.section = self.section + 1
+        if self.section >= len(self.filenames) or self.filenames[self.section] != name:
+            return False
+        self.section = self.section + 1
+        self.state = 'fence'
+        return True
+
+
+def write_files_from_markdown(md: str, subdir=None, workspace=None) -> list[str]:
+    """Writes the files in a markdown response, into the `workspace` of a candidate if given instead of to disk"""
+    if workspace is not None:
+        return write_markdown_files(md, subdir, workspace)
+    with tracer.span('write files', 'io'):
+        return write_markdown_files(md, subdir)
+
+
+def write_markdown_files(md: str, subdir=None, workspace=None) -> list[str]:
+    ast = parse_markdown(md)
     filenames = []
     filename = ''
     filedata = ''
@@ -146,6 +242,9 @@ def write_files_from_markdown(md: str, subdir=None) -> list[str]:
                 # If theres not data and we are not going to write the file, we should remove it from the filenames list
                 filenames.pop()
                 continue
+            if workspace is not None:
+                workspace.write(filename, filedata)
+                continue
             if subdir is not None:
                 os.makedirs(os.path.dirname(filename), exist_ok=True)
             write_file(filename, filedata)
@@ -153,7 +252,7 @@ def write_files_from_markdown(md: str, subdir=None) -> list[str]:
 
 
 def extract_func_name(type) -> str:
-    ast = ast_renderer.get_ast(Document(type))
+    ast = parse_markdown(type)
     if ast['children'][0]['type'] != 'Heading':
         raise Exception('Invalid Marsha function')
     header = ast['children'][0]['children'][0]['content']
@@ -0,0 +1,86 @@
+import copy
+
+from marsha.manifest import get_sections, references
+from marsha.meta import MarshaMeta
+from marsha.tokens import count_tokens
+
+# How much of the spec goes into each completion, the code and tests generated for it are a few times bigger
+DEFAULT_GROUP_TOKENS = 1000
+
+
+def find_components(sections: dict[str, str]) -> list[list[str]]:
+    """Groups the functions and types that reference each other, directly or through others, so they are
+    generated together"""
+    parent = {name: name for name in sections}
+
+    def find(name: str) -> str:
+        while parent[name] != name:
+            parent[name] = parent[parent[name]]
+            name = parent[name]
+        return name
+
+    for (name, section) in sections.items():
+        for other in sections:
+            if other != name and references(section, other):
+                parent[find(name)] = find(other)
+    components = {}
+    for name in sections:
+        components.setdefault(find(name), []).append(name)
+    return list(components.values())
+
+
+def group_meta(meta: MarshaMeta, names: set[str]) -> MarshaMeta:
+    grouped = copy.copy(meta)
+    grouped.functions = [
+        func for func in meta.functions if meta.spec.function(func).name in names]
+    grouped.void_funcs = [
+        func for func in meta.void_funcs if meta.spec.function(func).name in names]
+    types = [t for t in meta.types or [] if meta.spec.type(t).name in names]
+    grouped.types = types if len(types) > 0 else None
+    return grouped
+
+
+class Partitioner:
+    """Splits a spec into groups of functions and types that are generated concurrently, each group small enough
+    for a quick completion and closed under the references between them"""
+
+    def __init__(self):
+        self.max_tokens = None
+
+    def configure(self, max_tokens: int):
+        self.max_tokens = max_tokens
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_tokens is not None
+
+    def partition(self, meta: MarshaMeta) -> list[MarshaMeta]:
+        (functions, types) = get_sections(meta)
+        sections = {**types, **functions}
+        components = find_components(sections)
+        tokens = {name: count_tokens(section)
+                  for (name, section) in sections.items()}
+        # Biggest first, each into the first group with room left. A component bigger than the budget is a group
+        # of its own, splitting it would break the references between its functions
+        groups = []
+        for component in sorted(components, key=lambda c: -sum([tokens[name] for name in c])):
+            size = sum([tokens[name] for name in component])
+            group = next((group for group in groups if group['tokens'] + size <= self.max_tokens and
+                          any([name in functions for name in component])), None)
+            if group is None:
+                group = {'names': set(), 'tokens': 0}
+                groups.append(group)
+            group['names'].update(component)
+            group['tokens'] = group['tokens'] + size
+        # A group with only types has no functions to test, it goes with the smallest group that has some
+        with_functions = [group for group in groups if any(
+            [name in functions for name in group['names']])]
+        for group in [group for group in groups if group not in with_functions]:
+            if len(with_functions) > 0:
+                smallest = min(with_functions, key=lambda g: g['tokens'])
+                smallest['names'].update(group['names'])
+                smallest['tokens'] = smallest['tokens'] + group['tokens']
+        return [group_meta(meta, group['names']) for group in (with_functions or groups)]
+
+
+partitioner = Partitioner()
@@ -0,0 +1,137 @@
+import ast
+import re
+
+SEARCH_PATTERN = re.compile(r'^<{5,9} ?SEARCH\s*$')
+DIVIDER_PATTERN = re.compile(r'^={5,9}\s*$')
+REPLACE_PATTERN = re.compile(r'^>{5,9} ?REPLACE\s*$')
+HUNK_PATTERN = re.compile(r'^@@.*@@')
+
+
+class PatchError(Exception):
+    pass
+
+
+def parse_search_replace(patch: str) -> list[tuple[str, str]]:
+    """Reads `<<<<<<< SEARCH` / `=======` / `>>>>>>> REPLACE` blocks as `(search, replace)` pairs"""
+    edits = []
+    (search, replace, state) = ([], [], None)
+    for line in patch.split('\n'):
+        if state is None:
+            if SEARCH_PATTERN.match(line):
+                state = 'search'
+            elif line.strip() != '':
+                raise PatchError(f'Unexpected line outside of a block: {line}')
+        elif state == 'search':
+            if DIVIDER_PATTERN.match(line):
+                state = 'replace'
+            else:
+                search.append(line)
+        elif REPLACE_PATTERN.match(line):
+            edits.append(('\n'.join(search), '\n'.join(replace)))
+            (search, replace, state) = ([], [], None)
+        else:
+            replace.append(line)
+    if state is not None:
+        raise PatchError('Unterminated search/replace block')
+    return edits
+
+
+def parse_unified_diff(patch: str) -> list[tuple[str, str]]:
+    """Reads the hunks of a unified diff as `(search, replace)` pairs. The line numbers are ignored, the LLM
+    rarely gets them right"""
+    edits = []
+    hunk = None
+    for line in patch.split('\n'):
+        if HUNK_PATTERN.match(line):
+            if hunk is not None:
+                edits.append(hunk)
+            hunk = ([], [])
+        elif hunk is None:
+            # The `diff`, `index`, `---` and `+++` file headers. Inside a hunk a line starting with `---` is a
+            # removed line starting with `--`
+            continue
+        elif line.startswith('-'):
+            hunk[0].append(line[1:])
+        elif line.startswith('+'):
+            hunk[1].append(line[1:])
+        elif line.startswith(' ') or line == '':
+            hunk[0].append(line[1:])
+            hunk[1].append(line[1:])
+        elif line.startswith('\\'):
+            # `\ No newline at end of file`
+            continue
+        else:
+            raise PatchError(f'Unexpected line in a hunk: {line}')
+    if hunk is not None:
+        edits.append(hunk)
+    # Trailing empty context lines are usually the blank line before the closing fence
+    return [('\n'.join(search).rstrip('\n'), '\n'.join(replace).rstrip('\n')) for (search, replace) in edits]
+
+
+def parse_patch(patch: str) -> list[tuple[str, str]]:
+    if any([SEARCH_PATTERN.match(line) for line in patch.split('\n')]):
+        return parse_search_replace(patch)
+    if any([HUNK_PATTERN.match(line) for line in patch.split('\n')]):
+        return parse_unified_diff(patch)
+    raise PatchError('No search/replace blocks or diff hunks found')
+
+
+def find_lines(lines: list[str], search: list[str]) -> int:
+    """The index of the only place where the `search` lines are found, ignoring trailing whitespace"""
+    break_line = '\n'
+    search = [line.rstrip() for line in search]
+    stripped = [line.rstrip() for line in lines]
+    matches = [i for i in range(len(lines) - len(search) + 1)
+               if stripped[i:i + len(search)] == search]
+    if len(matches) == 0:
+        raise PatchError(f'Search text not found:\n{break_line.join(search)}')
+    if len(matches) > 1:
+        raise PatchError(
+            f'Search text found {len(matches)} times:\n{break_line.join(search)}')
+    return matches[0]
+
+
+def apply_edits(content: str, edits: list[tuple[str, str]]) -> str:
+    lines = content.split('\n')
+    for (search, replace) in edits:
+        replacement = replace.split('\n') if replace != '' else []
+        if search.strip() == '':
+            # Nothing to search for adds to the end of the file
+            while len(lines) > 0 and lines[-1].strip() == '':
+                lines.pop()
+            lines = lines + replacement + ['']
+            continue
+        search_lines = search.split('\n')
+        start = find_lines(lines, search_lines)
+        lines[start:start + len(search_lines)] = replacement
+    return '\n'.join(lines)
+
+
+class Patcher:
+    """Applies the fixes the LLM returns as search/replace blocks or unified diffs, instead of whole files"""
+
+    def __init__(self):
+        self.enabled = False
+
+    def configure(self, enabled: bool):
+        self.enabled = enabled
+
+    def apply(self, files: dict[str, str], patches: dict[str, str]) -> dict[str, str]:
+        """Returns the new content of every patched file, or raises a `PatchError` if a patch doesn't apply or
+        leaves a Python file that doesn't parse"""
+        patched = {}
+        for (filename, patch) in patches.items():
+            if filename not in files:
+                raise PatchError(f'Unexpected file {filename}')
+            content = apply_edits(files[filename] or '', parse_patch(patch))
+            if filename.endswith('.py'):
+                try:
+                    ast.parse(content)
+                except SyntaxError as e:
+                    raise PatchError(
+                        f'Patched {filename} is not valid Python: {e}')
+            patched[filename] = content
+        return patched
+
+
+patcher = Patcher()
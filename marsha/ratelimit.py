@@ -0,0 +1,140 @@
+import asyncio
+import os
+import random
+import time
+
+from marsha.tokens import estimate_messages_tokens
+
+# Defaults match the OpenAI limits for `gpt-3.5-turbo` on a paid account
+DEFAULT_REQUESTS_PER_MINUTE = 3500
+DEFAULT_TOKENS_PER_MINUTE = 90000
+# Caps on how many LLM calls and subprocesses (venvs, pip installs, test runs) run at once
+DEFAULT_MAX_LLM_CALLS = 16
+DEFAULT_MAX_SUBPROCESSES = os.cpu_count() or 4
+# Completion size assumed when a request does not set `max_tokens`, per choice
+DEFAULT_COMPLETION_TOKENS = 1024
+
+
+class TokenBucket:
+    """Continuously refilling token bucket holding up to a minute worth of capacity"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.available = per_minute
+        self.rate = per_minute / 60
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available +
+                             (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        self.refill()
+        # Never ask for more than the bucket can hold, or the request would wait forever
+        amount = min(amount, self.capacity)
+        if self.available >= amount:
+            return 0
+        return (amount - self.available) / self.rate
+
+    def consume(self, amount: float):
+        self.refill()
+        # Allowed to go negative, so an underestimated request delays the ones that follow it
+        self.available = self.available - amount
+
+
+class RateLimiter:
+    """Requests per minute and tokens per minute limits shared by every call to a model"""
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.paused_until = 0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int):
+        # The lock makes waiting callers get through in FIFO order
+        async with self.lock:
+            while True:
+                wait = max(self.paused_until - time.monotonic(), self.requests.wait_time(1),
+                           self.tokens.wait_time(tokens))
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            self.requests.consume(1)
+            self.tokens.consume(tokens)
+
+    def reconcile(self, estimated_tokens: int, actual_tokens: int):
+        self.tokens.consume(actual_tokens - estimated_tokens)
+
+    def pause(self, delay: float):
+        # The API told us to back off, so every caller of this model has to wait
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+
+class ModelRateLimiters:
+    def __init__(self):
+        self.requests_per_minute = DEFAULT_REQUESTS_PER_MINUTE
+        self.tokens_per_minute = DEFAULT_TOKENS_PER_MINUTE
+        self.limiters = {}
+
+    def configure(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.limiters = {}
+
+    def get(self, model: str) -> RateLimiter:
+        if model not in self.limiters:
+            self.limiters[model] = RateLimiter(
+                self.requests_per_minute, self.tokens_per_minute)
+        return self.limiters[model]
+
+
+class ConcurrencyLimit:
+    """Caps how many of something run at once across every compile in the process"""
+
+    def __init__(self, limit: int):
+        self.configure(limit)
+
+    def configure(self, limit: int):
+        # Only meant to be called on startup, before anything holds the limit
+        self.limit = limit
+        self.semaphore = asyncio.Semaphore(limit)
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.semaphore.release()
+
+
+def estimate_query_tokens(query: dict) -> int:
+    prompt_tokens = estimate_messages_tokens(query['messages'])
+    completion_tokens = query.get(
+        'max_tokens', DEFAULT_COMPLETION_TOKENS) * query.get('n', 1)
+    return prompt_tokens + completion_tokens
+
+
+def backoff_delay(attempt: int, retry_after: float = None, base: float = 1, cap: float = 30) -> float:
+    if retry_after is not None:
+        # Some jitter on top so the callers told to wait don't all retry at once
+        return retry_after + random.uniform(0, base)
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def get_retry_after(e: Exception) -> float:
+    headers = getattr(e, 'headers', None)
+    if headers is None:
+        return None
+    retry_after = headers.get('retry-after', headers.get('Retry-After'))
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        return None
+
+
+rate_limiters = ModelRateLimiters()
+llm_call_limit = ConcurrencyLimit(DEFAULT_MAX_LLM_CALLS)
+subprocess_limit = ConcurrencyLimit(DEFAULT_MAX_SUBPROCESSES)
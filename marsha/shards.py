@@ -0,0 +1,158 @@
+import ast
+import asyncio
+import json
+import os
+import tempfile
+import time
+from inspect import getsourcefile
+
+from marsha.compact import SEPARATOR, DIVIDER
+from marsha.utils import exec_subprocess, read_file
+from marsha.workers import test_workers
+
+DEFAULT_TEST_TIMEOUT = 10.0
+# A shard is killed after this long whatever its tests do, and its unfinished tests count as timed out
+SHARD_TIMEOUT = 60.0
+# What each status looks like in the `unittest` progress line
+PROGRESS = {'pass': '.', 'fail': 'F',
+            'error': 'E', 'timeout': 'E', 'skip': 's'}
+
+
+def get_runner_script() -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(getsourcefile(lambda: 0))), 'test_runner.py')
+
+
+def get_test_cases(test: str) -> list[str]:
+    """The `TestCase` classes of a test file, one per function, that are run as separate shards. Empty when the
+    file has to run as a whole, like when it doesn't parse or a test case inherits tests from another one"""
+    try:
+        tree = ast.parse(test)
+    except SyntaxError:
+        return []
+    classes = [node for node in tree.body if isinstance(node, ast.ClassDef)]
+    local_names = set([node.name for node in classes])
+    cases = []
+    for node in classes:
+        bases = [ast.unparse(base) for base in node.bases]
+        if any([base in local_names for base in bases]):
+            return []
+        if any([base.endswith('TestCase') for base in bases]):
+            cases.append(node.name)
+    return cases
+
+
+class TestResults:
+    """The result of every test of a test file, and what the shards printed"""
+
+    def __init__(self, results: list[dict], output: str, elapsed: float):
+        # In the order `unittest` runs them, the errors loading the test file first
+        self.results = sorted(results, key=lambda result: (
+            result['class'] or '', result['method'] or ''))
+        self.output = output
+        self.elapsed = elapsed
+
+    @property
+    def failed(self) -> bool:
+        return any([result['status'] not in ['pass', 'skip'] for result in self.results])
+
+    @property
+    def passing(self) -> set[tuple[str, str]]:
+        return set([(result['class'], result['method']) for result in self.results if result['status'] == 'pass'])
+
+    def count(self, *statuses: str) -> int:
+        return len([result for result in self.results if result['status'] in statuses])
+
+    def format(self) -> str:
+        """Formats the results like `unittest` does when the test file is run as a script, which is what the
+        third stage prompt was always given"""
+        load_errors = [result['traceback']
+                       for result in self.results if result['class'] is None]
+        if len(load_errors) > 0:
+            # Every shard fails the same way when the file does not load, and `unittest` never got to run
+            return self.output + '\n'.join(list(dict.fromkeys(load_errors)))
+        progress = ''.join([PROGRESS[result['status']]
+                           for result in self.results])
+        errors = [result for result in self.results if result['status'] in [
+            'error', 'timeout']]
+        failures = [
+            result for result in self.results if result['status'] == 'fail']
+        lines = [progress]
+        for (label, group) in [('ERROR', errors), ('FAIL', failures)]:
+            for result in group:
+                test_id = f'{result["class"]}.{result["method"]}' if result.get(
+                    'test', True) else result['class']
+                lines.extend([SEPARATOR, f'{label}: {result["method"]} (__main__.{test_id})', DIVIDER,
+                              result['traceback']])
+        counts = [f'{name}={count}' for (name, count) in [('failures', len(failures)), ('errors', len(errors)),
+                                                          ('skipped', self.count('skip'))] if count > 0]
+        if self.failed:
+            status = f'FAILED ({", ".join(counts)})'
+        else:
+            status = 'OK' + \
+                (f' ({", ".join(counts)})' if len(counts) > 0 else '')
+        tests = len(
+            [result for result in self.results if result.get('test', True)])
+        lines.extend(
+            [DIVIDER, f'Ran {tests} test{"s" if tests != 1 else ""} in {self.elapsed:.3f}s', '', status])
+        return self.output + '\n'.join(lines) + '\n'
+
+
+class TestShards:
+    """Runs every `TestCase` of a test file as its own shard, all at once, each test with its own timeout"""
+
+    def __init__(self, timeout: float = DEFAULT_TEST_TIMEOUT):
+        self.configure(timeout)
+
+    def configure(self, timeout: float):
+        self.timeout = timeout
+
+    async def run(self, python_exe: str, requirements: str, test_file: str, test: str) -> TestResults:
+        t1 = time.time()
+        shards = await asyncio.gather(*[self.run_shard(python_exe, requirements, test_file, case)
+                                        for case in (get_test_cases(test) or [None])])
+        return TestResults([result for (results, _) in shards for result in results],
+                           ''.join([output for (_, output) in shards]), time.time() - t1)
+
+    async def run_shard(self, python_exe: str, requirements: str, test_file: str, case: str) -> tuple[list[dict], str]:
+        (fd, output_path) = tempfile.mkstemp(
+            prefix='marsha_tests_', suffix='.json')
+        os.close(fd)
+        args = [test_file, '--output', output_path, '--timeout', str(self.timeout),
+                '--shard-timeout', str(SHARD_TIMEOUT)] + (['--case', case] if case is not None else [])
+        stdout = ''
+        stderr = ''
+        try:
+            # The runner kills itself after `SHARD_TIMEOUT`, the extra time covers starting it
+            if test_workers.enabled:
+                stdout, stderr = await test_workers.run(python_exe, requirements, get_runner_script(), *args,
+                                                        timeout=SHARD_TIMEOUT + 10)
+            else:
+                stdout, stderr = await exec_subprocess(python_exe, get_runner_script(), *args,
+                                                       timeout=SHARD_TIMEOUT + 10)
+        except Exception as e:
+            stderr = f'{stderr}{e}\n'
+        finally:
+            lines = read_file(output_path).split('\n')
+            os.remove(output_path)
+        results = []
+        done = False
+        for line in lines:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # Empty, or cut short when the shard was killed
+                continue
+            if result.get('done'):
+                done = True
+            else:
+                results.append(result)
+        if not done:
+            # The results of the tests that finished are kept, the rest of the shard counts as one failure
+            status = 'timeout' if 'timeout' in stderr.lower() else 'error'
+            results.append({'class': case or 'unittest', 'method': 'shard', 'status': status, 'duration': 0,
+                            'test': False, 'traceback': f'The tests stopped before finishing:\n{stderr}'})
+            return (results, stdout)
+        return (results, f'{stdout}{stderr}')
+
+
+test_shards = TestShards()
@@ -0,0 +1,136 @@
+import ast
+
+
+def normalize_name(name: str) -> str:
+    return name.replace('_', '').lower()
+
+
+def get_statement_source(lines: list[str], node: ast.stmt) -> str:
+    # Decorators are not part of the definition's line range
+    start = min([node.lineno] +
+                [d.lineno for d in getattr(node, 'decorator_list', [])])
+    return '\n'.join(lines[start - 1:node.end_lineno])
+
+
+def is_main_block(node: ast.stmt) -> bool:
+    return isinstance(node, ast.If) and isinstance(node.test, ast.Compare) and \
+        isinstance(node.test.left, ast.Name) and node.test.left.id == '__name__'
+
+
+def split_module(code: str) -> list[tuple[str, str, str]]:
+    """Splits Python source into top-level `(kind, name, source)` statements"""
+    tree = ast.parse(code)
+    lines = code.split('\n')
+    statements = []
+    for node in tree.body:
+        source = get_statement_source(lines, node)
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            statements.append(('import', ast.unparse(node), source))
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            statements.append(('definition', node.name, source))
+        elif is_main_block(node):
+            statements.append(('main', '__main__', source))
+        else:
+            statements.append(('other', ast.unparse(node), source))
+    return statements
+
+
+def join_statements(statements: list[tuple[str, str, str]]) -> str:
+    imports = [source for (kind, _, source) in statements if kind == 'import']
+    body = [source for (kind, _, source) in statements if kind != 'import']
+    return '\n\n\n'.join((['\n'.join(imports)] if len(imports) > 0 else []) + body) + '\n'
+
+
+def merge_modules(base: str, override: str) -> str:
+    """Merges two Python modules, where definitions in `override` replace the ones in `base` with the same name.
+
+    Imports are hoisted and de-duplicated, and new statements from `override` are appended before any
+    `if __name__ == '__main__':` block."""
+    base_statements = split_module(base)
+    override_statements = split_module(override)
+    overrides = {(kind, name): source for (kind, name,
+                                           source) in override_statements}
+    merged = []
+    seen = set()
+    for (kind, name, source) in base_statements + override_statements:
+        if (kind, name) in seen:
+            continue
+        seen.add((kind, name))
+        merged.append((kind, name, overrides.get((kind, name), source)))
+    main_blocks = [s for s in merged if s[0] == 'main']
+    return join_statements([s for s in merged if s[0] != 'main'] + main_blocks[:1])
+
+
+def get_defined_names(code: str) -> dict[str, str]:
+    """The source of every top-level definition and assignment of a module, by the name it defines"""
+    tree = ast.parse(code)
+    lines = code.split('\n')
+    names = {}
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names[node.name] = get_statement_source(lines, node)
+        elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [
+                node.target]
+            for target in targets:
+                for name in ast.walk(target):
+                    if isinstance(name, ast.Name):
+                        names[name.id] = get_statement_source(lines, node)
+    return names
+
+
+def find_collisions(modules: list[str]) -> set[str]:
+    """The names defined differently by more than one of the modules, one of which merging them would drop"""
+    sources = {}
+    collisions = set()
+    for module in modules:
+        for (name, source) in get_defined_names(module).items():
+            if name in sources and sources[name] != source:
+                collisions.add(name)
+            sources[name] = source
+    return collisions
+
+
+def remove_definitions(code: str, names: set[str]) -> str:
+    return join_statements([s for s in split_module(code) if s[0] != 'definition' or s[1] not in names])
+
+
+def find_class_for_type(code: str, type_name: str) -> str:
+    # The LLM is free to capitalize or snake case the class name for a Marsha type
+    for (kind, name, _) in split_module(code):
+        if kind == 'definition' and normalize_name(name) == normalize_name(type_name):
+            return name
+    return None
+
+
+def find_tested_function(test_class: ast.ClassDef, function_names: list[str]) -> str:
+    # Prefer the naming convention, `TestSortByAge` for `sort_by_age`, using the longest match so `sort`
+    # does not win over `sort_by_age`
+    class_name = normalize_name(test_class.name)
+    matches = [name for name in function_names if normalize_name(
+        name) in class_name]
+    if len(matches) > 0:
+        return max(matches, key=len)
+    # Otherwise the first spec function the test case calls
+    for node in ast.walk(test_class):
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in function_names:
+            return node.func.id
+    return None
+
+
+def map_test_cases(test_code: str, function_names: list[str]) -> dict[str, str]:
+    """Maps the name of each test class in the module to the function it tests"""
+    tree = ast.parse(test_code)
+    test_cases = {}
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef):
+            function_name = find_tested_function(node, function_names)
+            if function_name is not None:
+                test_cases[node.name] = function_name
+    return test_cases
+
+
+def extract_definitions(code: str, names: set[str]) -> str:
+    """The imports, the named definitions and the `if __name__ == '__main__':` block of a module"""
+    return join_statements([s for s in split_module(code) if s[0] in ['import', 'main'] or
+                            (s[0] == 'definition' and s[1] in names)])
@@ -1,6 +1,9 @@
-import functools
+import contextvars
+import json
+import math
+import os
 
-from marsha.utils import write_file
+from marsha.utils import write_file, prettify_time_delta
 
 # OpenAI pricing model.
 # Format: (tokens, price). Price per 1024 tokens.
@@ -14,122 +17,424 @@ PRICING_MODEL = {
         'out': [(8192, 0.06), (32768, 0.12)]
     }
 }
+STAGES = ['first_stage', 'second_stage', 'third_stage', 'speculative']
+COUNTERS = ['total_calls', 'cache_hits', 'saved_cost',
+            'early_aborts', 'saved_tokens', 'cancelled_calls', 'compacted_tokens', 'patches', 'patch_fallbacks',
+            'patch_saved_tokens']
+
+# The compile and the candidate the current task is working on, so concurrent compiles and candidates each
+# record into their own stats
+current_stats = contextvars.ContextVar('current_stats', default=None)
+current_candidate = contextvars.ContextVar('current_candidate', default=None)
+
+
+def calculate_cost(model: str, input_tokens: int, output_tokens: int) -> tuple[float, float]:
+    pricing = PRICING_MODEL[model]
+    input_cost = 0
+    output_cost = 0
+    # Calculate input cost based on context length
+    if (input_tokens <= pricing['in'][0][0]):
+        input_cost = input_tokens * pricing['in'][0][1] / 1024
+    elif (input_tokens <= pricing['in'][1][0]):
+        input_cost = input_tokens * pricing['in'][1][1] / 1024
+    # Calculate output cost based on context length
+    if (output_tokens <= pricing['out'][0][0]):
+        output_cost = output_tokens * pricing['out'][0][1] / 1024
+    elif (output_tokens <= pricing['out'][1][0]):
+        output_cost = output_tokens * pricing['out'][1][1] / 1024
+    return (input_cost, output_cost)
+
+
+def get_model_key(model_name: str) -> str:
+    return 'gpt4' if model_name.startswith('gpt-4') else 'gpt35'
+
+
+def percentile(values: list[float], p: float) -> float:
+    # Linear interpolation between the closest ranks
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    (lower, upper) = (math.floor(k), math.ceil(k))
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
 
 
 class ModelStats:
-    def __init__(self, name, input_tokens, output_tokens, input_cost, output_cost, total_cost):
+    def __init__(self, name):
         self.name = name
-        self.input_tokens = input_tokens
-        self.output_tokens = output_tokens
-        self.input_cost = input_cost
-        self.output_cost = output_cost
-        self.total_cost = total_cost
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.input_cost = 0
+        self.output_cost = 0
+
+    @property
+    def total_cost(self) -> float:
+        return self.input_cost + self.output_cost
+
+    def add(self, key: str, input_tokens: int, output_tokens: int):
+        input_cost, output_cost = calculate_cost(
+            key, input_tokens, output_tokens)
+        self.input_tokens = self.input_tokens + input_tokens
+        self.output_tokens = self.output_tokens + output_tokens
+        self.input_cost = self.input_cost + input_cost
+        self.output_cost = self.output_cost + output_cost
+
+    def merge(self, other):
+        self.input_tokens = self.input_tokens + other.input_tokens
+        self.output_tokens = self.output_tokens + other.output_tokens
+        self.input_cost = self.input_cost + other.input_cost
+        self.output_cost = self.output_cost + other.output_cost
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'input_tokens': self.input_tokens,
+            'output_tokens': self.output_tokens,
+            'input_cost': self.input_cost,
+            'output_cost': self.output_cost,
+            'total_cost': self.total_cost,
+        }
 
 
 class StageStats:
-    def __init__(self, name, total_time, total_calls):
+    def __init__(self, name):
         self.name = name
-        self.total_time = total_time
-        self.total_calls = total_calls
-        self.gpt35 = ModelStats('gpt-3.5-turbo', 0, 0, 0, 0, 0)
-        self.gpt4 = ModelStats('gpt-4', 0, 0, 0, 0, 0)
+        # Seconds, one entry per run of the stage, since every candidate runs its own
+        self.durations = []
+        self.total_calls = 0
+        self.cache_hits = 0
+        self.saved_cost = 0
+        self.early_aborts = 0
+        self.saved_tokens = 0
+        self.cancelled_calls = 0
+        # Prompt tokens left out by compacting the prompts
+        self.compacted_tokens = 0
+        # Fixes returned as patches, the ones that didn't apply, and the output tokens whole files would have taken
+        self.patches = 0
+        self.patch_fallbacks = 0
+        self.patch_saved_tokens = 0
+        self.gpt35 = ModelStats('gpt-3.5-turbo')
+        self.gpt4 = ModelStats('gpt-4')
+
+    @property
+    def total_time(self) -> float:
+        return sum(self.durations)
+
+    @property
+    def total_cost(self) -> float:
+        return self.gpt35.total_cost + self.gpt4.total_cost
+
+    def model(self, model_name: str) -> ModelStats:
+        return getattr(self, get_model_key(model_name))
+
+    def stage_update(self, res: list, cached: bool = False):
+        if cached:
+            # Responses served from the completion cache cost nothing, track what they would have cost instead
+            self.cache_hits = self.cache_hits + len(res)
+            for r in res:
+                input_cost, output_cost = calculate_cost(get_model_key(
+                    r.model), r.usage.prompt_tokens, r.usage.completion_tokens)
+                self.saved_cost = self.saved_cost + input_cost + output_cost
+            return
+        self.total_calls = self.total_calls + len(res)
+        for r in res:
+            self.model(r.model).add(get_model_key(r.model),
+                                    r.usage.prompt_tokens, r.usage.completion_tokens)
+
+    def abort_update(self, generated_tokens: list[int], expected_tokens: int):
+        # Streamed responses cancelled as soon as they were malformed, saving the rest of their output tokens
+        self.early_aborts = self.early_aborts + len(generated_tokens)
+        self.saved_tokens = self.saved_tokens + \
+            sum([max(0, expected_tokens - tokens)
+                for tokens in generated_tokens])
+
+    def cancel_update(self, model_name: str, input_tokens: int):
+        # Requests cancelled while in flight are still billed for the prompt, the output is unknown
+        self.cancelled_calls = self.cancelled_calls + 1
+        self.model(model_name).add(get_model_key(model_name), input_tokens, 0)
+
+    def compact_update(self, tokens: int):
+        self.compacted_tokens = self.compacted_tokens + tokens
+
+    def patch_update(self, applied: bool, saved_tokens: int):
+        if applied:
+            self.patches = self.patches + 1
+            self.patch_saved_tokens = self.patch_saved_tokens + saved_tokens
+        else:
+            self.patch_fallbacks = self.patch_fallbacks + 1
+
+    def merge(self, other):
+        self.durations = self.durations + other.durations
+        for attr in COUNTERS:
+            setattr(self, attr, getattr(self, attr) + getattr(other, attr))
+        self.gpt35.merge(other.gpt35)
+        self.gpt4.merge(other.gpt4)
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'total_time': self.total_time,
+            'durations': self.durations,
+            'p50_time': percentile(self.durations, 50),
+            'p95_time': percentile(self.durations, 95),
+            'max_time': max(self.durations, default=0),
+            **{attr: getattr(self, attr) for attr in COUNTERS},
+            'total_cost': self.total_cost,
+            'models': [self.gpt35.to_dict(), self.gpt4.to_dict()],
+        }
+
+
+class CandidateStats:
+    def __init__(self, name):
+        self.name = name
+        # Seconds since the start of the attempt, to show how the candidates overlap
+        self.generated = 0
+        self.finished = 0
+        self.result = None
+        self.stages = {stage: StageStats(stage) for stage in STAGES}
+
+    @property
+    def total_calls(self) -> int:
+        return sum([stage.total_calls for stage in self.stages.values()])
+
+    @property
+    def total_cost(self) -> float:
+        return sum([stage.total_cost for stage in self.stages.values()])
+
+    def finish(self, generated: float, finished: float, result: str):
+        self.generated = generated
+        self.finished = finished
+        self.result = result
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'generated': self.generated,
+            'finished': self.finished,
+            'result': self.result,
+            'total_calls': self.total_calls,
+            'total_cost': self.total_cost,
+            'stages': {name: stage.to_dict() for (name, stage) in self.stages.items()},
+        }
 
 
 class MarshaStats:
-    def __init__(self):
+    """Stats of a compile, or of the whole run with one child per compile. Updates go to the compile and the
+    candidate of the current task, see `get_stats`"""
+
+    def __init__(self, name: str = 'total'):
+        self.name = name
         self.total_time = 0
-        self.total_calls = 0
         self.attempts = 0
-        self.total_cost = 0
-        self.first_stage = StageStats('first_stage', 0, 0)
-        self.second_stage = StageStats('second_stage', 0, 0)
-        self.third_stage = StageStats('third_stage', 0, 0)
+        self.first_stage = StageStats('first_stage')
+        self.second_stage = StageStats('second_stage')
+        self.third_stage = StageStats('third_stage')
+        self.speculative = StageStats('speculative')
+        self.candidates = []
+        self.compiles = []
 
-    def aggregate(self, total_time, attempts):
+    def compile(self, name: str):
+        """Starts the stats of a compile, recording into them from the current task from now on"""
+        compile_stats = MarshaStats(name)
+        self.compiles.append(compile_stats)
+        current_stats.set(compile_stats)
+        return compile_stats
+
+    def candidate(self, name: str) -> CandidateStats:
+        """Starts the stats of a candidate, recording into them from the current task from now on"""
+        candidate_stats = CandidateStats(name)
+        self.candidates.append(candidate_stats)
+        current_candidate.set(candidate_stats)
+        return candidate_stats
+
+    def stage(self, stage: str) -> StageStats:
+        """A stage of this compile and every child compile together"""
+        combined = StageStats(stage)
+        combined.merge(getattr(self, stage))
+        for compile_stats in self.compiles:
+            combined.merge(compile_stats.stage(stage))
+        return combined
+
+    def stage_targets(self, stage: str) -> list[StageStats]:
+        candidate_stats = current_candidate.get()
+        return [getattr(self, stage)] + ([candidate_stats.stages[stage]] if candidate_stats is not None else [])
+
+    def all_candidates(self) -> list[CandidateStats]:
+        return self.candidates + [candidate for compile_stats in self.compiles for candidate in compile_stats.all_candidates()]
+
+    def sum_stages(self, attr: str):
+        return sum([getattr(self.stage(stage), attr) for stage in STAGES])
+
+    @property
+    def total_calls(self) -> int:
+        return self.sum_stages('total_calls')
+
+    @property
+    def total_cost(self) -> float:
+        return self.sum_stages('total_cost')
+
+    @property
+    def cache_hits(self) -> int:
+        return self.sum_stages('cache_hits')
+
+    @property
+    def saved_cost(self) -> float:
+        return self.sum_stages('saved_cost')
+
+    @property
+    def early_aborts(self) -> int:
+        return self.sum_stages('early_aborts')
+
+    @property
+    def saved_tokens(self) -> int:
+        return self.sum_stages('saved_tokens')
+
+    @property
+    def compacted_tokens(self) -> int:
+        return self.sum_stages('compacted_tokens')
+
+    @property
+    def patches(self) -> int:
+        return self.sum_stages('patches')
+
+    @property
+    def patch_fallbacks(self) -> int:
+        return self.sum_stages('patch_fallbacks')
+
+    @property
+    def patch_saved_tokens(self) -> int:
+        return self.sum_stages('patch_saved_tokens')
+
+    def aggregate(self, total_time: float, attempts: int):
         self.total_time = total_time
         self.attempts = attempts
-        self.total_calls = self.first_stage.total_calls + \
-            self.second_stage.total_calls + self.third_stage.total_calls
-        self.total_cost = self.first_stage.gpt35.total_cost + self.first_stage.gpt4.total_cost + self.second_stage.gpt35.total_cost + \
-            self.second_stage.gpt4.total_cost + \
-            self.third_stage.gpt35.total_cost + self.third_stage.gpt4.total_cost
-
-    def stage_update(self, stage: str, res: list):
-        rsetattr(self, f'{stage}.total_calls', rgetattr(
-            self, f'{stage}.total_calls') + len(res))
-        for r in res:
-            model = 'gpt4' if r.model.startswith('gpt-4') else 'gpt35'
-            input_tokens = r.usage.prompt_tokens
-            rsetattr(self, f'{stage}.{model}.input_tokens', rgetattr(
-                self, f'{stage}.{model}.input_tokens') + input_tokens)
-            pricing = PRICING_MODEL[model]
-            # Calculate input cost based on context length
-            if (input_tokens <= pricing['in'][0][0]):
-                rsetattr(self, f'{stage}.{model}.input_cost', rgetattr(
-                    self, f'{stage}.{model}.input_cost') + input_tokens * pricing['in'][0][1] / 1024)
-            elif (input_tokens <= pricing['in'][1][0]):
-                rsetattr(self, f'{stage}.{model}.input_cost', rgetattr(
-                    self, f'{stage}.{model}.input_cost') + input_tokens * pricing['in'][1][1] / 1024)
-            output_tokens = r.usage.completion_tokens
-            rsetattr(self, f'{stage}.{model}.output_tokens', rgetattr(
-                self, f'{stage}.{model}.output_tokens') + output_tokens)
-            # Calculate output cost based on context length
-            if (output_tokens <= pricing['out'][0][0]):
-                rsetattr(self, f'{stage}.{model}.output_cost', rgetattr(
-                    self, f'{stage}.{model}.output_cost') + output_tokens * pricing['out'][0][1] / 1024)
-            elif (output_tokens <= pricing['out'][1][0]):
-                rsetattr(self, f'{stage}.{model}.output_cost', rgetattr(
-                    self, f'{stage}.{model}.output_cost') + output_tokens * pricing['out'][1][1] / 1024)
-            # Calculate total cost
-            rsetattr(self, f'{stage}.{model}.total_cost', rgetattr(self, f'{stage}.{model}.total_cost') +
-                     rgetattr(self, f'{stage}.{model}.input_cost') + rgetattr(self, f'{stage}.{model}.output_cost'))
+
+    def stage_update(self, stage: str, res: list, cached: bool = False):
+        for target in self.stage_targets(stage):
+            target.stage_update(res, cached)
+
+    def abort_update(self, stage: str, generated_tokens: list[int], expected_tokens: int):
+        for target in self.stage_targets(stage):
+            target.abort_update(generated_tokens, expected_tokens)
+
+    def cancel_update(self, stage: str, model_name: str, input_tokens: int):
+        for target in self.stage_targets(stage):
+            target.cancel_update(model_name, input_tokens)
+
+    def compact_update(self, stage: str, tokens: int):
+        for target in self.stage_targets(stage):
+            target.compact_update(tokens)
+
+    def patch_update(self, stage: str, applied: bool, saved_tokens: int = 0):
+        for target in self.stage_targets(stage):
+            target.patch_update(applied, saved_tokens)
+
+    def time_update(self, stage: str, seconds: float):
+        for target in self.stage_targets(stage):
+            target.durations.append(seconds)
+
+    def merge_stage(self, source: str, target: str):
+        # Moves everything recorded under one stage to another, like speculative work that turned out to be needed
+        getattr(self, target).merge(getattr(self, source))
+        setattr(self, source, StageStats(source))
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'total_time': self.total_time,
+            'attempts': self.attempts,
+            'total_calls': self.total_calls,
+            'total_cost': self.total_cost,
+            'cache_hits': self.cache_hits,
+            'saved_cost': self.saved_cost,
+            'early_aborts': self.early_aborts,
+            'saved_tokens': self.saved_tokens,
+            'compacted_tokens': self.compacted_tokens,
+            'patches': self.patches,
+            'patch_fallbacks': self.patch_fallbacks,
+            'patch_saved_tokens': self.patch_saved_tokens,
+            'stages': {stage: self.stage(stage).to_dict() for stage in STAGES},
+            'candidates': [candidate.to_dict() for candidate in self.candidates],
+            'compiles': [compile_stats.to_dict() for compile_stats in self.compiles],
+        }
+
+    def to_records(self) -> list[dict]:
+        """One flat record for this compile, each child compile and each candidate, for NDJSON"""
+        record = self.to_dict()
+        records = [{'type': 'compile' if len(self.compiles) == 0 else 'total', **{
+            key: value for (key, value) in record.items() if key not in ['candidates', 'compiles']}}]
+        for candidate in self.candidates:
+            records.append(
+                {'type': 'candidate', 'compile': self.name, **candidate.to_dict()})
+        for compile_stats in self.compiles:
+            records.extend(compile_stats.to_records())
+        return records
+
+    def export(self, basename: str = 'stats'):
+        """Writes the stats as `<basename>.json` and `<basename>.ndjson`"""
+        write_file(f'{basename}.json', json.dumps(self.to_dict(), indent=2))
+        write_file(f'{basename}.ndjson', '\n'.join(
+            [json.dumps(record) for record in self.to_records()]) + '\n')
 
     def to_file(self, filename: str = 'stats.md'):
         write_file(filename, content=self.__str__())
+        self.export(os.path.splitext(filename)[0])
 
     def __repr__(self):
         return self.__str__()
 
+    def format_stage(self, title: str, stage: StageStats) -> str:
+        return f'''## {title}
+Total time: {prettify_time_delta(stage.total_time)}
+Total calls: {stage.total_calls}
+Total cost: {stage.total_cost}
+Cache hits: {stage.cache_hits}
+Saved cost: {stage.saved_cost}
+Early aborts: {stage.early_aborts}
+Saved tokens: {stage.saved_tokens}
+Compacted prompt tokens: {stage.compacted_tokens}
+Patches: {stage.patches} applied, {stage.patch_fallbacks} fell back to whole files, {stage.patch_saved_tokens} output tokens saved
+Time per run: p50 {prettify_time_delta(percentile(stage.durations, 50))}, p95 {prettify_time_delta(percentile(stage.durations, 95))}, max {prettify_time_delta(max(stage.durations, default=0))} ({len(stage.durations)} runs)'''
+
     def __str__(self):
+        break_line = '\n'
+        speculative = self.stage('speculative')
         return f'''# Stats
 
-## First stage
-Total time: {self.first_stage.total_time}
-Total calls: {self.first_stage.total_calls}
-Total cost: {self.first_stage.gpt35.total_cost + self.first_stage.gpt4.total_cost}
+{self.format_stage('First stage', self.stage('first_stage'))}
+
+{self.format_stage('Second stage', self.stage('second_stage'))}
+
+{self.format_stage('Third stage', self.stage('third_stage'))}
 
-## Second stage
-Total time: {self.second_stage.total_time}
-Total calls: {self.second_stage.total_calls}
-Total cost: {self.second_stage.gpt35.total_cost + self.second_stage.gpt4.total_cost}
+## Candidates
+| Candidate | Generated | Finished | Result | Calls | Cost | Second stage | Third stage |
+| --- | --- | --- | --- | --- | --- | --- | --- |
+{break_line.join([f'| {c.name} | {prettify_time_delta(c.generated)} | {prettify_time_delta(c.finished)} | {c.result} | {c.total_calls} | {round(c.total_cost, 4)} | {prettify_time_delta(c.stages["second_stage"].total_time)} | {prettify_time_delta(c.stages["third_stage"].total_time)} |' for c in self.all_candidates()])}
 
-## Third stage
-Total time: {self.third_stage.total_time}
-Total calls: {self.third_stage.total_calls}
-Total cost: {self.third_stage.gpt35.total_cost + self.third_stage.gpt4.total_cost}
+## Speculative stage
+Total calls: {speculative.total_calls}
+Cancelled calls: {speculative.cancelled_calls}
+Total cost: {speculative.total_cost}
 
 ## Total
-Total time: {self.total_time}
+Total time: {prettify_time_delta(self.total_time)}
 Total calls: {self.total_calls}
 Attempts: {self.attempts}
 Total cost: {self.total_cost}
+Cache hits: {self.cache_hits}
+Saved cost: {self.saved_cost}
+Early aborts: {self.early_aborts}
+Saved tokens: {self.saved_tokens}
+Compacted prompt tokens: {self.compacted_tokens}
+Patches: {self.patches} applied, {self.patch_fallbacks} fell back to whole files, {self.patch_saved_tokens} output tokens saved
 '''
 
 
-"""
-Source: https://stackoverflow.com/questions/31174295/getattr-and-setattr-on-nested-subobjects-chained-properties
-"""
-
-
-def rsetattr(obj, attr, val):
-    pre, _, post = attr.rpartition('.')
-    return setattr(rgetattr(obj, pre) if pre else obj, post, val)
-
-
-def rgetattr(obj, attr, *args):
-    def _getattr(obj, attr):
-        return getattr(obj, attr, *args)
-    return functools.reduce(_getattr, [obj] + attr.split('.'))
+def get_stats() -> MarshaStats:
+    """The stats of the compile the current task is working on"""
+    compile_stats = current_stats.get()
+    return compile_stats if compile_stats is not None else stats
 
 
 stats = MarshaStats()
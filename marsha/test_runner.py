@@ -0,0 +1,164 @@
+"""
+Sharded test runner.
+
+Run by the Python interpreter of a virtual environment, directly or in a warm test worker, it runs the tests of
+one `TestCase` of a test file, or all of them, and writes a JSON line per test to the output file as soon as the
+test finishes: its status (`pass`, `fail`, `error`, `skip` or `timeout`), its duration and its traceback. Each
+test gets its own timeout, and the whole shard a hard one, so a hanging test only costs its own timeout and the
+tests that finished before it keep their results.
+"""
+import argparse
+import faulthandler
+import importlib.util
+import json
+import os
+import signal
+import sys
+import time
+import traceback
+import unittest
+
+
+class TestTimeout(BaseException):
+    # Not an `Exception`, so a test catching every exception can't swallow it
+    pass
+
+
+class ShardResult(unittest.TestResult):
+    def __init__(self, output, timeout):
+        super().__init__()
+        self.output = output
+        self.timeout = timeout
+        self.started = None
+        self.outcome = None
+
+    def startTest(self, test):
+        super().startTest(test)
+        self.started = time.perf_counter()
+        self.outcome = ('pass', '')
+        if self.timeout > 0 and hasattr(signal, 'setitimer'):
+            signal.signal(signal.SIGALRM, self.raise_timeout)
+            signal.setitimer(signal.ITIMER_REAL, self.timeout)
+
+    def raise_timeout(self, signum, frame):
+        raise TestTimeout(
+            'The test took longer than {:g} seconds'.format(self.timeout))
+
+    def stopTest(self, test):
+        if self.timeout > 0 and hasattr(signal, 'setitimer'):
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        super().stopTest(test)
+        (status, tb) = self.outcome
+        write_result(self.output, {
+            'class': type(test).__name__,
+            'method': test._testMethodName,
+            'status': status,
+            'duration': time.perf_counter() - self.started,
+            'traceback': tb,
+        })
+
+    def addError(self, test, err):
+        if issubclass(err[0], TestTimeout):
+            # The last frame is the signal handler raising it
+            tb = err[2]
+            while tb is not None and tb.tb_next is not None and tb.tb_next.tb_next is not None:
+                tb = tb.tb_next
+            if tb is not None and tb.tb_next is not None:
+                tb.tb_next = None
+        super().addError(test, err)
+        self.outcome = ('timeout' if issubclass(err[0], TestTimeout) else 'error',
+                        self._exc_info_to_string(err, test))
+
+    def addFailure(self, test, err):
+        super().addFailure(test, err)
+        self.outcome = ('fail', self._exc_info_to_string(err, test))
+
+    def addSkip(self, test, reason):
+        super().addSkip(test, reason)
+        self.outcome = ('skip', reason)
+
+    def addExpectedFailure(self, test, err):
+        super().addExpectedFailure(test, err)
+        self.outcome = ('pass', '')
+
+    def addSubTest(self, test, subtest, err):
+        super().addSubTest(test, subtest, err)
+        if err is not None:
+            # A failing subtest fails the whole test, with the tracebacks of every failing subtest
+            status = 'fail' if issubclass(
+                err[0], test.failureException) else 'error'
+            self.outcome = (status if self.outcome[0] == 'pass' else self.outcome[0],
+                            self.outcome[1] + self._exc_info_to_string(err, test))
+
+    def addUnexpectedSuccess(self, test):
+        super().addUnexpectedSuccess(test)
+        self.outcome = ('fail', 'Unexpected success\n')
+
+
+def write_result(output, result):
+    output.write(json.dumps(result) + '\n')
+    output.flush()
+
+
+def format_load_error():
+    # Without the frames of this runner and of `importlib`, like when the test file is run as a script
+    (error_type, error, tb) = sys.exc_info()
+    frames = [frame for frame in traceback.extract_tb(tb) if frame.filename != os.path.abspath(__file__) and
+              not frame.filename.startswith('<frozen')]
+    return 'Traceback (most recent call last):\n' + ''.join(traceback.format_list(frames)) + \
+        ''.join(traceback.format_exception_only(error_type, error))
+
+
+def load_module(test_file):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(test_file)))
+    name = os.path.splitext(os.path.basename(test_file))[0]
+    spec = importlib.util.spec_from_file_location(name, test_file)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Marsha sharded test runner')
+    parser.add_argument('test_file')
+    parser.add_argument('--output', required=True,
+                        help='File to write the JSON results to')
+    parser.add_argument('--case', default=None,
+                        help='The `TestCase` to run, defaults to every test in the file')
+    parser.add_argument('--timeout', type=float, default=10,
+                        help='Seconds each test can take, 0 to never time out')
+    parser.add_argument('--shard-timeout', type=float, default=60,
+                        help='Seconds the whole shard can take before it is killed')
+    args = parser.parse_args()
+    # Runs in a watchdog thread, so even a test stuck outside of Python code can't outlive the shard
+    faulthandler.dump_traceback_later(args.shard_timeout, exit=True)
+    with open(args.output, 'a') as output:
+        try:
+            module = load_module(args.test_file)
+        except BaseException:
+            # The test file did not load, like when the code under test does not even import
+            write_result(output, {'class': None, 'method': None, 'status': 'error', 'duration': 0,
+                                  'traceback': format_load_error()})
+            write_result(output, {'done': True})
+            return
+        loader = unittest.TestLoader()
+        if args.case is not None:
+            suite = loader.loadTestsFromTestCase(getattr(module, args.case))
+        else:
+            suite = loader.loadTestsFromModule(module)
+        result = ShardResult(output, args.timeout)
+        suite.run(result)
+        # Errors in `setUpClass` and `tearDownClass` are not part of any test, their description is like
+        # `setUpClass (module.Class)`
+        for (test, tb) in result.errors:
+            if not isinstance(test, unittest.TestCase):
+                (method, _, test_id) = str(test).partition(' ')
+                write_result(output, {'class': test_id.strip('()').split('.')[-1], 'method': method,
+                                      'status': 'error', 'duration': 0, 'test': False, 'traceback': tb})
+        write_result(output, {'done': True})
+    faulthandler.cancel_dump_traceback_later()
+
+
+if __name__ == '__main__':
+    main()
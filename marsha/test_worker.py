@@ -0,0 +1,100 @@
+"""
+Warm test runner worker.
+
+Run by the Python interpreter of a virtual environment, it pre-imports `unittest` and the requirements and
+then waits for JSON requests on stdin. Each test file is run in a forked child, so it gets a fresh module
+namespace while skipping the interpreter startup and the imports, and the result is written back as JSON.
+"""
+import argparse
+import importlib
+import json
+import os
+import runpy
+import signal
+import sys
+import tempfile
+import traceback
+
+
+def preload(modules):
+    import unittest  # noqa: F401
+    import unittest.mock  # noqa: F401
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except BaseException:
+            # Requirement names don't always match their module names, the test will import what it needs
+            pass
+
+
+def run_child(request, stdout, stderr):
+    code = 1
+    try:
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.dup2(stdout.fileno(), 1)
+        os.dup2(stderr.fileno(), 2)
+        # The default SIGALRM action kills the child, so a hanging test can't outlive its timeout
+        signal.alarm(max(1, int(request['timeout'])))
+        test_file = request['test_file']
+        sys.argv = [test_file] + request.get('args', [])
+        sys.path[0] = os.path.dirname(os.path.abspath(test_file))
+        try:
+            runpy.run_path(test_file, run_name='__main__')
+            code = 0
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else (
+                0 if e.code is None else 1)
+        except BaseException:
+            traceback.print_exc()
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(code)
+
+
+def run_test_file(request):
+    with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            run_child(request, stdout, stderr)
+        _, status = os.waitpid(pid, 0)
+        timed_out = os.WIFSIGNALED(status) and os.WTERMSIG(
+            status) == signal.SIGALRM
+        stdout.seek(0)
+        stderr.seek(0)
+        return {
+            'stdout': stdout.read().decode('utf-8', errors='replace'),
+            'stderr': stderr.read().decode('utf-8', errors='replace'),
+            'exitcode': os.waitstatus_to_exitcode(status),
+            'timeout': timed_out,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Marsha warm test runner')
+    parser.add_argument('--preload', default='',
+                        help='Comma separated modules to import on startup')
+    args = parser.parse_args()
+    # Keep the original stdout for the protocol, anything else printing to it goes nowhere
+    protocol = os.fdopen(os.dup(1), 'w')
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    preload([module for module in args.preload.split(',') if len(module) > 0])
+    protocol.write(json.dumps({'ready': True}) + '\n')
+    protocol.flush()
+    for line in sys.stdin:
+        if len(line.strip()) == 0:
+            continue
+        try:
+            result = run_test_file(json.loads(line))
+        except Exception as e:
+            result = {'error': str(e)}
+        protocol.write(json.dumps(result) + '\n')
+        protocol.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+import re
+
+# Roughly 4 characters per token for English text and code
+CHARS_PER_TOKEN = 4
+# Every chat message is wrapped in a few tokens of formatting, and so is the reply
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def estimate_messages_tokens(messages: list[dict]) -> int:
+    return sum([estimate_tokens(message['content']) + TOKENS_PER_MESSAGE for message in messages]) + TOKENS_PER_REPLY
+
+
+# Splits text the way the GPT tokenizers do before merging characters into tokens: words with their leading space,
+# up to 3 digits, runs of punctuation and runs of whitespace
+PRETOKEN_PATTERN = re.compile(
+    r"""'(?:[sdmt]|ll|ve|re)| ?[^\W\d_]+| ?\d{1,3}| ?[^\s\w]+|\s+""")
+# Common words are a single token, longer ones get split into a few
+CHARS_PER_WORD_TOKEN = 6
+
+
+def count_tokens(text: str) -> int:
+    """A closer count than `estimate_tokens` for budgeting prompts, as code has a lot of short words, symbols and
+    indentation that take a token each"""
+    tokens = 0
+    for piece in PRETOKEN_PATTERN.findall(text):
+        piece = piece.lstrip(' ') or piece
+        chars_per_token = CHARS_PER_WORD_TOKEN if piece.isalpha() else CHARS_PER_TOKEN
+        tokens = tokens + (len(piece) + chars_per_token - 1) // chars_per_token
+    return tokens
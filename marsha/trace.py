@@ -0,0 +1,202 @@
+import contextvars
+import json
+import os
+import time
+
+from marsha.utils import prettify_time_delta
+
+current_span = contextvars.ContextVar('current_span', default=None)
+# Tags like the candidate id, added to every span started in the current context
+current_tags = contextvars.ContextVar('current_tags', default={})
+
+
+class Span:
+    def __init__(self, tracer, name: str, category: str, tags: dict):
+        self.tracer = tracer
+        self.id = None
+        self.parent = None
+        self.name = name
+        self.category = category
+        self.tags = tags
+        self.start = None
+        self.end = None
+        self.token = None
+
+    def __enter__(self):
+        self.parent = current_span.get()
+        self.id = len(self.tracer.spans)
+        self.tracer.spans.append(self)
+        self.token = current_span.set(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.perf_counter()
+        if exc_type is not None:
+            self.tags['error'] = exc_type.__name__
+        try:
+            current_span.reset(self.token)
+        except ValueError:
+            # Async generators can be closed from another context than the one they started the span in
+            current_span.set(self.parent)
+        return False
+
+    def tag(self, **tags):
+        self.tags.update(tags)
+
+    def is_ancestor_of(self, span) -> bool:
+        parent = span.parent
+        while parent is not None:
+            if parent is self:
+                return True
+            parent = parent.parent
+        return False
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def tag(self, **tags):
+        pass
+
+
+null_span = NullSpan()
+
+
+class Tracer:
+    """Nested spans of the work done during a compile, exported in the Chrome trace format that Perfetto and
+    `chrome://tracing` read"""
+
+    def __init__(self):
+        self.enabled = False
+        self.spans = []
+        self.t0 = time.perf_counter()
+
+    def enable(self):
+        self.enabled = True
+        self.spans = []
+        self.t0 = time.perf_counter()
+
+    def span(self, name: str, category: str, **tags):
+        if not self.enabled:
+            return null_span
+        return Span(self, name, category, {**current_tags.get(), **tags})
+
+    def tag(self, **tags):
+        """Adds tags to the spans started from now on in the current context, and the tasks it starts"""
+        current_tags.set({**current_tags.get(), **tags})
+
+    def finished_spans(self) -> list[Span]:
+        return [span for span in self.spans if span.end is not None]
+
+    def assign_lanes(self, spans: list[Span]) -> dict[int, int]:
+        # Spans on the same lane must nest, so a span goes on its parent's lane unless an overlapping sibling is
+        # already there, and on the first lane where it nests otherwise
+        lanes = {}
+        stacks = []
+        for span in sorted(spans, key=lambda span: (span.start, -span.end)):
+            candidates = ([lanes[span.parent.id]] if span.parent is not None and span.parent.id in lanes else []) + \
+                list(range(len(stacks)))
+            for lane in candidates:
+                stack = stacks[lane]
+                while len(stack) > 0 and stack[-1].end <= span.start:
+                    stack.pop()
+                if len(stack) == 0 or (stack[-1].is_ancestor_of(span) and span.end <= stack[-1].end):
+                    break
+            else:
+                stacks.append([])
+                lane = len(stacks) - 1
+            stacks[lane].append(span)
+            lanes[span.id] = lane
+        return lanes
+
+    def to_chrome_trace(self) -> dict:
+        spans = self.finished_spans()
+        lanes = self.assign_lanes(spans)
+        pid = os.getpid()
+        # Lanes are named after the first candidate that used them, the others only run the first stage
+        names = {}
+        for span in spans:
+            if 'candidate' in span.tags:
+                names.setdefault(lanes[span.id], str(span.tags['candidate']))
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': lane,
+                   'args': {'name': names.get(lane, 'generation')}} for lane in sorted(set(lanes.values()))]
+        for span in spans:
+            lane = lanes[span.id]
+            events.append({
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': (span.start - self.t0) * 1e6,
+                'dur': (span.end - span.start) * 1e6,
+                'pid': pid,
+                'tid': lane,
+                'args': {key: str(value) for (key, value) in span.tags.items()},
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def to_file(self, filename: str = 'trace.json'):
+        with open(filename, 'w') as f:
+            json.dump(self.to_chrome_trace(), f)
+
+    def critical_path(self) -> list[tuple[Span, float, float]]:
+        """Walks back from the end of the trace, always through the leaf span that finished last, returning the
+        `(span, start, end)` pieces of the path. Cancelled spans only end because something else finished first, so
+        they are never on it"""
+        spans = self.finished_spans()
+        parents = set(
+            [span.parent.id for span in spans if span.parent is not None])
+        leaves = [span for span in spans if span.id not in parents and span.tags.get(
+            'error') != 'CancelledError']
+        path = []
+        t = max([span.end for span in spans], default=self.t0)
+        while True:
+            running = [span for span in leaves if span.start < t]
+            if len(running) == 0:
+                break
+            span = max(running, key=lambda span: (
+                min(span.end, t), -span.start))
+            path.append((span, span.start, min(span.end, t)))
+            t = span.start
+        return list(reversed(path))
+
+    def summary(self) -> str:
+        spans = self.finished_spans()
+        if len(spans) == 0:
+            return 'No spans were traced.'
+        wall_time = max([span.end for span in spans]) - self.t0
+        parents = set(
+            [span.parent.id for span in spans if span.parent is not None])
+        leaves = [span for span in spans if span.id not in parents]
+        path = self.critical_path()
+        critical = {}
+        for (span, start, end) in path:
+            critical[span.category] = critical.get(
+                span.category, 0) + end - start
+        total = {}
+        for span in leaves:
+            total[span.category] = total.get(
+                span.category, 0) + span.end - span.start
+        critical_time = sum(critical.values())
+        total_time = sum(total.values())
+        rows = '\n'.join([f'| {category} | {prettify_time_delta(critical.get(category, 0))} | {prettify_time_delta(total[category] - critical.get(category, 0))} |'
+                          for category in sorted(total, key=lambda category: -critical.get(category, 0))])
+        return f'''# Trace
+
+Wall time: {prettify_time_delta(wall_time)}
+Critical path: {prettify_time_delta(critical_time)}
+Untraced: {prettify_time_delta(max(0, wall_time - critical_time))}
+Off the critical path: {prettify_time_delta(total_time - critical_time)}
+Parallelism: {round(total_time / wall_time, 2) if wall_time > 0 else 0}
+
+| Category | Critical path | In parallel |
+| --- | --- | --- |
+{rows}
+'''
+
+
+tracer = Tracer()
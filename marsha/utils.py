@@ -1,7 +1,11 @@
+from asyncio.subprocess import Process
 from inspect import getsourcefile
-import autopep8
+import asyncio
 import os
 import shutil
+import subprocess
+
+from marsha.ratelimit import subprocess_limit
 
 
 def prettify_time_delta(delta, max_depth=2):
@@ -39,21 +43,10 @@ def write_file(filename: str, content: str, mode: str = 'w'):
         f.write(content)
 
 
-def autoformat_files(files: list[str]):
-    for file in files:
-        before = read_file(file)
-        after = autopep8.fix_code(before)
-        write_file(file, after)
-
-
 def copy_file(src: str, dest: str):
     shutil.copyfile(src, dest)
 
 
-def copy_tree(src: str, dest: str):
-    shutil.copytree(src, dest)
-
-
 def get_filename_from_path(path: str):
     return os.path.splitext(os.path.basename(path))[0]
 
@@ -63,3 +56,61 @@ def add_helper(filename: str):
         os.path.abspath(getsourcefile(lambda: 0))), 'helper.py')
     with open(filename, 'a') as o, open(helper, 'r') as i:
         o.write(i.read())
+
+
+async def run_subprocess(stream: Process, timeout: float = 60.0) -> tuple[str, str]:
+    stdout = ''
+    stderr = ''
+    try:
+        stdout, stderr = await asyncio.wait_for(stream.communicate(), timeout)
+    except asyncio.exceptions.TimeoutError:
+        try:
+            stream.kill()
+        except OSError:
+            # Ignore 'no such process' error
+            pass
+        raise Exception('run_subprocess timeout...')
+    except Exception as e:
+        raise e
+    return (stdout.decode('utf-8'), stderr.decode('utf-8'))
+
+
+async def exec_subprocess(*cmd: str, timeout: float = 60.0, check: bool = False) -> tuple[str, str]:
+    async with subprocess_limit:
+        stream = await asyncio.create_subprocess_exec(
+            *cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (stdout, stderr) = await run_subprocess(stream, timeout)
+    if check and stream.returncode != 0:
+        raise Exception(
+            f'{os.path.basename(cmd[0])} exited with code {stream.returncode}', stderr)
+    return (stdout, stderr)
+
+
+async def merge_async_iterators(iterators: dict):
+    """Yields `(key, item)` pairs from several async iterators, in the order the items arrive"""
+    queue = asyncio.Queue()
+    finished = object()
+
+    async def drain(key, iterator):
+        try:
+            async for item in iterator:
+                queue.put_nowait((key, item))
+        finally:
+            queue.put_nowait((key, finished))
+
+    tasks = [asyncio.create_task(drain(key, iterator))
+             for (key, iterator) in iterators.items()]
+    try:
+        remaining = len(tasks)
+        while remaining > 0:
+            (key, item) = await queue.get()
+            if item is finished:
+                remaining = remaining - 1
+                continue
+            yield (key, item)
+        for task in tasks:
+            # Raises the first error from any of the iterators
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
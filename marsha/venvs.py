@@ -0,0 +1,199 @@
+import asyncio
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+from marsha.cache import get_cache_dir, hash_content
+from marsha.trace import tracer
+from marsha.utils import exec_subprocess, read_file, write_file
+
+DEFAULT_MAX_SIZE = 2 * 1024 * 1024 * 1024  # 2GB
+
+
+def normalize_requirements(requirements: str) -> list[str]:
+    normalized = set()
+    for line in requirements.split('\n'):
+        line = line.split('#')[0].strip().lower().replace('_', '-')
+        if len(line) > 0:
+            normalized.add(line)
+    return sorted(normalized)
+
+
+def get_venv_python(venv_path: str) -> str:
+    # define python executable based on os
+    return f'{venv_path}/Scripts/python.exe' if platform.system() == 'Windows' else f'{venv_path}/bin/python'
+
+
+def get_venv_pip(venv_path: str) -> str:
+    # define pip executable based on os
+    return f'{venv_path}/Scripts/pip.exe' if platform.system() == 'Windows' else f'{venv_path}/bin/pip'
+
+
+def get_directory_size(path: str) -> int:
+    size = 0
+    for (root, _, files) in os.walk(path):
+        for file in files:
+            try:
+                size = size + os.lstat(os.path.join(root, file)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class VenvCache:
+    """Virtual environments with requirements installed, shared across candidates and compiles.
+
+    Each environment is built in a directory of its own that it never moves out of, since virtual environments
+    are not relocatable, and is only published once the install succeeds by atomically writing a metadata file
+    keyed by the normalized requirements that points to it. The cache only ever hands out complete environments,
+    and candidates use the cached environment's interpreter directly instead of copying it."""
+
+    def __init__(self, directory: str = None, max_size: int = DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.locks = {}
+        self.in_use = set()
+        # Environments with failed installs, never published and removed at the end of the run
+        self.failed = set()
+
+    def get_directory(self) -> str:
+        if self.directory is None:
+            self.directory = get_cache_dir('venvs')
+        return self.directory
+
+    def get_metadata_path(self, key: str) -> str:
+        return os.path.join(self.get_directory(), f'{key}.json')
+
+    def read_metadata(self, key: str) -> dict:
+        try:
+            metadata = json.loads(read_file(self.get_metadata_path(key)))
+        except Exception:
+            return None
+        if not os.path.exists(get_venv_python(metadata['path'])):
+            return None
+        return metadata
+
+    async def get(self, python: str, requirements: str, debug: bool = False) -> str:
+        normalized = normalize_requirements(requirements)
+        key = hash_content(normalized, shutil.which(
+            python), platform.platform())
+        if key not in self.locks:
+            self.locks[key] = asyncio.Lock()
+        # Candidates with the same requirements wait for the first one to build the environment
+        with tracer.span('virtual environment', 'venv'):
+            async with self.locks[key]:
+                metadata = self.read_metadata(key)
+                if metadata is None:
+                    venv_path = await self.build(python, normalized, key, debug)
+                    if venv_path in self.failed:
+                        return venv_path
+                else:
+                    venv_path = metadata['path']
+                    # The metadata modification time is the last access time for the LRU eviction
+                    os.utime(self.get_metadata_path(key))
+                self.in_use.add(venv_path)
+        self.evict()
+        return venv_path
+
+    async def build(self, python: str, requirements: list[str], key: str, debug: bool = False) -> str:
+        os.makedirs(self.get_directory(), exist_ok=True)
+        venv_path = tempfile.mkdtemp(
+            dir=self.get_directory(), prefix=f'{key[:16]}_')
+        print('Creating virtual environment...')
+        try:
+            with tracer.span('create virtual environment', 'venv'):
+                await exec_subprocess(python, '-m', 'venv', '--clear', venv_path, check=True)
+        except Exception as e:
+            shutil.rmtree(venv_path, ignore_errors=True)
+            raise e
+        if len(requirements) > 0:
+            print('Installing requirements...')
+            req_file = os.path.join(venv_path, 'requirements.txt')
+            write_file(req_file, '\n'.join(requirements))
+            # Tried twice, so a network hiccup does not fail the candidate
+            for attempt in range(2):
+                try:
+                    with tracer.span('pip install', 'pip', requirements=len(requirements), attempt=attempt):
+                        await exec_subprocess(get_venv_pip(venv_path), 'install', '--disable-pip-version-check',
+                                              '--no-compile', '-r', req_file, timeout=120, check=True)
+                    break
+                except Exception as e:
+                    if debug:
+                        print('Failed to install requirements', e)
+            else:
+                # Like a broken requirement, a failed install is left for the test run to report. The next
+                # candidate with the same requirements tries again
+                self.failed.add(venv_path)
+                return venv_path
+        metadata = self.read_metadata(key)
+        if metadata is not None:
+            # Another process built the same environment in the meantime
+            shutil.rmtree(venv_path, ignore_errors=True)
+            return metadata['path']
+        fd, tmp_path = tempfile.mkstemp(
+            dir=self.get_directory(), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({
+                'path': venv_path,
+                'requirements': requirements,
+                'size': get_directory_size(venv_path),
+                'created': time.time(),
+            }, f)
+        os.replace(tmp_path, self.get_metadata_path(key))
+        return venv_path
+
+    def evict(self):
+        entries = []
+        published = set()
+        total_size = 0
+        names = os.listdir(self.get_directory())
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            metadata_path = os.path.join(self.get_directory(), name)
+            try:
+                metadata = json.loads(read_file(metadata_path))
+                last_used = os.stat(metadata_path).st_mtime
+            except Exception:
+                continue
+            published.add(metadata['path'])
+            entries.append(
+                (last_used, metadata['size'], metadata_path, metadata['path']))
+            total_size = total_size + metadata['size']
+        for name in names:
+            path = os.path.join(self.get_directory(), name)
+            # Leftovers from a process that died while building an environment, or that lost a race to build it
+            try:
+                if path not in published and path not in self.in_use and path not in self.failed and \
+                        time.time() - os.stat(path).st_mtime > 24 * 60 * 60 and not name.endswith('.json'):
+                    if os.path.isdir(path):
+                        shutil.rmtree(path, ignore_errors=True)
+                    else:
+                        os.remove(path)
+            except OSError:
+                pass
+        # Least recently used environments go first, skipping the ones this process is using
+        for (_, size, metadata_path, venv_path) in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if venv_path in self.in_use:
+                continue
+            # Drop the metadata first so nobody picks up a half deleted environment
+            try:
+                os.remove(metadata_path)
+            except OSError:
+                continue
+            shutil.rmtree(venv_path, ignore_errors=True)
+            total_size = total_size - size
+
+    def cleanup(self):
+        for venv_path in self.failed:
+            shutil.rmtree(venv_path, ignore_errors=True)
+        self.failed = set()
+        self.in_use = set()
+
+
+venv_cache = VenvCache()
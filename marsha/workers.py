@@ -0,0 +1,192 @@
+import asyncio
+import json
+import os
+import re
+from inspect import getsourcefile
+
+from marsha.ratelimit import subprocess_limit
+
+DEFAULT_POOL_SIZE = 3
+DEFAULT_MAX_RUNS = 100
+WORKER_STARTUP_TIMEOUT = 60.0
+# Each result is one JSON line with everything the tests printed, far over the 64KiB default for a noisy suite
+WORKER_OUTPUT_LIMIT = 64 * 1024 * 1024
+# Requirements whose module name differs from the package name
+REQUIREMENT_MODULES = {
+    'beautifulsoup4': 'bs4',
+    'opencv-python': 'cv2',
+    'pillow': 'PIL',
+    'python-dateutil': 'dateutil',
+    'pyyaml': 'yaml',
+    'scikit-learn': 'sklearn',
+}
+
+
+def get_worker_script() -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(getsourcefile(lambda: 0))), 'test_worker.py')
+
+
+def get_preload_modules(requirements: str) -> list[str]:
+    modules = []
+    for line in requirements.split('\n'):
+        name = re.split(r'[\s<>=!~;\[@#]', line.strip(), 1)[0].lower()
+        if len(name) == 0:
+            continue
+        modules.append(REQUIREMENT_MODULES.get(
+            name, name.replace('-', '_')))
+    return modules
+
+
+class TestWorker:
+    """A warm interpreter that runs test files in forked children"""
+
+    def __init__(self, python_exe: str, preload: list[str]):
+        self.python_exe = python_exe
+        self.preload = preload
+        self.process = None
+        self.runs = 0
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(
+            self.python_exe, get_worker_script(), '--preload', ','.join(self.preload),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            limit=WORKER_OUTPUT_LIMIT)
+        line = await asyncio.wait_for(self.process.stdout.readline(), WORKER_STARTUP_TIMEOUT)
+        if not json.loads(line or 'null'):
+            raise Exception('Test worker failed to start')
+
+    async def run(self, test_file: str, args: list[str], timeout: float) -> dict:
+        self.runs = self.runs + 1
+        self.process.stdin.write((json.dumps({
+            'test_file': test_file,
+            'args': args,
+            'timeout': timeout,
+        }) + '\n').encode('utf-8'))
+        await self.process.stdin.drain()
+        # The worker kills the test after the timeout, the extra time covers reading the output back
+        line = await asyncio.wait_for(self.process.stdout.readline(), timeout + 10)
+        if len(line) == 0:
+            raise Exception('Test worker exited unexpectedly')
+        result = json.loads(line)
+        if 'error' in result:
+            raise Exception(f'Test worker failed: {result["error"]}')
+        return result
+
+    def kill(self):
+        if self.process is not None and self.process.returncode is None:
+            try:
+                self.process.kill()
+            except ProcessLookupError:
+                pass
+
+
+class TestWorkerPool:
+    """Warm test workers for one interpreter, recycled after `max_runs` test runs or on a crash"""
+
+    def __init__(self, python_exe: str, preload: list[str], size: int = DEFAULT_POOL_SIZE,
+                 max_runs: int = DEFAULT_MAX_RUNS):
+        self.python_exe = python_exe
+        self.preload = preload
+        self.size = size
+        self.max_runs = max_runs
+        self.idle = asyncio.Queue()
+        self.starting = set()
+        # Killed workers are reaped on close, so none of them exits after the event loop is gone
+        self.killed = []
+        # Start the workers right away so they are warm by the time the tests are written
+        for _ in range(size):
+            self.spawn()
+
+    def spawn(self):
+        task = asyncio.create_task(self.start_worker())
+        self.starting.add(task)
+        task.add_done_callback(self.starting.discard)
+
+    async def start_worker(self):
+        worker = TestWorker(self.python_exe, self.preload)
+        try:
+            await worker.start()
+        except asyncio.CancelledError as e:
+            self.retire(worker)
+            raise e
+        except Exception:
+            worker.kill()
+            worker = None
+        # A failed worker still goes in the queue so nobody waits forever, and is replaced on use
+        await self.idle.put(worker)
+
+    async def run(self, test_file: str, args: list[str], timeout: float) -> tuple[str, str]:
+        worker = await self.idle.get()
+        if worker is None:
+            self.spawn()
+            raise Exception('Test worker failed to start')
+        try:
+            result = await worker.run(test_file, args, timeout)
+        except (Exception, asyncio.CancelledError) as e:
+            # A cancelled run leaves its result unread in the pipe, so the worker can't be reused either
+            self.retire(worker)
+            self.spawn()
+            raise e
+        if worker.runs >= self.max_runs:
+            self.retire(worker)
+            self.spawn()
+        else:
+            await self.idle.put(worker)
+        # Only the forked child is killed on a timeout, the worker itself is fine
+        if result['timeout']:
+            raise Exception(f'run_subprocess timeout after {timeout} seconds')
+        return (result['stdout'], result['stderr'])
+
+    def retire(self, worker: TestWorker):
+        worker.kill()
+        self.killed.append(worker)
+
+    async def close(self):
+        for task in list(self.starting):
+            task.cancel()
+        await asyncio.gather(*self.starting, return_exceptions=True)
+        while not self.idle.empty():
+            worker = self.idle.get_nowait()
+            if worker is not None:
+                self.retire(worker)
+        await asyncio.gather(*[worker.process.wait() for worker in self.killed if worker.process is not None],
+                             return_exceptions=True)
+        self.killed = []
+
+
+class TestWorkerPools:
+    """Test worker pools keyed by interpreter, falling back to a new process per run without `fork`"""
+
+    def __init__(self, size: int = DEFAULT_POOL_SIZE, max_runs: int = DEFAULT_MAX_RUNS):
+        self.configure(size, max_runs)
+        self.pools = {}
+
+    def configure(self, size: int, max_runs: int = DEFAULT_MAX_RUNS):
+        self.size = size
+        self.max_runs = max_runs
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0 and hasattr(os, 'fork')
+
+    def get(self, python_exe: str, requirements: str = '') -> TestWorkerPool:
+        if python_exe not in self.pools:
+            self.pools[python_exe] = TestWorkerPool(
+                python_exe, get_preload_modules(requirements), self.size, self.max_runs)
+        return self.pools[python_exe]
+
+    async def run(self, python_exe: str, requirements: str, test_file: str, *args: str,
+                  timeout: float = 60.0) -> tuple[str, str]:
+        pool = self.get(python_exe, requirements)
+        async with subprocess_limit:
+            return await pool.run(test_file, list(args), timeout)
+
+    async def close(self):
+        pools = self.pools
+        self.pools = {}
+        await asyncio.gather(*[pool.close() for pool in pools.values()])
+
+
+test_workers = TestWorkerPools()
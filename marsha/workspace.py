@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+
+from marsha.cache import hash_content
+from marsha.trace import tracer
+from marsha.utils import read_file, write_file
+
+# Shared memory is a tmpfs on Linux, so the files the tests run from never hit the disk
+TMPFS_DIRECTORY = '/dev/shm'
+
+
+def get_workspace_root() -> str:
+    if os.path.isdir(TMPFS_DIRECTORY) and os.access(TMPFS_DIRECTORY, os.W_OK | os.X_OK):
+        return TMPFS_DIRECTORY
+    # The default temporary directory
+    return None
+
+
+class Workspace:
+    """The files of one candidate, kept in memory while they are linted, fixed and formatted. They are only
+    written to `directory` when a subprocess needs them, like the test run, and then only the ones that changed
+    since the last time"""
+
+    def __init__(self, suffix: str):
+        # The name is reserved up front, the paths of the files show up in the prompts
+        self.directory = tempfile.mkdtemp(
+            suffix=suffix, dir=get_workspace_root())
+        self.files = {}
+        # Hash of what is on disk for every file written there
+        self.written = {}
+
+    def exists(self, path: str) -> bool:
+        return path in self.files
+
+    def read(self, path: str) -> str:
+        if path not in self.files:
+            return read_file(path)
+        return self.files[path]
+
+    def write(self, path: str, content: str):
+        self.files[path] = content
+
+    def materialize(self) -> list[str]:
+        """Writes the files that changed since they were last written, returning their paths"""
+        changed = []
+        with tracer.span('write files', 'io'):
+            for (path, content) in self.files.items():
+                content_hash = hash_content(content)
+                if self.written.get(path) == content_hash:
+                    continue
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                write_file(path, content)
+                self.written[path] = content_hash
+                changed.append(path)
+        return changed
+
+    def export(self, destination: str):
+        """Writes every file into another directory, keeping the layout, like the failed candidates to debug"""
+        for (path, content) in self.files.items():
+            relative_path = os.path.relpath(path, self.directory)
+            if relative_path.startswith('..'):
+                continue
+            os.makedirs(os.path.dirname(os.path.join(
+                destination, relative_path)), exist_ok=True)
+            write_file(os.path.join(destination, relative_path), content)
+
+    def cleanup(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.files = {}
+        self.written = {}
@@ -18,8 +18,7 @@ setup(
         'pycodestyle',
         'pydocstyle',
         'pyflakes',
-        'pyinstaller',
-        'pylama'
+        'pyinstaller'
     ],
     classifiers=[
         'Development Status :: 2 - Pre-Alpha',
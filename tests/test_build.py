@@ -0,0 +1,80 @@
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from io import StringIO
+from unittest import mock
+
+from marsha.stats import MarshaStats
+
+# The arguments are parsed when the module is imported
+with mock.patch.object(sys, 'argv', ['marsha', '--build', '.']):
+    from marsha import base
+
+SORT_BY_AGE = '''# type person
+name, age
+Joe, 20
+
+# func sort_by_age(person list): person list ordered by age
+
+Orders the people by age.
+
+* sort_by_age([person('Joe', 20)]) = [person('Joe', 20)]
+'''
+TAKE_YOUNGEST = '''# func take_youngest(person list): youngest person
+
+Gets the youngest person using the `sort_by_age` function.
+
+* take_youngest([person('Joe', 20)]) = person('Joe', 20)
+'''
+FIBONACCI = '''# func fibonacci(integer): integer
+
+Calculates the nth fibonacci number.
+
+* fibonacci(1) = 1
+'''
+
+
+class TestBuild(unittest.TestCase):
+    def test_files_compile_concurrently_without_ordering(self):
+        cases = [
+            ('independent files', {
+             'fibonacci.mrsh': FIBONACCI, 'sort_by_age.mrsh': SORT_BY_AGE}),
+            # `take_youngest` uses a function of the other file, which does not make it wait for that file
+            ('file using a function of another', {'sort_by_age.mrsh': SORT_BY_AGE,
+                                                  'take_youngest.mrsh': TAKE_YOUNGEST}),
+        ]
+        for (name, files) in cases:
+            with self.subTest(name):
+                with tempfile.TemporaryDirectory() as directory:
+                    source = os.path.join(directory, 'src')
+                    os.makedirs(source)
+                    for (filename, content) in files.items():
+                        with open(os.path.join(source, filename), 'w') as f:
+                            f.write(content)
+                    started = []
+
+                    async def compile_file(input_file: str, output_dir: str) -> int:
+                        started.append(os.path.basename(input_file))
+                        # Only finishes once every file started, which never happens if one waits for another
+                        while len(started) < len(files):
+                            await asyncio.sleep(0.01)
+                        return 1
+
+                    cwd = os.getcwd()
+                    os.chdir(directory)
+                    try:
+                        with mock.patch.object(base, 'compile_file', compile_file), \
+                                mock.patch.object(base, 'stats', MarshaStats()), \
+                                redirect_stdout(StringIO()):
+                            asyncio.run(asyncio.wait_for(
+                                base.build(source), 5))
+                    finally:
+                        os.chdir(cwd)
+                self.assertEqual(sorted(started), sorted(files.keys()))
+
+
+if __name__ == '__main__':
+    unittest.main()
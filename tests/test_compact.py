@@ -0,0 +1,179 @@
+import unittest
+
+from marsha.compact import DIVIDER, ELIDED_BODY, SEPARATOR, compact_fix_prompt, compact_test_results, elide_tests, \
+    restore_elided_tests, split_test_results, truncate_to_tokens
+from marsha.tokens import count_tokens
+
+TEST = '''import unittest
+from two import add, mul
+
+
+class TestAdd(unittest.TestCase):
+    def test_add(self):
+        """Adds two numbers"""
+        self.assertEqual(add(1, 2), 3)
+
+    @unittest.skipIf(False, 'never')
+    def test_negative(self):
+        result = add(-1, -2)
+        self.assertEqual(
+            result,
+            -3)
+
+    def test_one_line(self): self.assertEqual(add(0, 0), 0)
+
+
+class TestMul(unittest.TestCase):
+    def test_mul(self):
+        self.assertEqual(mul(2, 3), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
+'''
+
+
+def failure(kind: str, method: str, test_class: str, line: int, error: str) -> str:
+    return '\n'.join([SEPARATOR, f'{kind}: {method} (__main__.{test_class}.{method})', DIVIDER,
+                      'Traceback (most recent call last):',
+                      f'  File "/tmp/two_test.py", line {line}, in {method}',
+                      '    self.assertEqual(mul(2, 3), 6)',
+                      '  File "/tmp/two.py", line 5, in mul',
+                      '    return a + b',
+                      error, ''])
+
+
+RESULTS = 'FF.\n' + failure('FAIL', 'test_mul', 'TestMul', 21, 'AssertionError: 5 != 6') + \
+    failure('FAIL', 'test_big', 'TestMul', 24, 'AssertionError: 5 != 6') + \
+    '\n'.join([DIVIDER, 'Ran 3 tests in 0.001s',
+              '', 'FAILED (failures=2)', ''])
+
+
+class TestElideAndRestore(unittest.TestCase):
+    def test_elide(self):
+        cases = [
+            ('nothing', set(), set(), []),
+            ('one test', {('TestAdd', 'test_add')}, {('TestAdd', 'test_add')},
+             ['"""Adds two numbers"""', 'add(1, 2), 3']),
+            ('multi-line body', {('TestAdd', 'test_negative')}, {('TestAdd', 'test_negative')},
+             ['result = add(-1, -2)', '-3)']),
+            ('body on the def line', {
+             ('TestAdd', 'test_one_line')}, set(), []),
+            ('unknown test', {('TestAdd', 'test_missing')}, set(), []),
+            ('same method name in another class', {
+             ('TestMul', 'test_add')}, set(), []),
+            ('every test', {('TestAdd', 'test_add'), ('TestAdd', 'test_negative'), ('TestMul', 'test_mul')},
+             {('TestAdd', 'test_add'), ('TestAdd',
+                                        'test_negative'), ('TestMul', 'test_mul')},
+             ['add(1, 2), 3', 'result = add(-1, -2)', 'mul(2, 3), 6']),
+        ]
+        for (name, names, expected, removed) in cases:
+            with self.subTest(name):
+                (elided_test, elided) = elide_tests(TEST, names)
+                self.assertEqual(elided, expected)
+                self.assertEqual(elided_test.count(ELIDED_BODY), len(expected))
+                for text in removed:
+                    self.assertNotIn(text, elided_test)
+                self.assertEqual(restore_elided_tests(
+                    elided_test, TEST, elided), TEST)
+
+    def test_restore_what_the_llm_returned(self):
+        names = {('TestAdd', 'test_add'), ('TestMul', 'test_mul')}
+        (elided_test, elided) = elide_tests(TEST, names)
+        fixed_mul = elided_test.replace(
+            f'    def test_mul(self):\n        {ELIDED_BODY}', '    def test_mul(self):\n        self.assertEqual(mul(2, 2), 4)')
+        cases = [
+            ('left alone', elided_test, TEST),
+            ('one test rewritten', fixed_mul,
+             TEST.replace('mul(2, 3), 6', 'mul(2, 2), 4')),
+            ('reindented', elided_test.replace('    ', '  '),
+             TEST.replace('    ', '  ')),
+            ('does not parse', elided_test + '\ndef broken(:\n',
+             elided_test + '\ndef broken(:\n'),
+        ]
+        for (name, returned, expected) in cases:
+            with self.subTest(name):
+                self.assertEqual(restore_elided_tests(
+                    returned, TEST, elided), expected)
+
+    def test_elide_invalid_test(self):
+        with self.assertRaises(SyntaxError):
+            elide_tests('def broken(:\n', {('TestAdd', 'test_add')})
+
+
+class TestTestResults(unittest.TestCase):
+    def test_split(self):
+        (failures, summary) = split_test_results(RESULTS)
+        self.assertEqual([f.test for f in failures], [
+                         ('TestMul', 'test_mul'), ('TestMul', 'test_big')])
+        self.assertEqual(failures[0].signature, failures[1].signature)
+        self.assertTrue(summary.startswith('Ran 3 tests'))
+        self.assertTrue(summary.endswith('FAILED (failures=2)'))
+
+    def test_failure_header_formats(self):
+        cases = [
+            ('Python 3.11', 'FAIL: test_mul (__main__.TestMul.test_mul)'),
+            ('before Python 3.11', 'FAIL: test_mul (__main__.TestMul)'),
+            ('module name', 'ERROR: test_mul (two_test.TestMul.test_mul)'),
+        ]
+        for (name, header) in cases:
+            with self.subTest(name):
+                (failures, _) = split_test_results(
+                    '\n'.join([SEPARATOR, header, DIVIDER, 'Traceback']))
+                self.assertEqual(failures[0].test, ('TestMul', 'test_mul'))
+
+    def test_compact(self):
+        cases = [
+            ('identical failures', RESULTS, [
+             'Same error as `test_mul`', 'Ran 3 tests'], ['FF.', 'line 24']),
+            ('different failures', RESULTS.replace('AssertionError: 5 != 6\n' + DIVIDER, 'ZeroDivisionError\n' + DIVIDER),
+             ['line 24', 'ZeroDivisionError'], ['Same error as']),
+            ('no failures', 'Traceback (most recent call last):\nImportError: no module\n',
+             ['ImportError: no module'], []),
+        ]
+        for (name, results, present, absent) in cases:
+            with self.subTest(name):
+                compacted = compact_test_results(results)
+                for text in present:
+                    self.assertIn(text, compacted)
+                for text in absent:
+                    self.assertNotIn(text, compacted)
+
+    def test_truncate(self):
+        text = '\n'.join([f'line {i} of the traceback' for i in range(200)])
+        cases = [
+            ('fits', 10000, text),
+            ('truncated', 200, None),
+        ]
+        for (name, max_tokens, expected) in cases:
+            with self.subTest(name):
+                truncated = truncate_to_tokens(text, max_tokens)
+                if expected is not None:
+                    self.assertEqual(truncated, expected)
+                    continue
+                self.assertLessEqual(count_tokens(truncated), max_tokens + 20)
+                self.assertIn('lines truncated', truncated)
+                self.assertTrue(truncated.startswith('line 0 '))
+                self.assertTrue(truncated.endswith(
+                    'line 199 of the traceback'))
+
+
+class TestCompactFixPrompt(unittest.TestCase):
+    def test_compact(self):
+        passing = {('TestAdd', 'test_add'), ('TestAdd', 'test_negative')}
+        (test, test_results, elided) = compact_fix_prompt(
+            100, TEST, RESULTS, passing)
+        self.assertEqual(elided, passing)
+        self.assertEqual(test.count(ELIDED_BODY), 2)
+        self.assertIn('Same error as `test_mul`', test_results)
+        self.assertEqual(restore_elided_tests(test, TEST, elided), TEST)
+
+    def test_invalid_test(self):
+        (test, _, elided) = compact_fix_prompt(
+            100, 'def broken(:\n', RESULTS, {('TestAdd', 'test_add')})
+        self.assertEqual(test, 'def broken(:\n')
+        self.assertEqual(elided, set())
+
+
+if __name__ == '__main__':
+    unittest.main()
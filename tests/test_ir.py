@@ -0,0 +1,147 @@
+import glob
+import os
+import re
+import tempfile
+import unittest
+
+from marsha.ir import Spec, SpecCache, lex_sections, parse_spec
+from marsha.utils import read_file
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'examples')
+
+SPEC = '''# type Person
+
+name, age
+Alice, 30
+Bob, 25
+
+# func sort_by_age(list of Person): list of Person sorted by age
+
+This function receives a list of people and returns a new list with the same people sorted by their age, youngest first.
+
+* sort_by_age([Person('Alice', 30), Person('Bob', 25)]) = [Person('Bob', 25), Person('Alice', 30)]
+* sort_by_age([]) = []
+
+# func log_people(list of Person)
+
+This function prints the name and age of every person in the list it receives, one person per line, in the same order.
+'''
+
+
+def legacy_sections(content: str) -> list[tuple[str, str]]:
+    # How the sections were split before the lexer, for files that only have `#` at the start of headings
+    sections = []
+    for section in content.split('#'):
+        match = re.match(r'\s*(func|type)\b', section)
+        if match is not None:
+            sections.append((match.group(1), f'# {section.lstrip()}'))
+    return sections
+
+
+class TestLexSections(unittest.TestCase):
+    def test_sections(self):
+        cases = [
+            ('empty', '', []),
+            ('no sections', 'Some notes\n', []),
+            ('function and type', '# func a(int): int\n\ndesc\n\n* a(1) = 2\n\n# type T t.csv\n',
+             [('func', '# func a(int): int\n\ndesc\n\n* a(1) = 2\n\n'), ('type', '# type T t.csv\n')]),
+            ('hash inside a line', '# func a(): int\n\nuses C# and #tags\n',
+             [('func', '# func a(): int\n\nuses C# and #tags\n')]),
+            ('deeper headings', '## func a(int): int\n\nd\n\n### Notes\n\nignored\n# type T\n\nx, y\n1, 2\n',
+             [('func', '# func a(int): int\n\nd\n\n'), ('type', '# type T\n\nx, y\n1, 2\n')]),
+            ('indented heading after text', 'intro text\n\n  # func a(int)\n\nd\n',
+             [('func', '# func a(int)\n\nd\n')]),
+            ('no trailing newline', '# type T t.csv',
+             [('type', '# type T t.csv')]),
+            ('word starting with func', '# functions\n\nnotes\n# func a(int)\n\nd\n',
+             [('func', '# func a(int)\n\nd\n')]),
+        ]
+        for (name, content, expected) in cases:
+            with self.subTest(name):
+                self.assertEqual(lex_sections(content), expected)
+
+    def test_examples_match_legacy_split(self):
+        for path in sorted(glob.glob(os.path.join(EXAMPLES, '**', '*.mrsh'), recursive=True)):
+            content = read_file(path)
+            if any(['#' in line.lstrip()[1:].lstrip('#') for line in content.split('\n')]):
+                # The legacy split breaks sections at a `#` anywhere
+                continue
+            with self.subTest(os.path.relpath(path, EXAMPLES)):
+                self.assertEqual(lex_sections(content),
+                                 legacy_sections(content))
+
+
+class TestParseSpec(unittest.TestCase):
+    def test_spec(self):
+        spec = parse_spec(SPEC)
+        self.assertEqual([t.name for t in spec.types], ['Person'])
+        self.assertIsNone(spec.types[0].filename)
+        self.assertEqual([f.name for f in spec.functions],
+                         ['sort_by_age', 'log_people'])
+        (sort_by_age, log_people) = spec.functions
+        self.assertEqual([a.type for a in sort_by_age.args],
+                         ['list of Person'])
+        self.assertEqual(sort_by_age.returns,
+                         'list of Person sorted by age')
+        self.assertFalse(sort_by_age.void)
+        self.assertEqual(len(sort_by_age.examples), 2)
+        self.assertTrue(sort_by_age.format_examples().startswith(
+            '* sort_by_age(['))
+        self.assertTrue(log_people.void)
+        self.assertEqual(log_people.examples, [])
+        self.assertIs(spec.function(sort_by_age.source), sort_by_age)
+
+    def test_type_from_file(self):
+        spec = parse_spec('# type Employee employees.csv\n')
+        self.assertEqual(spec.types[0].name, 'Employee')
+        self.assertEqual(spec.types[0].filename, 'employees.csv')
+
+    def test_errors(self):
+        short = '# func a(int): int\n\nToo short.\n\n* a(1) = 2\n* a(2) = 3\n'
+        description = 'This function receives an integer and returns the next one, for any integer number it gets.'
+        cases = [
+            ('no sections', 'Just some notes\n'),
+            ('short description', short),
+            ('one example',
+             f'# func a(int): int\n\n{description}\n\n* a(1) = 2\n'),
+            ('no examples', f'# func a(int): int\n\n{description}\n'),
+            ('missing return type',
+             f'# func a(int):\n\n{description}\n\n* a(1) = 2\n* a(2) = 3\n'),
+            ('type without examples', '# type T\n\nx, y\n'),
+        ]
+        for (name, content) in cases:
+            with self.subTest(name):
+                with self.assertRaises(Exception):
+                    parse_spec(content)
+
+    def test_dict_round_trip(self):
+        spec = parse_spec(SPEC)
+        spec.dependencies.append(['/tmp/employees.csv', 'abc'])
+        self.assertEqual(Spec.from_dict(spec.to_dict()), spec)
+
+
+class TestSpecCache(unittest.TestCase):
+    def test_keyed_on_source_and_directory(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = SpecCache(directory)
+            spec = parse_spec(SPEC)
+            cache.set(SPEC, 'a', spec)
+            self.assertEqual(cache.get(SPEC, 'a'), spec)
+            self.assertIsNone(cache.get(SPEC, 'b'))
+            self.assertIsNone(cache.get(SPEC + '\n', 'a'))
+
+    def test_stale_dependency(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = SpecCache(directory)
+            type_file = os.path.join(directory, 'types.csv')
+            with open(type_file, 'w') as f:
+                f.write('x, y\n1, 2\n')
+            spec = parse_spec(SPEC)
+            spec.dependencies.append([type_file, 'not the hash'])
+            cache.set(SPEC, directory, spec)
+            self.assertIsNone(cache.get(SPEC, directory))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from marsha import lint
+from marsha.lint import LintEngine
+
+
+class TestLintCache(unittest.TestCase):
+    def setUp(self):
+        self.engine = LintEngine(max_workers=1)
+
+    def tearDown(self):
+        self.engine.shutdown()
+
+    def test_hit_on_oldest_entry_when_full(self):
+        async def run():
+            with mock.patch.object(lint, 'MAX_CACHE_ENTRIES', 2):
+                await self.engine.lint({'a.py': 'a = 1\n'})
+                await self.engine.lint({'b.py': 'b = 1\n'})
+                # `a.py` is a hit on the oldest entry, and the new files push the cache over its size
+                result = await self.engine.lint({'a.py': 'a = 1\n', 'c.py': 'c = 1\n', 'd.py': 'd = undefined\n'})
+                return (result, list(self.engine.cache.values()))
+        (result, cached) = asyncio.run(run())
+        self.assertEqual(result['a.py'], [])
+        self.assertEqual(result['c.py'], [])
+        self.assertEqual(len(result['d.py']), 1)
+        self.assertIn('undefined', result['d.py'][0])
+        self.assertEqual(len(cached), 2)
+
+    def test_least_recently_used_is_evicted(self):
+        async def run():
+            with mock.patch.object(lint, 'MAX_CACHE_ENTRIES', 2):
+                await self.engine.lint({'a.py': 'a = 1\n'})
+                await self.engine.lint({'b.py': 'b = 1\n'})
+                # Using `a.py` again makes `b.py` the least recently used
+                await self.engine.lint({'a.py': 'a = 1\n'})
+                await self.engine.lint({'c.py': 'c = 1\n'})
+                with mock.patch.object(self.engine, 'run_batch', side_effect=AssertionError('not cached')):
+                    await self.engine.lint({'a.py': 'a = 1\n'})
+        asyncio.run(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+import unittest
+
+from marsha.patch import PatchError, apply_edits, parse_patch, parse_search_replace, parse_unified_diff, patcher
+
+CODE = '''USAGE = \'\'\'
+-- add: adds two numbers
+\'\'\'
+
+
+def add(a, b):
+    # adds two numbers
+    return a + b
+
+
+def sub(a, b):
+    return a - b
+'''
+
+
+class TestParseSearchReplace(unittest.TestCase):
+    def test_blocks(self):
+        cases = [
+            ('one block', '<<<<<<< SEARCH\n    return a + b\n=======\n    return b + a\n>>>>>>> REPLACE',
+             [('    return a + b', '    return b + a')]),
+            ('two blocks', '<<<<<<< SEARCH\na\n=======\nb\n>>>>>>> REPLACE\n\n<<<<<<< SEARCH\nc\n=======\nd\n'
+             '>>>>>>> REPLACE', [('a', 'b'), ('c', 'd')]),
+            ('empty replace',
+             '<<<<<<< SEARCH\na\n=======\n>>>>>>> REPLACE', [('a', '')]),
+            ('multi-line', '<<<<<<< SEARCH\na\nb\n=======\nc\nd\ne\n>>>>>>> REPLACE',
+             [('a\nb', 'c\nd\ne')]),
+            ('marker without space',
+             '<<<<<<<SEARCH\na\n=======\nb\n>>>>>>>REPLACE', [('a', 'b')]),
+        ]
+        for (name, patch, expected) in cases:
+            with self.subTest(name):
+                self.assertEqual(parse_search_replace(patch), expected)
+
+    def test_errors(self):
+        cases = [
+            ('prose outside a block',
+             'Here is the fix\n<<<<<<< SEARCH\na\n=======\nb\n>>>>>>> REPLACE'),
+            ('unterminated', '<<<<<<< SEARCH\na\n=======\nb'),
+        ]
+        for (name, patch) in cases:
+            with self.subTest(name):
+                with self.assertRaises(PatchError):
+                    parse_search_replace(patch)
+
+
+class TestParseUnifiedDiff(unittest.TestCase):
+    def test_hunks(self):
+        cases = [
+            ('with file headers', '--- a/x.py\n+++ b/x.py\n@@ -1,2 +1,2 @@\n def add(a, b):\n-    return a + b\n'
+             '+    return b + a', [('def add(a, b):\n    return a + b', 'def add(a, b):\n    return b + a')]),
+            ('without file headers', '@@ -1 +1 @@\n-a\n+b', [('a', 'b')]),
+            ('git headers', 'diff --git a/x.py b/x.py\nindex 123..456 100644\n--- a/x.py\n+++ b/x.py\n@@ -1 +1 @@\n'
+             '-a\n+b', [('a', 'b')]),
+            ('two hunks', '@@ -1 +1 @@\n-a\n+b\n@@ -5 +5 @@\n-c\n+d',
+             [('a', 'b'), ('c', 'd')]),
+            ('removed line starting with --', '@@ -1,2 +1,2 @@\n---- a comment\n-x = 1\n+x = 2',
+             [('--- a comment\nx = 1', 'x = 2')]),
+            ('added line starting with ++',
+             '@@ -1 +1 @@\n-a\n+++b', [('a', '++b')]),
+            ('empty context line', '@@ -1,3 +1,3 @@\n a\n\n-b\n+c',
+             [('a\n\nb', 'a\n\nc')]),
+            ('no newline marker',
+             '@@ -1 +1 @@\n-a\n\\ No newline at end of file\n+b', [('a', 'b')]),
+            ('trailing blank context',
+             '@@ -1 +1 @@\n-a\n+b\n\n', [('a', 'b')]),
+        ]
+        for (name, patch, expected) in cases:
+            with self.subTest(name):
+                self.assertEqual(parse_unified_diff(patch), expected)
+
+    def test_unexpected_line(self):
+        with self.assertRaises(PatchError):
+            parse_unified_diff('@@ -1 +1 @@\n-a\nnot a diff line\n+b')
+
+
+class TestParsePatch(unittest.TestCase):
+    def test_formats(self):
+        cases = [
+            ('search/replace',
+             '<<<<<<< SEARCH\na\n=======\nb\n>>>>>>> REPLACE', [('a', 'b')]),
+            ('unified diff', '@@ -1 +1 @@\n-a\n+b', [('a', 'b')]),
+        ]
+        for (name, patch, expected) in cases:
+            with self.subTest(name):
+                self.assertEqual(parse_patch(patch), expected)
+
+    def test_no_edits(self):
+        with self.assertRaises(PatchError):
+            parse_patch('def add(a, b):\n    return a + b')
+
+
+class TestApplyEdits(unittest.TestCase):
+    def test_edits(self):
+        cases = [
+            ('replace a line', [('    return a + b', '    return b + a')],
+             CODE.replace('return a + b', 'return b + a')),
+            ('trailing whitespace is ignored', [('    return a - b   ', '    return b - a')],
+             CODE.replace('return a - b', 'return b - a')),
+            ('remove a line', [('    # adds two numbers', '')],
+             CODE.replace('    # adds two numbers\n', '')),
+            ('append to the end', [('', 'def mul(a, b):\n    return a * b')],
+             CODE.rstrip('\n') + '\ndef mul(a, b):\n    return a * b\n'),
+            ('several edits', [('    return a + b', '    return b + a'), ('    return a - b', '    return b - a')],
+             CODE.replace('return a + b', 'return b + a').replace('return a - b', 'return b - a')),
+        ]
+        for (name, edits, expected) in cases:
+            with self.subTest(name):
+                self.assertEqual(apply_edits(CODE, edits), expected)
+
+    def test_errors(self):
+        cases = [
+            ('not found', [('    return a * b', '    return b * a')]),
+            ('found more than once', [('def', 'async def')]),
+        ]
+        for (name, edits) in cases:
+            with self.subTest(name):
+                with self.assertRaises(PatchError):
+                    apply_edits(CODE, edits)
+
+    def test_round_trip(self):
+        # A diff of a change applied to the original gives back the changed file
+        changed = CODE.replace('-- add: adds two numbers',
+                               '++ add: adds two numbers')
+        diff = '--- a/x.py\n+++ b/x.py\n@@ -1,3 +1,3 @@\n USAGE = \'\'\'\n--- add: adds two numbers\n' \
+            '+++ add: adds two numbers\n \'\'\''
+        self.assertEqual(apply_edits(CODE, parse_patch(diff)), changed)
+
+
+class TestPatcher(unittest.TestCase):
+    def test_apply(self):
+        patched = patcher.apply({'x.py': CODE, 'requirements.txt': 'requests'},
+                                {'x.py': '<<<<<<< SEARCH\n    return a + b\n=======\n    return b + a\n>>>>>>> REPLACE'})
+        self.assertEqual(
+            patched, {'x.py': CODE.replace('return a + b', 'return b + a')})
+
+    def test_errors(self):
+        cases = [
+            ('unexpected file', {'y.py': '@@ -1 +1 @@\n-a\n+b'}),
+            ('invalid Python', {'x.py': '<<<<<<< SEARCH\n    return a + b\n=======\n    return (a + b\n'
+                                '>>>>>>> REPLACE'}),
+        ]
+        for (name, patches) in cases:
+            with self.subTest(name):
+                with self.assertRaises(PatchError):
+                    patcher.apply({'x.py': CODE}, patches)
+
+
+if __name__ == '__main__':
+    unittest.main()
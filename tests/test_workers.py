@@ -0,0 +1,51 @@
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+
+from marsha.workers import TestWorker
+
+TEST = '''import unittest
+
+
+class TestOutput(unittest.TestCase):
+    def test_output(self):
+        print('x' * {size})
+
+
+if __name__ == '__main__':
+    unittest.main()
+'''
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'Test workers fork a child for every run')
+class TestTestWorker(unittest.TestCase):
+    def test_output_sizes(self):
+        cases = [
+            ('small', 10),
+            ('over the default stream limit', 300 * 1024),
+        ]
+        for (name, size) in cases:
+            with self.subTest(name):
+                with tempfile.TemporaryDirectory() as directory:
+                    test_file = os.path.join(directory, 'output_test.py')
+                    with open(test_file, 'w') as f:
+                        f.write(TEST.format(size=size))
+
+                    async def run():
+                        worker = TestWorker(sys.executable, [])
+                        await worker.start()
+                        try:
+                            return await worker.run(test_file, [], 30)
+                        finally:
+                            worker.kill()
+                            await worker.process.wait()
+                    result = asyncio.run(run())
+                self.assertEqual(result['exitcode'], 0)
+                self.assertEqual(len(result['stdout']), size + 1)
+                self.assertIn('OK', result['stderr'])
+
+
+if __name__ == '__main__':
+    unittest.main()